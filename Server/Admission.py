@@ -0,0 +1,157 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+
+def busy_response(retry_after):
+    """Fast rejection sent instead of queueing a connection or request past the limits"""
+    return {
+        'type': 'busy_response',
+        'status': 'busy',
+        'message': 'Server is busy, please retry shortly.',
+        'retry_after': retry_after
+    }
+
+
+class AdmissionController:
+    """
+    Connection and in-flight request limits for the threaded engine
+
+    Up to max_in_flight requests run at once. Past that, up to max_queued requests wait
+    for a slot for at most queue_deadline seconds, anything beyond that (or still waiting
+    at the deadline) is shed and answered with busy_response() right away.
+    """
+
+    def __init__(self, max_connections=1024, max_in_flight=64, max_queued=256, queue_deadline=0.5):
+        self.max_connections = max_connections
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.queue_deadline = queue_deadline
+
+        self.connections = 0
+        self.in_flight = 0
+        self.queued = 0
+        self.rejected_connections = 0
+        self.shed_requests = 0
+        self._condition = threading.Condition()
+
+    def open_connection(self):
+        """Count a new connection, False if the server is already at max_connections"""
+        with self._condition:
+            if self.connections >= self.max_connections:
+                self.rejected_connections += 1
+                return False
+            self.connections += 1
+            return True
+
+    def close_connection(self):
+        with self._condition:
+            self.connections -= 1
+
+    def acquire(self):
+        """Wait for a request slot, False if the request should be shed"""
+        with self._condition:
+            if self.in_flight < self.max_in_flight and not self.queued:
+                self.in_flight += 1
+                return True
+            if self.queued >= self.max_queued:
+                self.shed_requests += 1
+                return False
+
+            self.queued += 1
+            deadline = time.monotonic() + self.queue_deadline
+            try:
+                while self.in_flight >= self.max_in_flight:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.shed_requests += 1
+                        return False
+                    self._condition.wait(remaining)
+                self.in_flight += 1
+                return True
+            finally:
+                self.queued -= 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def snapshot(self):
+        """Current load and limits, for tuning"""
+        return {
+            'connections': self.connections,
+            'max_connections': self.max_connections,
+            'in_flight': self.in_flight,
+            'max_in_flight': self.max_in_flight,
+            'queue_depth': self.queued,
+            'max_queued': self.max_queued,
+            'queue_deadline': self.queue_deadline,
+            'rejected_connections': self.rejected_connections,
+            'shed_requests': self.shed_requests
+        }
+
+
+class AsyncAdmissionController(AdmissionController):
+    """
+    Same limits for the asyncio engine
+
+    Everything runs on the event loop thread, waiters are futures handed a slot in FIFO order.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._waiters = deque()
+
+    async def acquire_async(self):
+        """Wait for a request slot without blocking the loop, False if the request should be shed"""
+        if self.in_flight < self.max_in_flight and not self._waiters:
+            self.in_flight += 1
+            return True
+        if len(self._waiters) >= self.max_queued:
+            self.shed_requests += 1
+            return False
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.queued = len(self._waiters)
+        try:
+            await asyncio.wait_for(waiter, self.queue_deadline)
+            return True
+        except asyncio.TimeoutError:
+            if waiter.done() and not waiter.cancelled():
+                # Handed a slot in the same instant the deadline passed, keep it
+                return True
+            self.shed_requests += 1
+            return False
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Handed a slot as the request was cancelled (its client went away), pass the slot on
+                self.release_async()
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            self.queued = len(self._waiters)
+
+    def release_async(self):
+        """Hand the slot to the oldest waiter still queued, or free it"""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self.queued = len(self._waiters)
+                return
+        self.queued = 0
+        self.in_flight -= 1
+
+    def open_connection(self):
+        if self.connections >= self.max_connections:
+            self.rejected_connections += 1
+            return False
+        self.connections += 1
+        return True
+
+    def close_connection(self):
+        self.connections -= 1
@@ -0,0 +1,80 @@
+import hashlib
+import hmac
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+SCHEME = 'pbkdf2_sha256'
+DEFAULT_ITERATIONS = 200000
+
+
+# The functions below run inside the worker processes, keep them at module level so they pickle
+
+def derive(password, salt, iterations):
+    """PBKDF2-HMAC-SHA256 of the password, hex encoded"""
+    return hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), iterations).hex()
+
+
+def make_hash(password, iterations):
+    """
+    Hash a password with a fresh salt
+
+    :return: (salt, stored hash in the form 'pbkdf2_sha256$<iterations>$<hex digest>')
+    """
+    salt = os.urandom(16).hex()
+    return salt, f"{SCHEME}${iterations}${derive(password, salt, iterations)}"
+
+
+def check_hash(password, salt, stored_hash):
+    """
+    Verify a password against a stored hash
+
+    Hashes without a scheme prefix use the original format, a single salted SHA-256: sha256(password + salt).
+
+    :return: (matches, iterations of the stored hash, 0 for the original format)
+    """
+    if '$' not in stored_hash:
+        legacy = hashlib.sha256((password + salt).encode()).hexdigest()
+        return hmac.compare_digest(legacy, stored_hash), 0
+
+    scheme, iterations, digest = stored_hash.split('$', 2)
+    if scheme != SCHEME:
+        return False, 0
+    iterations = int(iterations)
+    return hmac.compare_digest(derive(password, salt, iterations), digest), iterations
+
+
+class PasswordHasher:
+    """
+    Password hashing and verification on a dedicated process pool
+
+    The KDF is CPU bound, running it in worker processes keeps it off the GIL so
+    connection threads and the event loop keep serving other requests meanwhile.
+    """
+
+    def __init__(self, iterations=DEFAULT_ITERATIONS, workers=None):
+        """
+        :param iterations: PBKDF2 cost for new hashes, stored hashes with a different cost are upgraded on login
+        :param workers: worker processes, defaults to the CPU count
+        """
+        self.iterations = iterations
+        # spawn, not fork: the server already has threads running when the pool starts
+        self._pool = ProcessPoolExecutor(max_workers=workers or os.cpu_count(),
+                                         mp_context=multiprocessing.get_context('spawn'))
+
+    def hash(self, password):
+        """
+        :return: (salt, stored hash) for a new password
+        """
+        return self._pool.submit(make_hash, password, self.iterations).result()
+
+    def verify(self, password, salt, stored_hash):
+        """
+        :return: (matches, needs_rehash) where needs_rehash means the stored hash is the
+                 original SHA-256 format or uses a different cost than configured
+        """
+        matches, iterations = self._pool.submit(check_hash, password, salt, stored_hash).result()
+        return matches, matches and iterations != self.iterations
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,176 @@
+import hashlib
+import os
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import Future
+from io import BytesIO
+from Database import ConnectionPool
+
+# What the client displays covers at, they are resized once here instead of on every client
+COVER_SIZE = (200, 200)
+COVER_QUALITY = 85
+MAX_SOURCE_SIZE = 20 * 1024 * 1024
+COVER_SCHEMES = ('http', 'https')
+
+
+class HttpOnlyRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Follows redirects to http(s) URLs only, urllib would also follow them to ftp"""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if urllib.parse.urlsplit(newurl).scheme not in COVER_SCHEMES:
+            raise urllib.error.HTTPError(newurl, code, "redirect to a non-http(s) URL", headers, fp)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+_opener = urllib.request.build_opener(HttpOnlyRedirectHandler)
+
+
+def download(url, timeout=10.0):
+    """
+    :return: the bytes at url, at most MAX_SOURCE_SIZE of them
+    :raise ValueError: not an http(s) URL, the server must not read local files or other schemes for a client
+    """
+    if urllib.parse.urlsplit(url).scheme not in COVER_SCHEMES:
+        raise ValueError(f"cover URL must be http or https, got '{url}'")
+    with _opener.open(url, timeout=timeout) as response:
+        length = response.headers.get('Content-Length')
+        if length and length.isdigit() and int(length) > MAX_SOURCE_SIZE:
+            raise ValueError(f"cover is larger than {MAX_SOURCE_SIZE} bytes")
+        data = response.read(MAX_SOURCE_SIZE + 1)
+    if len(data) > MAX_SOURCE_SIZE:
+        raise ValueError(f"cover is larger than {MAX_SOURCE_SIZE} bytes")
+    return data
+
+
+def make_thumbnail(data, size=COVER_SIZE, quality=COVER_QUALITY):
+    """:return: the image in data resized to size and encoded as JPEG"""
+    # Imported here so the server runs without Pillow, only cover requests need it
+    from PIL import Image
+    with Image.open(BytesIO(data)) as image:
+        thumbnail = image.convert('RGB').resize(size)
+    output = BytesIO()
+    thumbnail.save(output, 'JPEG', quality=quality, optimize=True)
+    return output.getvalue()
+
+
+class CoverStore:
+    """
+    Cover thumbnails, made once per cover image and served to every client
+
+    A game's cover URL comes from the metadata cache. The thumbnail made from it is saved in
+    `directory` under the hash of its content, which doubles as its ETag: a client that
+    sends the ETag of the thumbnail it has gets a not-modified answer instead of the image.
+    The covers table maps source URLs to ETags, so titles sharing an image share a thumbnail
+    and a cover RAWG replaces gets a new ETag once the metadata is refreshed.
+    """
+
+    def __init__(self, metadata, directory='covers', db_path='orderly_users.db', pool=None, writer=None,
+                 fetch=download):
+        """
+        :param metadata: GameMetadata.MetadataService the cover URLs are looked up in
+        :param fetch: function(url) -> image bytes
+        """
+        self.metadata = metadata
+        self.directory = directory
+        self.db_path = db_path
+        self.pool = pool or ConnectionPool(db_path)
+        # Optional GroupCommitWriter, without one each new cover commits on its own
+        self.writer = writer
+        self.fetch = fetch
+
+        self._lock = threading.Lock()
+        self._inflight = {}  # {source URL: Future} of thumbnails being made
+
+        # Counters for tuning
+        self.hits = 0
+        self.made = 0
+        self.coalesced = 0
+
+    def path(self, etag):
+        return os.path.join(self.directory, f"{etag}.jpg")
+
+    def _load(self, url):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT etag FROM covers WHERE source_url = ?", (url,))
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def get(self, title):
+        """
+        ETag of a game's cover thumbnail, made now if it doesn't exist yet
+
+        :return: the ETag, the thumbnail is at path(etag), None when the game has no cover
+        :raise Exception: the metadata, the image or Pillow couldn't be had
+        """
+        metadata, _ = self.metadata.get(title)
+        url = metadata.get('cover_url')
+        if not url:
+            return None
+
+        etag = self._load(url)
+        if etag and os.path.exists(self.path(etag)):
+            self.hits += 1
+            return etag
+
+        with self._lock:
+            future = self._inflight.get(url)
+            leader = future is None
+            if leader:
+                future = self._inflight[url] = Future()
+        if not leader:
+            self.coalesced += 1
+            return future.result()
+
+        try:
+            etag = self._make(url)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(etag)
+        finally:
+            with self._lock:
+                del self._inflight[url]
+        return etag
+
+    def _make(self, url):
+        thumbnail = make_thumbnail(self.fetch(url))
+        etag = hashlib.sha256(thumbnail).hexdigest()[:32]
+        path = self.path(etag)
+        if not os.path.exists(path):
+            os.makedirs(self.directory, exist_ok=True)
+            # Written aside and renamed, a reader never sees half a thumbnail
+            partial = f"{path}.{threading.get_ident()}.tmp"
+            with open(partial, 'wb') as f:
+                f.write(thumbnail)
+            os.replace(partial, path)
+
+        def save(cursor):
+            cursor.execute('''
+                INSERT OR REPLACE INTO covers (source_url, etag, created)
+                VALUES (?, ?, ?)
+            ''', (url, etag, int(time.time())))
+
+        if self.writer:
+            self.writer.execute(save)
+        else:
+            with self.pool.connection() as conn:
+                save(conn.cursor())
+        self.made += 1
+        return etag
+
+    def read(self, etag):
+        with open(self.path(etag), 'rb') as f:
+            return f.read()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'made': self.made,
+            'coalesced': self.coalesced,
+            'in_flight': len(self._inflight)
+        }
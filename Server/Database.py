@@ -0,0 +1,104 @@
+import sqlite3
+import threading
+import time
+from Metrics import add_db_time
+
+# Applied to every pooled connection. WAL lets readers run alongside the writer and
+# synchronous=NORMAL is durable under WAL except for the last commits on power loss.
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA mmap_size = 134217728",
+)
+
+
+def open_connection(db_path, **kwargs):
+    """Open a connection with the standard pragmas applied, kwargs go to sqlite3.connect()"""
+    conn = sqlite3.connect(db_path, **kwargs)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose `with conn:` blocks count as DB time of the request running on the thread"""
+
+    def __enter__(self):
+        self._entered = time.perf_counter()
+        return super().__enter__()
+
+    def __exit__(self, *exc_info):
+        try:
+            return super().__exit__(*exc_info)
+        finally:
+            add_db_time(time.perf_counter() - self._entered)
+
+
+class ConnectionPool:
+    """
+    One long-lived SQLite connection per worker thread
+
+    Handlers keep using the `with pool.connection() as conn:` form they used with
+    sqlite3.connect(): the context manager commits or rolls back but leaves the
+    connection open, so the file open, schema parse and pragmas are paid once per worker.
+    """
+
+    def __init__(self, db_path='orderly_users.db', cached_statements=256):
+        """
+        :param db_path: SQLite database file
+        :param cached_statements: prepared statements kept per connection, keyed by SQL text
+        """
+        self.db_path = db_path
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = {}  # {thread ident: (thread, connection)}
+
+    def _connect(self):
+        # Each connection is only used by the thread that opened it, the pool may close it after that thread exits
+        return open_connection(self.db_path,
+                               factory=TimedConnection,
+                               cached_statements=self.cached_statements,
+                               check_same_thread=False)
+
+    def connection(self):
+        """Return the calling thread's connection, opening it on first use"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._lock:
+                self._prune()
+                self._connections[threading.get_ident()] = (threading.current_thread(), conn)
+        return conn
+
+    def release(self):
+        """Close the calling thread's connection, used by threads that are about to exit"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.conn = None
+            with self._lock:
+                self._connections.pop(threading.get_ident(), None)
+            conn.close()
+
+    def _prune(self):
+        """Close connections left behind by threads that exited without release()"""
+        for ident, (thread, conn) in list(self._connections.items()):
+            if not thread.is_alive():
+                del self._connections[ident]
+                conn.close()
+
+    def size(self):
+        """Number of open connections"""
+        with self._lock:
+            return len(self._connections)
+
+    def close_all(self):
+        """Close every pooled connection, used on shutdown"""
+        with self._lock:
+            for _, conn in self._connections.values():
+                conn.close()
+            self._connections.clear()
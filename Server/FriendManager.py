@@ -1,14 +1,350 @@
+import logging
 import sqlite3
+import sys
+import threading
+from Database import ConnectionPool
+
+log = logging.getLogger('orderly.friends')
+
+SUGGESTIONS = 10
+MAX_SUGGESTIONS = 50  # ranked and cached per user, requests get a prefix of them
+
+
+def popcount(bits):
+    return bin(bits).count('1')
+
+
+def at_least(planes, value, universe):
+    """
+    Members of universe whose bit-sliced count is >= value
+
+    :param planes: planes[i] has a member's bit set when bit i of its count is 1
+    """
+    if value >> len(planes):
+        return 0
+    greater = 0
+    equal = universe
+    for i in reversed(range(len(planes))):
+        if value >> i & 1:
+            equal &= planes[i]
+        else:
+            greater |= equal & planes[i]
+            equal &= ~planes[i]
+    return greater | equal
+
+
+def lowest_slots(bits, limit):
+    """Positions of the lowest `limit` set bits"""
+    slots = []
+    while bits and len(slots) < limit:
+        low = bits & -bits
+        slots.append(low.bit_length() - 1)
+        bits ^= low
+    return slots
+
+
+def rank_by_overlap(masks, exclude, limit):
+    """
+    The slots set in the most of the given bitsets
+
+    The masks are summed bit-sliced, a whole bitset per carry step instead of one user at a
+    time, then the cut-off count of the top `limit` is found a bit at a time from the top.
+    Every step is a big-int operation over all slots at once, so the cost grows with the
+    number of masks and barely with their density.
+
+    :param masks: one int bitset per friend, bit s set when that friend has user slot s as a friend
+    :param exclude: bitset of slots never returned
+    :return: [(slot, count)] highest count first
+    """
+    planes = []  # planes[i] holds bit i of every slot's count
+    for mask in masks:
+        carry = mask
+        i = 0
+        while carry:
+            if i == len(planes):
+                planes.append(carry)
+                break
+            plane = planes[i]
+            planes[i] = plane ^ carry
+            carry &= plane
+            i += 1
+
+    candidates = 0
+    for plane in planes:
+        candidates |= plane
+    candidates &= ~exclude
+
+    # Highest count that at least `limit` candidates reach, 0 when there are fewer candidates
+    threshold = 0
+    for bit in reversed(range(len(planes))):
+        trial = threshold | (1 << bit)
+        if popcount(at_least(planes, trial, candidates)) >= limit:
+            threshold = trial
+    above = at_least(planes, threshold + 1, candidates)
+    ties = at_least(planes, threshold, candidates) & ~above if threshold else 0
+    slots = lowest_slots(above, limit) + lowest_slots(ties, limit - popcount(above))
+
+    ranked = [(slot, sum((plane >> slot & 1) << i for i, plane in enumerate(planes))) for slot in slots]
+    ranked.sort(key=lambda item: -item[1])
+    return ranked
+
+
+class FriendGraph:
+    """
+    In-memory adjacency index of the friends table
+
+    Every user ID is interned once so the adjacency sets and the username map share
+    the same string objects. Reads are O(1) (count, membership) or O(degree) (listing).
+
+    Each user also gets a dense slot number and each friend list a bitset over the slots,
+    which friend suggestions sum without visiting friends of friends one by one. A bitset
+    takes a bit per slot up to its highest friend, an eighth of the user count in bytes.
+    """
+
+    def __init__(self):
+        self._adjacency = {}  # {user_id: set of friend_ids}
+        self._reverse = {}  # {friend_id: set of user_ids that have them as a friend}
+        self._usernames = {}  # {user_id: username}, only for users that appear as someone's friend
+        self._slots = {}  # {user_id: slot}
+        self._ids = []  # [user_id] by slot
+        self._bits = {}  # {user_id: int bitset of the slots of their friends}
+        self._suggestions = {}  # {user_id: ranked suggestions}, dropped when they may have changed
+        self._version = 0  # bumped on every change, a ranking computed across one isn't cached
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _load_edges(conn):
+        """Every friends row, with the friend's username (None if the user row is missing)"""
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT f.user_id, f.friend_id, u.username
+            FROM friends f
+            LEFT JOIN users u ON u.id = f.friend_id
+        """)
+        return cursor.fetchall()
+
+    def load(self, conn):
+        """(Re)build the index from the database"""
+        adjacency = {}
+        reverse = {}
+        usernames = {}
+        for user_id, friend_id, username in self._load_edges(conn):
+            user_id = sys.intern(user_id)
+            friend_id = sys.intern(friend_id)
+            adjacency.setdefault(user_id, set()).add(friend_id)
+            reverse.setdefault(friend_id, set()).add(user_id)
+            if username is not None:
+                usernames[friend_id] = username
+
+        ids = list(adjacency.keys() | reverse.keys())
+        slots = {user_id: slot for slot, user_id in enumerate(ids)}
+
+        # Set bits in a byte array and convert once, OR-ing ints one bit at a time is quadratic
+        bits = {}
+        for user_id, friends in adjacency.items():
+            buffer = bytearray(max(slots[friend_id] for friend_id in friends) // 8 + 1)
+            for friend_id in friends:
+                slot = slots[friend_id]
+                buffer[slot >> 3] |= 1 << (slot & 7)
+            bits[user_id] = int.from_bytes(buffer, 'little')
+
+        with self._lock:
+            self._adjacency = adjacency
+            self._reverse = reverse
+            self._usernames = usernames
+            self._slots = slots
+            self._ids = ids
+            self._bits = bits
+            self._suggestions = {}
+            self._version += 1
+
+    def _slot(self, user_id):
+        """Slot of a user, assigned on first sight, called with self._lock held"""
+        slot = self._slots.get(user_id)
+        if slot is None:
+            slot = self._slots[user_id] = len(self._ids)
+            self._ids.append(user_id)
+        return slot
+
+    def _changed(self, user_id):
+        """
+        Drop the cached suggestions an edge from user_id affects, called with self._lock held
+
+        Their own list changed, and so did the mutual counts seen by everyone who has them as a friend.
+        """
+        self._version += 1
+        self._suggestions.pop(user_id, None)
+        for follower_id in self._reverse.get(user_id, ()):
+            self._suggestions.pop(follower_id, None)
+
+    def add(self, user_id, friend_id, friend_username):
+        user_id = sys.intern(user_id)
+        friend_id = sys.intern(friend_id)
+        with self._lock:
+            self._adjacency.setdefault(user_id, set()).add(friend_id)
+            self._reverse.setdefault(friend_id, set()).add(user_id)
+            self._usernames[friend_id] = friend_username
+            self._slot(user_id)
+            self._bits[user_id] = self._bits.get(user_id, 0) | (1 << self._slot(friend_id))
+            self._changed(user_id)
+
+    def remove(self, user_id, friend_id):
+        with self._lock:
+            for index, key, value in ((self._adjacency, user_id, friend_id), (self._reverse, friend_id, user_id)):
+                members = index.get(key)
+                if members is not None:
+                    members.discard(value)
+                    if not members:
+                        del index[key]
+            slot = self._slots.get(friend_id)
+            if slot is not None and user_id in self._bits:
+                bits = self._bits[user_id] & ~(1 << slot)
+                if bits:
+                    self._bits[user_id] = bits
+                else:
+                    del self._bits[user_id]
+            self._changed(user_id)
+
+    def count(self, user_id):
+        return len(self._adjacency.get(user_id, ()))
+
+    def contains(self, user_id, friend_id):
+        return friend_id in self._adjacency.get(user_id, ())
+
+    def friends(self, user_id):
+        """Same shape as FriendManager.get_friends, friends without a user row are skipped like the SQL join does"""
+        with self._lock:
+            friend_ids = list(self._adjacency.get(user_id, ()))
+            usernames = self._usernames
+            return [{"id": friend_id, "username": usernames[friend_id]}
+                    for friend_id in friend_ids if friend_id in usernames]
+
+    def follower_ids(self, user_id):
+        """Snapshot of the users that have user_id in their friend list"""
+        with self._lock:
+            return set(self._reverse.get(user_id, ()))
+
+    def friend_ids(self, user_id):
+        """Snapshot of a user's friend IDs"""
+        with self._lock:
+            return set(self._adjacency.get(user_id, ()))
+
+    def suggestions(self, user_id, limit=SUGGESTIONS):
+        """
+        Friends of friends that aren't friends yet, most mutual friends first
+
+        :return: [{'id', 'username', 'mutual_friends'}], mutual_friends being how many of the
+            user's friends have them as a friend
+        """
+        with self._lock:
+            cached = self._suggestions.get(user_id)
+            if cached is not None:
+                return [dict(suggestion) for suggestion in cached[:limit]]
+            version = self._version
+            bits = self._bits
+            masks = [bits[friend_id] for friend_id in self._adjacency.get(user_id, ()) if friend_id in bits]
+            exclude = bits.get(user_id, 0)
+            if user_id in self._slots:
+                exclude |= 1 << self._slots[user_id]
+
+        # Ints are immutable, the ranking runs on the snapshot without holding the lock
+        ranked = rank_by_overlap(masks, exclude, MAX_SUGGESTIONS)
+
+        with self._lock:
+            ids = self._ids
+            usernames = self._usernames
+            suggestions = [{"id": ids[slot], "username": usernames[ids[slot]], "mutual_friends": count}
+                           for slot, count in ranked if ids[slot] in usernames]
+            if self._version == version:
+                self._suggestions[user_id] = suggestions
+        return [dict(suggestion) for suggestion in suggestions[:limit]]
+
+    def check_consistency(self, conn):
+        """
+        Compare the index with the friends table
+
+        :return: {'missing': edges only in the table, 'extra': edges only in the index}
+        """
+        table_edges = {(user_id, friend_id) for user_id, friend_id, _ in self._load_edges(conn)}
+        with self._lock:
+            index_edges = {(user_id, friend_id)
+                           for user_id, friends in self._adjacency.items() for friend_id in friends}
+        return {
+            'missing': sorted(table_edges - index_edges),
+            'extra': sorted(index_edges - table_edges)
+        }
 
 
 class FriendManager:
-    def __init__(self, db_path='orderly_users.db'):
+    def __init__(self, db_path='orderly_users.db', pool=None, writer=None, index=False):
         self.db_path = db_path
+        # Share the server's pool when given one so each worker keeps a single connection
+        self.pool = pool or ConnectionPool(db_path)
+        # Optional GroupCommitWriter, mutations share its batched commits instead of committing one by one
+        self.writer = writer
         self.static = None
 
+        # Optional in-memory index serving the read methods, kept up to date write-through
+        self.graph = None
+        if index:
+            self.graph = FriendGraph()
+            with self.pool.connection() as conn:
+                self.graph.load(conn)
+
+    def check_index(self, repair=False):
+        """
+        Compare the in-memory index with the friends table, see FriendGraph.check_consistency
+
+        Runs through the writer, so no change of this process is half applied while the table
+        is read. Changes of other worker processes reach the index a little after they commit.
+
+        :param repair: set the differing edges of the index to what the table holds
+        """
+        if self.graph is None:
+            return {'missing': [], 'extra': []}
+
+        def check(cursor):
+            problems = self.graph.check_consistency(cursor.connection)
+            if repair:
+                for user_id, friend_id in problems['missing'] + problems['extra']:
+                    self._reload_edge(cursor, user_id, friend_id)
+            return problems
+
+        return self._write(check)
+
+    def _reload_edge(self, cursor, user_id, friend_id):
+        """Set an edge of the index to what the friends table holds"""
+        cursor.execute("""
+            SELECT u.username FROM friends f JOIN users u ON u.id = f.friend_id
+            WHERE f.user_id = ? AND f.friend_id = ?
+        """, (user_id, friend_id))
+        row = cursor.fetchone()
+        if row:
+            self.graph.add(user_id, friend_id, row[0])
+        else:
+            self.graph.remove(user_id, friend_id)
+
+    def _repair_edge(self, user_id, friend_id):
+        """After a failed write, whose index change may have been applied when the transaction failed"""
+        if self.graph is None:
+            return
+        try:
+            self._write(lambda cursor: self._reload_edge(cursor, user_id, friend_id))
+        except sqlite3.Error as e:
+            log.error("Friend index may be out of date for %s -> %s: %s", user_id, friend_id, e)
+
+    def _write(self, operation):
+        """Run a mutation, operation(cursor), through the writer or in its own transaction"""
+        if self.writer:
+            return self.writer.execute(operation)
+        with self.pool.connection() as conn:
+            return operation(conn.cursor())
+
     def get_friends_count(self, user_id):
         """Get the total number of friends a user has."""
-        with sqlite3.connect(self.db_path) as conn:
+        if self.graph is not None:
+            return self.graph.count(user_id)
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
                 SELECT COUNT(*)
@@ -19,7 +355,9 @@ class FriendManager:
 
     def get_friends(self, user_id):
         """Get a list of friends for a user"""
-        with sqlite3.connect(self.db_path) as conn:
+        if self.graph is not None:
+            return self.graph.friends(user_id)
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
                 SELECT u.id, u.username 
@@ -29,49 +367,114 @@ class FriendManager:
             """, (user_id,))
             return [{"id": row[0], "username": row[1]} for row in cursor.fetchall()]
 
+    def get_followers(self, user_id):
+        """Get the IDs of the users that have this user in their friend list"""
+        if self.graph is not None:
+            return list(self.graph.follower_ids(user_id))
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT user_id
+                FROM friends
+                WHERE friend_id = ?
+            """, (user_id,))
+            return [row[0] for row in cursor.fetchall()]
+
+    def get_suggestions(self, user_id, limit=SUGGESTIONS):
+        """
+        Users the user's friends have as friends, ranked by how many of them do
+
+        Served and cached by the index when there is one, otherwise counted by SQLite.
+        """
+        limit = max(1, min(int(limit), MAX_SUGGESTIONS))
+        if self.graph is not None:
+            return self.graph.suggestions(user_id, limit)
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT u.id, u.username, COUNT(*) AS mutual
+                FROM friends f
+                JOIN friends fof ON fof.user_id = f.friend_id
+                JOIN users u ON u.id = fof.friend_id
+                WHERE f.user_id = ? AND fof.friend_id != ?
+                  AND NOT EXISTS (SELECT 1 FROM friends mine WHERE mine.user_id = ? AND mine.friend_id = fof.friend_id)
+                GROUP BY u.id
+                ORDER BY mutual DESC
+                LIMIT ?
+            """, (user_id, user_id, user_id, limit))
+            return [{"id": row[0], "username": row[1], "mutual_friends": row[2]} for row in cursor.fetchall()]
+
     def add_friend(self, user_id, friend_id):
         """Add a friend to user's friend list"""
+        def add(cursor):
+            # Check if friend exists
+            cursor.execute("SELECT id, username FROM users WHERE id = ?", (friend_id,))
+            friend = cursor.fetchone()
+            if not friend:
+                return False, "User not found"
+
+            # Check if already friends
+            cursor.execute("""
+                SELECT 1 FROM friends 
+                WHERE user_id = ? AND friend_id = ?
+            """, (user_id, friend_id))
+            if cursor.fetchone():
+                return False, "Already friends"
+
+            # Add friendship
+            cursor.execute("""
+                INSERT INTO friends (user_id, friend_id) 
+                VALUES (?, ?)
+            """, (user_id, friend_id))
+            # Applied with the write, so the index sees the changes of this process in commit order
+            if self.graph is not None:
+                self.graph.add(user_id, friend_id, friend[1])
+            return True, "Friend added successfully"
+
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                # Check if friend exists
-                cursor.execute("SELECT id FROM users WHERE id = ?", (friend_id,))
-                if not cursor.fetchone():
-                    return False, "User not found"
-
-                # Check if already friends
-                cursor.execute("""
-                    SELECT 1 FROM friends 
-                    WHERE user_id = ? AND friend_id = ?
-                """, (user_id, friend_id))
-                if cursor.fetchone():
-                    return False, "Already friends"
-
-                # Add friendship
-                cursor.execute("""
-                    INSERT INTO friends (user_id, friend_id) 
-                    VALUES (?, ?)
-                """, (user_id, friend_id))
-                return True, "Friend added successfully"
+            return self._write(add)
         except sqlite3.Error as e:
+            self._repair_edge(user_id, friend_id)
             return False, f"Database error: {str(e)}"
 
     def remove_friend(self, user_id, friend_id):
         """Remove a friend from user's friend list"""
+        def remove(cursor):
+            cursor.execute("""
+                DELETE FROM friends 
+                WHERE user_id = ? AND friend_id = ?
+            """, (user_id, friend_id))
+            if cursor.rowcount == 0:
+                return False, "Not in your friend list"
+            if self.graph is not None:
+                self.graph.remove(user_id, friend_id)
+            return True, "Friend removed successfully"
+
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    DELETE FROM friends 
-                    WHERE user_id = ? AND friend_id = ?
-                """, (user_id, friend_id))
-                return True, "Friend removed successfully"
+            return self._write(remove)
         except sqlite3.Error as e:
+            self._repair_edge(user_id, friend_id)
             return False, f"Database error: {str(e)}"
 
+    def apply_change(self, action, user_id, friend_id):
+        """Replay an add or remove committed by another worker process onto the in-memory index"""
+        if self.graph is None:
+            return
+        if action == 'remove':
+            self.graph.remove(user_id, friend_id)
+            return
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT username FROM users WHERE id = ?", (friend_id,))
+            friend = cursor.fetchone()
+        if friend:
+            self.graph.add(user_id, friend_id, friend[0])
+
     def are_friends(self, user_id, friend_id):
         """Check if two users are friends"""
-        with sqlite3.connect(self.db_path) as conn:
+        if self.graph is not None:
+            return self.graph.contains(user_id, friend_id)
+        with self.pool.connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
                 SELECT 1 FROM friends 
@@ -94,7 +497,7 @@ class FriendManager:
                 'message': 'Missing required parameters.'
             }
 
-        friend_manager = FriendManager()
+        friend_manager = self
 
         try:
             if action == 'get':
@@ -135,14 +538,22 @@ class FriendManager:
                     'message': message
                 }
 
+            elif action == 'suggestions':
+                suggestions = friend_manager.get_suggestions(user_id, request.get('limit', SUGGESTIONS))
+                return {
+                    'type': 'friendlist_response',
+                    'status': 'success',
+                    'suggestions': suggestions
+                }
+
             return {
                 'type': 'friendlist_response',
                 'status': 'failed',
-                'message': f"Invalid action '{action}'. Expected 'get', 'add', or 'remove'."
+                'message': f"Invalid action '{action}'. Expected 'get', 'add', 'remove', or 'suggestions'."
             }
 
         except Exception as e:
-            print(f"[!] Error in friend operation: {e}")
+            log.error("Error in friend operation: %s", e)
             return {
                 'type': 'friendlist_response',
                 'status': 'failed',
@@ -0,0 +1,198 @@
+import json
+import re
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import Future
+from Database import ConnectionPool
+
+RAWG_URL = 'https://api.rawg.io/api'
+# The key the client used to call RAWG with directly, override it with --rawg-key
+DEFAULT_RAWG_KEY = '74206afbba5d4287927acbdd696485f3'
+# Found games are refreshed monthly like the client cache used to, misses sooner in case RAWG adds them
+METADATA_TTL = 30 * 24 * 3600
+MISSING_TTL = 24 * 3600
+MAX_TITLE_LENGTH = 200
+
+
+def title_key(title):
+    """Cache key of a title, the same for differences in case and spacing"""
+    return ' '.join(title.lower().split())
+
+
+class RawgUpstream:
+    """Fetches metadata from the RAWG API, the same lookups GameMetadataRetriever makes"""
+
+    def __init__(self, api_key, base_url=RAWG_URL, timeout=10.0):
+        """
+        :param api_key: RAWG API key
+        :param base_url: API root, a local stub server can stand in for RAWG
+        :param timeout: seconds per HTTP request
+        """
+        self.api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def _get(self, path, params=None):
+        query = urllib.parse.urlencode(dict(params or {}, key=self.api_key))
+        with urllib.request.urlopen(f"{self.base_url}{path}?{query}", timeout=self.timeout) as response:
+            return json.load(response)
+
+    def fetch(self, title):
+        """
+        :return: metadata dict, {'name': title, 'found': False} for a game RAWG doesn't know
+        :raise OSError, ValueError: RAWG couldn't be reached or answered garbage
+        """
+        results = self._get('/games', {'search': title, 'page_size': 1}).get('results')
+        if not results and re.search(r'\d+', title):
+            # Scanned folder names often carry version numbers RAWG doesn't
+            results = self._get('/games', {'search': re.sub(r'\d+', '', title).strip(), 'page_size': 1}).get('results')
+        if not results:
+            return {'name': title, 'found': False}
+
+        game = results[0]
+        if not isinstance(game.get('id'), (str, int)):
+            raise ValueError(f"Invalid game ID: {game.get('id')}")
+        details = self._get(f"/games/{game['id']}")
+        return {
+            'name': game.get('name', title),
+            'found': True,
+            'description': details.get('description_raw', 'No description available'),
+            'genres': [genre['name'] for genre in game.get('genres') or []],
+            'platforms': [platform['platform']['name'] for platform in game.get('platforms') or []],
+            'release_date': (game.get('released') or 'Unknown')[:4],
+            'cover_url': game.get('background_image') or '',
+            'rating': game.get('rating', 0),
+            'metacritic': game.get('metacritic') or 'N/A',
+            'website': details.get('website', '')
+        }
+
+
+class FileUpstream:
+    """Serves metadata from a JSON file of {title: metadata}, for running without RAWG"""
+
+    def __init__(self, path):
+        with open(path) as f:
+            self.games = {title_key(title): metadata for title, metadata in json.load(f).items()}
+
+    def fetch(self, title):
+        metadata = self.games.get(title_key(title))
+        if metadata is None:
+            return {'name': title, 'found': False}
+        return dict(metadata, found=True)
+
+
+class MetadataService:
+    """
+    Game metadata shared by every client, cached in the game_metadata table
+
+    Cache hits are a primary key read, shared by all worker processes and kept across
+    restarts. Concurrent misses for the same title within a process wait for the one
+    upstream fetch already running (single flight), so a title popular at release costs one
+    API call per worker rather than one per client. When the upstream fails an expired entry
+    is served rather than nothing.
+    """
+
+    def __init__(self, upstream, db_path='orderly_users.db', pool=None, writer=None,
+                 ttl=METADATA_TTL, missing_ttl=MISSING_TTL):
+        """
+        :param upstream: object with fetch(title) -> metadata dict, e.g. RawgUpstream or FileUpstream
+        """
+        self.upstream = upstream
+        self.db_path = db_path
+        self.pool = pool or ConnectionPool(db_path)
+        # Optional GroupCommitWriter, without one each fetched entry commits on its own
+        self.writer = writer
+        self.ttl = ttl
+        self.missing_ttl = missing_ttl
+
+        self._lock = threading.Lock()
+        self._inflight = {}  # {title key: Future} of fetches running or not committed yet
+
+        # Counters for tuning
+        self.hits = 0
+        self.fetches = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    def _load(self, key):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT metadata, fetched FROM game_metadata WHERE title_key = ?", (key,))
+            row = cursor.fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def _fresh(self, metadata, fetched):
+        return time.time() - fetched < (self.ttl if metadata.get('found') else self.missing_ttl)
+
+    def get(self, title):
+        """
+        Metadata of a game, fetched upstream only when it isn't cached or has expired
+
+        :return: (metadata, True if it came from the cache or another request's fetch)
+        :raise Exception: whatever the upstream raised, when there is no cached entry to fall back on
+        """
+        key = title_key(title)
+        cached = self._load(key)
+        if cached and self._fresh(*cached):
+            self.hits += 1
+            return cached[0], True
+
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+        if not leader:
+            self.coalesced += 1
+            try:
+                return future.result(), True
+            except Exception:
+                if cached:
+                    return cached[0], True
+                raise
+
+        self.fetches += 1
+        try:
+            metadata = self.upstream.fetch(title)
+        except Exception as e:
+            self.errors += 1
+            self._release(key)
+            future.set_exception(e)
+            if cached:
+                return cached[0], True
+            raise
+        future.set_result(metadata)
+        self._store(key, metadata)
+        return metadata, False
+
+    def _store(self, key, metadata):
+        """Save a fetched entry, later misses keep joining the finished fetch until it is committed"""
+        def save(cursor):
+            cursor.execute('''
+                INSERT OR REPLACE INTO game_metadata (title_key, metadata, fetched)
+                VALUES (?, ?, ?)
+            ''', (key, json.dumps(metadata), int(time.time())))
+
+        if self.writer:
+            self.writer.submit(save).add_done_callback(lambda done: self._release(key))
+            return
+        try:
+            with self.pool.connection() as conn:
+                save(conn.cursor())
+        finally:
+            self._release(key)
+
+    def _release(self, key):
+        with self._lock:
+            self._inflight.pop(key, None)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'fetches': self.fetches,
+            'coalesced': self.coalesced,
+            'errors': self.errors,
+            'in_flight': len(self._inflight)
+        }
@@ -0,0 +1,69 @@
+import hashlib
+import json
+
+# Game library sync: the client uploads its scanned library once, then only the games that
+# were added, changed or removed since the version the server has. The client (Library.py
+# next to main.py) and the server (Server/Library.py) carry identical copies of this module,
+# keep the two in sync.
+
+# Fields shared with the server, install paths stay on the client
+GAME_FIELDS = ('name', 'exe_name', 'type')
+MAX_FIELD_LENGTH = 256
+MAX_GAMES = 10000
+# A version is the sum of the entries' hashes modulo 2**128, so it is independent of order and
+# adding or removing a game updates it in O(1)
+VERSION_BITS = 128
+EMPTY_VERSION = '0' * (VERSION_BITS // 4)
+
+
+def library_entry(game):
+    """The synced part of a scanned game"""
+    return {field: game.get(field) for field in GAME_FIELDS}
+
+
+def library_from_games(games):
+    """
+    :param games: GameScanner.scan() output or a list of entries
+    :return: {name: entry}, a game found twice is kept once
+    """
+    return {game['name']: library_entry(game) for game in games}
+
+
+def entry_hash(entry):
+    body = json.dumps([entry.get(field) for field in GAME_FIELDS], separators=(',', ':'))
+    return int.from_bytes(hashlib.sha256(body.encode('utf-8')).digest()[:VERSION_BITS // 8], 'big')
+
+
+def update_version(version, added=(), removed=()):
+    """Version of a library after adding and removing entries, a changed game is removed and added"""
+    total = int(version, 16)
+    for entry in added:
+        total += entry_hash(entry)
+    for entry in removed:
+        total -= entry_hash(entry)
+    return f"{total % (1 << VERSION_BITS):0{VERSION_BITS // 4}x}"
+
+
+def library_version(library):
+    """:param library: {name: entry}"""
+    return update_version(EMPTY_VERSION, added=library.values())
+
+
+def diff_library(old, new):
+    """
+    :param old: {name: entry} the server has
+    :param new: {name: entry} scanned now
+    :return: (added entries, changed entries, removed names)
+    """
+    added = [entry for name, entry in new.items() if name not in old]
+    changed = [entry for name, entry in new.items() if name in old and old[name] != entry]
+    removed = [name for name in old if name not in new]
+    return added, changed, removed
+
+
+def valid_entry(entry):
+    """An entry as the sender claims it, checked before it is stored"""
+    return (isinstance(entry, dict) and isinstance(entry.get('name'), str) and entry['name']
+            and all(entry.get(field) is None or (isinstance(entry.get(field), str)
+                                                 and len(entry[field]) <= MAX_FIELD_LENGTH)
+                    for field in GAME_FIELDS))
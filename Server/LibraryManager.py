@@ -0,0 +1,145 @@
+import time
+from Database import ConnectionPool
+from Library import (EMPTY_VERSION, MAX_GAMES, GAME_FIELDS, library_entry, library_version, update_version,
+                     valid_entry)
+
+
+class LibraryConflict(Exception):
+    """The client's diff doesn't apply to the stored library, it has to send the whole library"""
+
+    def __init__(self, version):
+        super().__init__(f"stored library is at version {version}")
+        self.version = version
+
+
+class LibraryManager:
+    """
+    Game libraries synced from the clients, stored in libraries and library_games
+
+    A sync names the version it was diffed against. When that is the stored version only the
+    added, changed and removed games are written and the new version is derived from the old
+    one, so a sync costs as much as its diff and an unchanged library costs nothing but the
+    version check. The client's claimed new version is checked against the derived one, a
+    library can't drift from what the client has.
+    """
+
+    def __init__(self, db_path='orderly_users.db', pool=None, writer=None):
+        self.db_path = db_path
+        self.pool = pool or ConnectionPool(db_path)
+        # Optional GroupCommitWriter, without one each sync commits on its own
+        self.writer = writer
+        self.static = None
+
+    def _write(self, operation):
+        if self.writer:
+            return self.writer.execute(operation)
+        with self.pool.connection() as conn:
+            return operation(conn.cursor())
+
+    def sync(self, user_id, base, version, added=(), changed=(), removed=()):
+        """
+        Apply a client's library diff
+
+        :param base: version the diff was made against, None to replace the library with `added`
+        :param version: version of the client's library after the diff
+        :return: the stored version, equal to `version`
+        :raise LibraryConflict: the stored library isn't at `base` or the diff doesn't lead to `version`
+        :raise ValueError: malformed games, or a game named more than once in a diff
+        """
+        if not all(valid_entry(entry) for entry in list(added) + list(changed)):
+            raise ValueError("invalid game entry")
+        if not all(isinstance(name, str) for name in removed):
+            raise ValueError("invalid removed game")
+        added = [library_entry(entry) for entry in added]
+        changed = [library_entry(entry) for entry in changed]
+        if base is not None:
+            # The version and game count are updated per entry, a name the diff holds twice would count twice
+            names = [entry['name'] for entry in added + changed] + list(removed)
+            if len(set(names)) != len(names):
+                raise ValueError("a game appears more than once in the diff")
+
+        # Nothing changed on the client: a read, without queueing behind the writer
+        if base is not None and base == version and not (added or changed or removed):
+            current, _ = self.get_version(user_id)
+            if current != base:
+                raise LibraryConflict(current or EMPTY_VERSION)
+            return current
+
+        def apply(cursor):
+            cursor.execute("SELECT version, game_count FROM libraries WHERE user_id = ?", (user_id,))
+            row = cursor.fetchone()
+            current, count = row if row else (EMPTY_VERSION, 0)
+
+            if base is None:
+                library = {entry['name']: entry for entry in added}
+                if len(library) > MAX_GAMES:
+                    raise ValueError(f"more than {MAX_GAMES} games")
+                new_version = library_version(library)
+                if new_version != version:
+                    raise LibraryConflict(current)
+                cursor.execute("DELETE FROM library_games WHERE user_id = ?", (user_id,))
+                self._insert(cursor, user_id, library.values())
+                count = len(library)
+            elif base != current:
+                raise LibraryConflict(current)
+            else:
+                # Entries the diff replaces, each looked up by primary key
+                old = []
+                for name in [entry['name'] for entry in changed] + list(removed):
+                    cursor.execute("SELECT exe_name, type FROM library_games WHERE user_id = ? AND name = ?",
+                                   (user_id, name))
+                    row = cursor.fetchone()
+                    if row is None:
+                        raise LibraryConflict(current)
+                    old.append(dict(zip(GAME_FIELDS, (name,) + row)))
+                for entry in added:
+                    cursor.execute("SELECT 1 FROM library_games WHERE user_id = ? AND name = ?",
+                                   (user_id, entry['name']))
+                    if cursor.fetchone():
+                        raise LibraryConflict(current)
+
+                new_version = update_version(current, added=added + changed, removed=old)
+                count += len(added) - len(removed)
+                if new_version != version:
+                    raise LibraryConflict(current)
+                if count > MAX_GAMES:
+                    raise ValueError(f"more than {MAX_GAMES} games")
+                cursor.executemany("DELETE FROM library_games WHERE user_id = ? AND name = ?",
+                                   [(user_id, name) for name in removed])
+                self._insert(cursor, user_id, added + changed)
+
+            cursor.execute('''
+                INSERT OR REPLACE INTO libraries (user_id, version, game_count, updated)
+                VALUES (?, ?, ?, ?)
+            ''', (user_id, version, count, int(time.time())))
+            return version
+
+        return self._write(apply)
+
+    @staticmethod
+    def _insert(cursor, user_id, entries):
+        cursor.executemany('''
+            INSERT OR REPLACE INTO library_games (user_id, name, exe_name, type)
+            VALUES (?, ?, ?, ?)
+        ''', [(user_id, entry['name'], entry['exe_name'], entry['type']) for entry in entries])
+
+    def get_version(self, user_id):
+        """:return: (version, game count), (None, 0) for a user that never synced"""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT version, game_count FROM libraries WHERE user_id = ?", (user_id,))
+            row = cursor.fetchone()
+        return (row[0], row[1]) if row else (None, 0)
+
+    def get_library(self, user_id):
+        """:return: (version, [entries] in name order), (None, []) for a user that never synced"""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            # One read transaction, so the games match the version even while a sync commits
+            cursor.execute("BEGIN")
+            cursor.execute("SELECT version FROM libraries WHERE user_id = ?", (user_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return None, []
+            cursor.execute("SELECT name, exe_name, type FROM library_games WHERE user_id = ?", (user_id,))
+            return row[0], [dict(zip(GAME_FIELDS, game)) for game in cursor.fetchall()]
@@ -0,0 +1,169 @@
+import threading
+import time
+from concurrent.futures import Future
+from Database import ConnectionPool
+from Metrics import db_timer
+
+HISTORY_PAGE = 50
+MAX_HISTORY_PAGE = 200
+MAX_MESSAGE_LENGTH = 2000
+
+
+def conversation_key(user_id, peer_id):
+    """Same key for both directions of a conversation"""
+    return f"{user_id}:{peer_id}" if user_id < peer_id else f"{peer_id}:{user_id}"
+
+
+class MessageManager:
+    """
+    Direct messages between users, stored in the messages table
+
+    History is read newest first, a page at a time, by keyset pagination over the
+    (conversation, timestamp) index: each page seeks straight to its cursor, so the latest
+    page of a long conversation costs the same whatever the table size. Sends are coalesced,
+    every message queued while the writer is busy goes into the next batch as one operation.
+    """
+
+    def __init__(self, db_path='orderly_users.db', pool=None, writer=None):
+        self.db_path = db_path
+        self.pool = pool or ConnectionPool(db_path)
+        # Optional GroupCommitWriter, without one each send commits on its own
+        self.writer = writer
+        self.static = None
+
+        self._lock = threading.Lock()
+        self._batch = None  # messages waiting for the queued insert operation
+
+        # Counters for tuning
+        self.batches = 0
+        self.sent = 0
+
+    def send(self, sender_id, receiver_id, text):
+        """
+        Store a message, blocking until it is committed
+
+        :return: {'id', 'sender_id', 'receiver_id', 'message', 'timestamp'}
+        """
+        if not self.writer:
+            with self.pool.connection() as conn:
+                return self._insert(conn.cursor(), [(sender_id, receiver_id, text, None)])[0]
+
+        future = Future()
+        with self._lock:
+            if self._batch is None:
+                batch = self._batch = []
+                self.writer.submit(lambda cursor: self._insert_batch(cursor, batch)).add_done_callback(
+                    lambda done: self._settle(batch, done))
+            self._batch.append((sender_id, receiver_id, text, future))
+        with db_timer():
+            return future.result()
+
+    def _insert_batch(self, cursor, batch):
+        """Writer operation for one batch, later sends start a new one"""
+        with self._lock:
+            if self._batch is batch:
+                self._batch = None
+        return self._insert(cursor, batch)
+
+    def _insert(self, cursor, batch):
+        stored = []
+        # Same UTC format as the column's CURRENT_TIMESTAMP default
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        for sender_id, receiver_id, text, _ in batch:
+            cursor.execute("""
+                INSERT INTO messages (conversation, sender_id, receiver_id, message, timestamp)
+                VALUES (?, ?, ?, ?, ?)
+            """, (conversation_key(sender_id, receiver_id), sender_id, receiver_id, text, timestamp))
+            stored.append({
+                'id': cursor.lastrowid,
+                'sender_id': sender_id,
+                'receiver_id': receiver_id,
+                'message': text,
+                'timestamp': timestamp
+            })
+        self.batches += 1
+        self.sent += len(stored)
+        return stored
+
+    @staticmethod
+    def _settle(batch, done):
+        """Hand every sender its own stored message once the batch has committed"""
+        error = done.exception()
+        stored = None if error else done.result()
+        for index, (_, _, _, future) in enumerate(batch):
+            if error:
+                future.set_exception(error)
+            else:
+                future.set_result(stored[index])
+
+    def get_history(self, user_id, peer_id, before=None, limit=HISTORY_PAGE):
+        """
+        One page of a conversation, newest first
+
+        :param before: cursor from the previous page, None for the latest messages
+        :return: (messages, cursor for the next older page or None when there is none)
+        """
+        limit = max(1, min(int(limit), MAX_HISTORY_PAGE))
+        conversation = conversation_key(user_id, peer_id)
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            if before is None:
+                cursor.execute("""
+                    SELECT id, sender_id, receiver_id, message, timestamp
+                    FROM messages
+                    WHERE conversation = ?
+                    ORDER BY timestamp DESC, id DESC
+                    LIMIT ?
+                """, (conversation, limit + 1))
+            else:
+                timestamp, message_id = before
+                cursor.execute("""
+                    SELECT id, sender_id, receiver_id, message, timestamp
+                    FROM messages
+                    WHERE conversation = ? AND (timestamp, id) < (?, ?)
+                    ORDER BY timestamp DESC, id DESC
+                    LIMIT ?
+                """, (conversation, timestamp, int(message_id), limit + 1))
+            rows = cursor.fetchall()
+
+        # One row past the page tells whether an older page exists without a COUNT
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = [rows[-1][4], rows[-1][0]]
+        messages = [{
+            'id': row[0],
+            'sender_id': row[1],
+            'receiver_id': row[2],
+            'message': row[3],
+            'timestamp': row[4]
+        } for row in rows]
+        return messages, next_cursor
+
+    def mark_read(self, user_id, peer_id):
+        """Mark everything peer_id sent to user_id as read, in the background"""
+        def update(cursor):
+            cursor.execute("""
+                UPDATE messages SET is_read = 1
+                WHERE receiver_id = ? AND sender_id = ? AND is_read = 0
+            """, (user_id, peer_id))
+
+        if self.writer:
+            self.writer.submit(update)
+        else:
+            with self.pool.connection() as conn:
+                update(conn.cursor())
+
+    def get_unread_counts(self, user_id):
+        """
+        :return: {sender_id: unread messages from them}, served from the partial unread index
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT sender_id, COUNT(*)
+                FROM messages
+                WHERE receiver_id = ? AND is_read = 0
+                GROUP BY sender_id
+            """, (user_id,))
+            return dict(cursor.fetchall())
@@ -0,0 +1,195 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger('orderly.metrics')
+
+# Histogram bucket upper bounds in milliseconds, the last bucket takes everything slower
+BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# DB time spent by the request running on the current thread
+_db_time = threading.local()
+
+
+def add_db_time(seconds):
+    _db_time.total = getattr(_db_time, 'total', 0.0) + seconds
+
+
+def take_db_time():
+    """Return the DB time accumulated on this thread since the last call and reset it"""
+    total = getattr(_db_time, 'total', 0.0)
+    _db_time.total = 0.0
+    return total
+
+
+@contextmanager
+def db_timer():
+    """Count the time spent in the block as DB time, e.g. waiting for a group commit"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_db_time(time.perf_counter() - started)
+
+
+class Histogram:
+    """Fixed log-spaced latency buckets, cheap enough to update on every request"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, seconds):
+        ms = seconds * 1000
+        self.counts[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of samples, the max for the last bucket"""
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return BUCKETS_MS[index] if index < len(BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def snapshot(self):
+        buckets = {f"le_{bound}": count for bound, count in zip(BUCKETS_MS, self.counts) if count}
+        if self.counts[-1]:
+            buckets['inf'] = self.counts[-1]
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total_ms / self.count, 3) if self.count else 0.0,
+            'p50_ms': self.percentile(0.50),
+            'p95_ms': self.percentile(0.95),
+            'p99_ms': self.percentile(0.99),
+            'max_ms': round(self.max_ms, 3),
+            'buckets': buckets
+        }
+
+
+class RequestStats:
+    """Counters and latency histograms of one request type (or friendlist action)"""
+
+    def __init__(self):
+        self.requests = 0
+        self.failed = 0  # answered with status 'failed'
+        self.errors = 0  # handler raised
+        self.latency = Histogram()  # handler, DB included
+        self.db = Histogram()
+        self.decode = Histogram()
+        self.encode = Histogram()
+
+    def snapshot(self):
+        return {
+            'requests': self.requests,
+            'failed': self.failed,
+            'errors': self.errors,
+            'latency': self.latency.snapshot(),
+            'db': self.db.snapshot(),
+            'serialization': {
+                'decode': self.decode.snapshot(),
+                'encode': self.encode.snapshot()
+            }
+        }
+
+
+class Metrics:
+    """
+    Per request type instrumentation
+
+    Handlers are timed by the dispatcher, DB time is whatever pooled connections and
+    writer waits added to the thread's counter while the handler ran (see db_timer),
+    and serialization is timed where requests are decoded and responses encoded.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._stats = {}  # {key: RequestStats}
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats.setdefault(key, RequestStats())
+        return stats
+
+    def record(self, key, seconds, db_seconds, failed=False, error=False):
+        with self._lock:
+            stats = self._get(key)
+            stats.requests += 1
+            stats.failed += failed
+            stats.errors += error
+            stats.latency.record(seconds)
+            stats.db.record(db_seconds)
+
+    def record_serialization(self, key, phase, seconds):
+        """
+        :param phase: 'decode' for the request or 'encode' for the response
+        """
+        with self._lock:
+            getattr(self._get(key), phase).record(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            requests = {key: stats.snapshot() for key, stats in sorted(self._stats.items())}
+        return {
+            'uptime': round(time.time() - self.started, 1),
+            'requests': requests
+        }
+
+    def dump(self, path, extra=None):
+        """Write a snapshot as JSON, replacing the file atomically so readers never see half of it"""
+        snapshot = self.snapshot()
+        if extra:
+            snapshot.update(extra)
+        snapshot['time'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        temporary = f"{path}.tmp"
+        with open(temporary, 'w') as f:
+            json.dump(snapshot, f, indent=2)
+        os.replace(temporary, path)
+
+
+class StatsDumper:
+    """Background thread dumping a server's stats to a file every interval seconds"""
+
+    def __init__(self, dump, path, interval=60.0):
+        """
+        :param dump: callable(path) writing the stats file
+        :param path: file the stats are written to
+        :param interval: seconds between dumps
+        """
+        self.dump = dump
+        self.path = path
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='orderly-stats', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._dump()
+
+    def _dump(self):
+        try:
+            self.dump(self.path)
+        except OSError as e:
+            log.warning("Could not write stats to %s: %s", self.path, e)
+
+    def stop(self):
+        """Stop the thread and write a final dump"""
+        self._stopped.set()
+        self._thread.join()
+        self._dump()
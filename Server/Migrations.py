@@ -0,0 +1,381 @@
+"""
+Versioned schema migrations for orderly_users.db
+
+Every schema change is a numbered migration, applied in order on startup and recorded in
+the schema_migrations table, so an existing database is brought up to date in place
+instead of being rebuilt. Migrations that shipped are never edited or renumbered, a
+change to one of them is a new migration. Run this file to see a database's state and
+the query plan of every hot query:
+
+    python Migrations.py orderly_users.db
+"""
+import argparse
+import sqlite3
+import time
+from Database import open_connection
+
+
+def _initial_schema(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY,
+            username TEXT UNIQUE NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            salt TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS friends (
+            user_id TEXT,
+            friend_id TEXT,
+            PRIMARY KEY (user_id, friend_id),
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (friend_id) REFERENCES users (id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender_id TEXT,
+            receiver_id TEXT,
+            message TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _sessions_table(cursor):
+    # Loaded into memory at startup, see Sessions.SessionStore
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            username TEXT NOT NULL,
+            expires INTEGER NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+
+def _message_chat(cursor):
+    # A direction-independent conversation key for history paging and a read flag for unread
+    # counts. Databases from before migrations were tracked may already have them
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(messages)")}
+    if 'conversation' not in columns:
+        cursor.execute("ALTER TABLE messages ADD COLUMN conversation TEXT")
+        cursor.execute('''
+            UPDATE messages SET conversation = CASE WHEN sender_id < receiver_id
+                THEN sender_id || ':' || receiver_id
+                ELSE receiver_id || ':' || sender_id END
+        ''')
+    if 'is_read' not in columns:
+        cursor.execute("ALTER TABLE messages ADD COLUMN is_read INTEGER NOT NULL DEFAULT 0")
+    # History pages seek on (conversation, timestamp), the rowid in every index entry breaks ties
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_conversation
+        ON messages (conversation, timestamp)
+    ''')
+    # Only unread messages are indexed, so the index stays as small as the unread backlog
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_unread
+        ON messages (receiver_id, sender_id) WHERE is_read = 0
+    ''')
+
+
+def _friend_followers(cursor):
+    # The primary key only serves lookups by user_id, "who has me as a friend" scanned the
+    # whole table on every sign in and sign out. Covering, the table itself is never read
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_friends_friend ON friends (friend_id, user_id)")
+
+
+def _session_expiry(cursor):
+    # Expired sessions are purged every minute and loaded oldest first at startup
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires)")
+
+
+def _username_search(cursor):
+    # user_search seeks the range of usernames starting with the query, ignoring ASCII case.
+    # The username breaks ties between names equal but for case and id makes it covering
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_users_username_search
+        ON users (username COLLATE NOCASE, username, id)
+    ''')
+
+
+def _libraries(cursor):
+    # One row per synced library with its version, the games clustered by owner so a
+    # library is read with one range scan, see LibraryManager
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS libraries (
+            user_id TEXT PRIMARY KEY,
+            version TEXT NOT NULL,
+            game_count INTEGER NOT NULL,
+            updated INTEGER NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS library_games (
+            user_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            exe_name TEXT,
+            type TEXT,
+            PRIMARY KEY (user_id, name)
+        ) WITHOUT ROWID
+    ''')
+
+
+def _game_metadata(cursor):
+    # Shared cache of upstream game metadata, see GameMetadata.MetadataService
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS game_metadata (
+            title_key TEXT PRIMARY KEY,
+            metadata TEXT NOT NULL,
+            fetched INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+
+def _covers(cursor):
+    # Cover thumbnails by the image they were made from, the files are named by ETag, see Covers
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS covers (
+            source_url TEXT PRIMARY KEY,
+            etag TEXT NOT NULL,
+            created INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+
+def _playtime(cursor):
+    # Play sessions as reported and their rollups, see PlaytimeManager. Open sessions are
+    # indexed on their own for the purge of those never stopped
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS play_sessions (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            game TEXT NOT NULL,
+            started INTEGER NOT NULL,
+            ended INTEGER,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_play_sessions_open ON play_sessions (started) WHERE ended IS NULL")
+    for table, bucket in (('playtime_hourly', 'hour'), ('playtime_daily', 'day')):
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                user_id TEXT NOT NULL,
+                game TEXT NOT NULL,
+                {bucket} INTEGER NOT NULL,
+                seconds INTEGER NOT NULL,
+                PRIMARY KEY (user_id, game, {bucket})
+            ) WITHOUT ROWID
+        ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS playtime_totals (
+            user_id TEXT NOT NULL,
+            game TEXT NOT NULL,
+            seconds INTEGER NOT NULL,
+            sessions INTEGER NOT NULL,
+            last_played INTEGER NOT NULL,
+            PRIMARY KEY (user_id, game)
+        ) WITHOUT ROWID
+    ''')
+    # Everyone's playtime per game and week, ranked by the index
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS playtime_weekly (
+            week INTEGER NOT NULL,
+            game TEXT NOT NULL,
+            seconds INTEGER NOT NULL,
+            sessions INTEGER NOT NULL,
+            PRIMARY KEY (week, game)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_playtime_weekly_rank ON playtime_weekly (week, seconds)")
+
+
+def _leaderboards(cursor):
+    # Every game's players in order of playtime, for global leaderboards and ranks
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_playtime_totals_rank ON playtime_totals (game, seconds)")
+
+
+# (version, description, apply(cursor)), in the order they run
+MIGRATIONS = [
+    (1, "users, friends and messages tables", _initial_schema),
+    (2, "sessions table", _sessions_table),
+    (3, "message conversation key, read flag and their indexes", _message_chat),
+    (4, "friends (friend_id, user_id) index for follower lookups", _friend_followers),
+    (5, "sessions expiry index", _session_expiry),
+    (6, "case-insensitive username index for user search", _username_search),
+    (7, "synced game libraries", _libraries),
+    (8, "game metadata cache", _game_metadata),
+    (9, "cover thumbnails", _covers),
+    (10, "play sessions and playtime rollups", _playtime),
+    (11, "playtime rank index for leaderboards", _leaderboards),
+]
+
+
+def applied_migrations(conn):
+    """
+    :return: {version: (description, applied_at)}, empty for a database that was never migrated
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'schema_migrations'")
+    if not cursor.fetchone():
+        return {}
+    cursor.execute("SELECT version, description, applied_at FROM schema_migrations")
+    return {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+
+
+def migrate(conn, migrations=MIGRATIONS):
+    """
+    Apply every migration the database hasn't had yet
+
+    All of them run in one BEGIN IMMEDIATE transaction: worker processes starting together
+    wait for each other and only the first one does the work, and a failing migration
+    rolls the database back to where it was.
+
+    :return: [(version, description)] of the migrations applied now
+    """
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TEXT NOT NULL
+            )
+        ''')
+        done = set(applied_migrations(conn))
+        applied = []
+        for version, description, apply in migrations:
+            if version in done:
+                continue
+            apply(cursor)
+            cursor.execute('''
+                INSERT INTO schema_migrations (version, description, applied_at)
+                VALUES (?, ?, ?)
+            ''', (version, description, time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())))
+            applied.append((version, description))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return applied
+
+
+# Queries on the request path, each should be answered from an index: (name, SQL, sample parameters).
+# Keep them in step with the statements in FriendManager, MessageManager, LibraryManager, GameMetadata,
+# Covers, PlaytimeManager, Sessions and Server
+HOT_QUERIES = [
+    ('login', "SELECT id, username, password_hash, salt FROM users WHERE username = ?", ('name',)),
+    ('user_info', "SELECT id, username FROM users WHERE id = ?", ('id',)),
+    ('user_search', "SELECT id, username FROM users "
+                    "WHERE username >= ?1 COLLATE NOCASE AND username < ?2 COLLATE NOCASE "
+                    "AND (username COLLATE NOCASE > ?1 OR username > ?3) "
+                    "ORDER BY username COLLATE NOCASE, username LIMIT ?4", ('ab', 'ab\U0010ffff', '', 21)),
+    ('friends.get', "SELECT u.id, u.username FROM users u JOIN friends f ON u.id = f.friend_id "
+                    "WHERE f.user_id = ?", ('id',)),
+    ('friends.count', "SELECT COUNT(*) FROM friends WHERE user_id = ?", ('id',)),
+    ('friends.exists', "SELECT 1 FROM friends WHERE user_id = ? AND friend_id = ?", ('id', 'id')),
+    ('friends.followers', "SELECT user_id FROM friends WHERE friend_id = ?", ('id',)),
+    ('messages.history', "SELECT id, sender_id, receiver_id, message, timestamp FROM messages "
+                         "WHERE conversation = ? ORDER BY timestamp DESC, id DESC LIMIT ?", ('a:b', 51)),
+    ('messages.history_page', "SELECT id, sender_id, receiver_id, message, timestamp FROM messages "
+                              "WHERE conversation = ? AND (timestamp, id) < (?, ?) "
+                              "ORDER BY timestamp DESC, id DESC LIMIT ?", ('a:b', '2000-01-01 00:00:00', 1, 51)),
+    ('messages.unread', "SELECT sender_id, COUNT(*) FROM messages WHERE receiver_id = ? AND is_read = 0 "
+                        "GROUP BY sender_id", ('id',)),
+    ('messages.mark_read', "UPDATE messages SET is_read = 1 WHERE receiver_id = ? AND sender_id = ? "
+                           "AND is_read = 0", ('id', 'id')),
+    ('library.version', "SELECT version, game_count FROM libraries WHERE user_id = ?", ('id',)),
+    ('library.games', "SELECT name, exe_name, type FROM library_games WHERE user_id = ?", ('id',)),
+    ('library.game', "SELECT exe_name, type FROM library_games WHERE user_id = ? AND name = ?", ('id', 'name')),
+    ('game_metadata', "SELECT metadata, fetched FROM game_metadata WHERE title_key = ?", ('title',)),
+    ('covers.etag', "SELECT etag FROM covers WHERE source_url = ?", ('url',)),
+    ('playtime.session', "SELECT game, started FROM play_sessions WHERE id = ? AND user_id = ? AND ended IS NULL",
+     ('id', 'id')),
+    ('playtime.abandoned', "SELECT id, user_id, game, started FROM play_sessions WHERE ended IS NULL AND started < ?",
+     (0,)),
+    ('playtime.close', "UPDATE play_sessions SET ended = ? WHERE id = ?", (0, 'id')),
+    ('playtime.totals', "SELECT game, seconds, sessions, last_played FROM playtime_totals WHERE user_id = ?",
+     ('id',)),
+    ('playtime.recent', "SELECT game, SUM(seconds) FROM playtime_daily WHERE user_id = ? AND day >= ? "
+                        "GROUP BY game", ('id', 0)),
+    ('playtime.hours', "SELECT hour, seconds FROM playtime_hourly WHERE user_id = ? AND game = ? AND hour >= ?",
+     ('id', 'game', 0)),
+    ('playtime.top_games', "SELECT game, seconds, sessions FROM playtime_weekly WHERE week = ? "
+                           "ORDER BY seconds DESC LIMIT ?", (0, 10)),
+    ('leaderboard.scores', "SELECT user_id, seconds FROM playtime_totals WHERE user_id IN (?, ?, ?) AND game = ?",
+     ('id', 'id', 'id', 'game')),
+    ('leaderboard.top', "SELECT t.user_id, u.username, t.seconds FROM playtime_totals t "
+                        "JOIN users u ON u.id = t.user_id WHERE t.game = ? ORDER BY t.seconds DESC LIMIT ?",
+     ('game', 10)),
+    ('leaderboard.rank', "SELECT COUNT(*) FROM playtime_totals WHERE game = ? AND seconds > ?", ('game', 0)),
+    ('sessions.fetch', "SELECT user_id, username, expires FROM sessions WHERE id = ?", ('id',)),
+    ('sessions.purge', "DELETE FROM sessions WHERE expires <= ?", (0,)),
+]
+
+
+def query_plan(conn, sql, parameters=()):
+    """:return: the detail column of EXPLAIN QUERY PLAN, one line per step"""
+    cursor = conn.cursor()
+    cursor.execute(f"EXPLAIN QUERY PLAN {sql}", parameters)
+    return [row[3] for row in cursor.fetchall()]
+
+
+def plan_problems(plan):
+    """Steps of a plan that read a whole table or sort in a temporary b-tree"""
+    return [step for step in plan
+            if (step.startswith('SCAN ') and step != 'SCAN CONSTANT ROW') or 'TEMP B-TREE' in step]
+
+
+def check_query_plans(conn, queries=HOT_QUERIES):
+    """
+    EXPLAIN every hot query against the current schema
+
+    :return: [(name, plan steps, problem steps)], problems empty when the query is index-only
+    """
+    results = []
+    for name, sql, parameters in queries:
+        try:
+            plan = query_plan(conn, sql, parameters)
+        except sqlite3.Error as e:
+            # e.g. a column added by a pending migration
+            results.append((name, [], [str(e)]))
+            continue
+        results.append((name, plan, plan_problems(plan)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate an Orderly database and check its query plans")
+    parser.add_argument('database', nargs='?', default='orderly_users.db')
+    parser.add_argument('--status', action='store_true', help="only report, don't apply pending migrations")
+    args = parser.parse_args()
+
+    conn = open_connection(args.database)
+    if not args.status:
+        for version, description in migrate(conn):
+            print(f"[+] Applied migration {version}: {description}")
+
+    applied = applied_migrations(conn)
+    for version, description, _ in MIGRATIONS:
+        state = f"applied {applied[version][1]}" if version in applied else "pending"
+        print(f"{version:>4}  {description:<58} {state}")
+
+    print()
+    failures = 0
+    for name, plan, problems in check_query_plans(conn):
+        print(f"{'[!]' if problems else '[+]'} {name}")
+        for step in plan or problems:
+            print(f"      {step}")
+        failures += bool(problems)
+    conn.close()
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
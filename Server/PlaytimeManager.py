@@ -0,0 +1,244 @@
+import logging
+import time
+from Database import ConnectionPool
+
+log = logging.getLogger('orderly.playtime')
+
+HOUR = 3600
+DAY = 24 * HOUR
+# A session is counted for at most this long, a stop arriving later is capped to it
+MAX_SESSION = DAY
+# A session with no stop this long past MAX_SESSION was lost (client crashed, connection dropped)
+# and is closed at MAX_SESSION by housekeeping, a late stop still gets counted until then
+STOP_GRACE = DAY
+TOP_GAMES = 10
+MAX_TOP_GAMES = 50
+LEADERBOARD = 10
+MAX_LEADERBOARD = 100
+# Host parameters per query, well under SQLite's limit
+SCORE_CHUNK = 500
+
+
+def week_of(timestamp):
+    """Weeks since the epoch, starting on Monday (1970-01-01 was a Thursday)"""
+    return (timestamp // DAY + 3) // 7
+
+
+def split_buckets(started, ended, width):
+    """
+    :return: [(bucket, seconds)] of the time between started and ended falling in each
+             bucket of `width` seconds, bucket being the start time // width
+    """
+    buckets = []
+    while started < ended:
+        bucket = started // width
+        end = min(ended, (bucket + 1) * width)
+        buckets.append((bucket, end - started))
+        started = end
+    return buckets
+
+
+def ranked(entries):
+    """
+    Order leaderboard entries by 'seconds' and number them, equal times share a rank (1, 2, 2, 4)
+
+    :param entries: dicts with 'seconds' and 'username'
+    """
+    entries = sorted(entries, key=lambda entry: (-entry['seconds'], entry['username']))
+    for position, entry in enumerate(entries):
+        tied = position and entries[position - 1]['seconds'] == entry['seconds']
+        entry['rank'] = entries[position - 1]['rank'] if tied else position + 1
+    return entries
+
+
+class PlaytimeManager:
+    """
+    Play sessions reported by the clients, rolled up by hour, day, week and in total
+
+    Starts and stops are queued on the group-commit writer without waiting, a burst of
+    reports costs one commit. A stop adds the session's time to the user's hourly, daily and
+    total rollups for the game and to the global weekly count, split at bucket edges, so every
+    question about playtime is answered from the rollups and raw sessions are never summed.
+
+    The totals double as leaderboard scores: a stop updates the one row it affects and the
+    (game, seconds) index keeps every game's players in score order.
+    """
+
+    def __init__(self, db_path='orderly_users.db', pool=None, writer=None):
+        self.db_path = db_path
+        self.pool = pool or ConnectionPool(db_path)
+        # Optional GroupCommitWriter, without one each report commits on its own
+        self.writer = writer
+        self.static = None
+
+    def _submit(self, operation):
+        if self.writer:
+            self.writer.submit(operation).add_done_callback(self._report_error)
+            return
+        with self.pool.connection() as conn:
+            operation(conn.cursor())
+
+    def _report_error(self, future):
+        self.static = None
+        if future.exception() is not None:
+            log.error("Error recording playtime: %s", future.exception())
+
+    def start(self, user_id, session_id, game, at=None):
+        """Record that a user launched a game, a repeated start of the same session is ignored"""
+        at = int(at or time.time())
+
+        def record(cursor):
+            cursor.execute('''
+                INSERT OR IGNORE INTO play_sessions (id, user_id, game, started)
+                VALUES (?, ?, ?, ?)
+            ''', (session_id, user_id, game, at))
+
+        self._submit(record)
+
+    def stop(self, user_id, session_id, at=None):
+        """Close a user's session and add its time to the rollups, unknown or closed sessions are ignored"""
+        at = int(at or time.time())
+
+        def record(cursor):
+            cursor.execute("SELECT game, started FROM play_sessions WHERE id = ? AND user_id = ? AND ended IS NULL",
+                           (session_id, user_id))
+            row = cursor.fetchone()
+            if row is None:
+                return 0
+            game, started = row
+            return self._close(cursor, session_id, user_id, game, started, at)
+
+        self._submit(record)
+
+    def _close(self, cursor, session_id, user_id, game, started, at):
+        """End an open session at `at`, capped to MAX_SESSION, and roll its time up, :return: seconds counted"""
+        ended = min(max(at, started), started + MAX_SESSION)
+        cursor.execute("UPDATE play_sessions SET ended = ? WHERE id = ?", (ended, session_id))
+        self._roll_up(cursor, user_id, game, started, ended)
+        return ended - started
+
+    @staticmethod
+    def _roll_up(cursor, user_id, game, started, ended):
+        cursor.executemany('''
+            INSERT INTO playtime_hourly (user_id, game, hour, seconds) VALUES (?, ?, ?, ?)
+            ON CONFLICT (user_id, game, hour) DO UPDATE SET seconds = seconds + excluded.seconds
+        ''', [(user_id, game, hour, seconds) for hour, seconds in split_buckets(started, ended, HOUR)])
+        cursor.executemany('''
+            INSERT INTO playtime_daily (user_id, game, day, seconds) VALUES (?, ?, ?, ?)
+            ON CONFLICT (user_id, game, day) DO UPDATE SET seconds = seconds + excluded.seconds
+        ''', [(user_id, game, day, seconds) for day, seconds in split_buckets(started, ended, DAY)])
+        cursor.execute('''
+            INSERT INTO playtime_totals (user_id, game, seconds, sessions, last_played) VALUES (?, ?, ?, 1, ?)
+            ON CONFLICT (user_id, game) DO UPDATE SET seconds = seconds + excluded.seconds,
+                sessions = sessions + 1, last_played = MAX(last_played, excluded.last_played)
+        ''', (user_id, game, ended - started, ended))
+        weeks = {}
+        for day, seconds in split_buckets(started, ended, DAY):
+            week = week_of(day * DAY)
+            weeks[week] = weeks.get(week, 0) + seconds
+        cursor.executemany('''
+            INSERT INTO playtime_weekly (week, game, seconds, sessions) VALUES (?, ?, ?, 1)
+            ON CONFLICT (week, game) DO UPDATE SET seconds = seconds + excluded.seconds,
+                sessions = sessions + 1
+        ''', [(week, game, seconds) for week, seconds in weeks.items()])
+
+    def close_abandoned(self, now=None):
+        """Close the sessions that were never stopped at MAX_SESSION and count them, :return: how many"""
+        cutoff = int(now or time.time()) - MAX_SESSION - STOP_GRACE
+
+        def close(cursor):
+            cursor.execute("SELECT id, user_id, game, started FROM play_sessions WHERE ended IS NULL AND started < ?",
+                           (cutoff,))
+            abandoned = cursor.fetchall()
+            for session_id, user_id, game, started in abandoned:
+                self._close(cursor, session_id, user_id, game, started, started + MAX_SESSION)
+            return len(abandoned)
+
+        if self.writer:
+            return self.writer.execute(close)
+        with self.pool.connection() as conn:
+            return close(conn.cursor())
+
+    def get_totals(self, user_id):
+        """:return: [{'game', 'seconds', 'sessions', 'last_played'}] most played first"""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT game, seconds, sessions, last_played FROM playtime_totals WHERE user_id = ?",
+                           (user_id,))
+            rows = cursor.fetchall()
+        # One user's games, fewer than a library holds, sorted here rather than through a temp b-tree
+        rows.sort(key=lambda row: row[1], reverse=True)
+        return [{'game': game, 'seconds': seconds, 'sessions': sessions, 'last_played': last_played}
+                for game, seconds, sessions, last_played in rows]
+
+    def get_recent(self, user_id, days=7, now=None):
+        """:return: [{'game', 'seconds'}] played in the last `days` days, most played first"""
+        since = int(now or time.time()) // DAY - days + 1
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT game, SUM(seconds) FROM playtime_daily
+                WHERE user_id = ? AND day >= ? GROUP BY game
+            ''', (user_id, since))
+            rows = cursor.fetchall()
+        rows.sort(key=lambda row: row[1], reverse=True)
+        return [{'game': game, 'seconds': seconds} for game, seconds in rows]
+
+    def get_hours(self, user_id, game, hours=24, now=None):
+        """:return: [{'hour', 'seconds'}] of a game in the last `hours` hours, hour as a timestamp"""
+        since = int(now or time.time()) // HOUR - hours + 1
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT hour, seconds FROM playtime_hourly
+                WHERE user_id = ? AND game = ? AND hour >= ?
+            ''', (user_id, game, since))
+            return [{'hour': hour * HOUR, 'seconds': seconds} for hour, seconds in cursor.fetchall()]
+
+    def top_games(self, limit=TOP_GAMES, now=None):
+        """:return: [{'game', 'seconds', 'sessions'}] most played by everyone this week (from Monday)"""
+        limit = max(1, min(int(limit), MAX_TOP_GAMES))
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT game, seconds, sessions FROM playtime_weekly
+                WHERE week = ? ORDER BY seconds DESC LIMIT ?
+            ''', (week_of(int(now or time.time())), limit))
+            return [{'game': game, 'seconds': seconds, 'sessions': sessions}
+                    for game, seconds, sessions in cursor.fetchall()]
+
+    def get_scores(self, user_ids, game):
+        """:return: {user_id: seconds} of a game, for those of the users who played it"""
+        user_ids = list(user_ids)
+        scores = {}
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            for start in range(0, len(user_ids), SCORE_CHUNK):
+                chunk = user_ids[start:start + SCORE_CHUNK]
+                # One primary key seek per user, however many played the game
+                cursor.execute(f'''
+                    SELECT user_id, seconds FROM playtime_totals
+                    WHERE user_id IN ({', '.join('?' * len(chunk))}) AND game = ?
+                ''', chunk + [game])
+                scores.update(cursor.fetchall())
+        return scores
+
+    def top_players(self, game, limit=LEADERBOARD):
+        """:return: [{'id', 'username', 'seconds'}] who played a game longest, longest first"""
+        limit = max(1, min(int(limit), MAX_LEADERBOARD))
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT t.user_id, u.username, t.seconds
+                FROM playtime_totals t JOIN users u ON u.id = t.user_id
+                WHERE t.game = ? ORDER BY t.seconds DESC LIMIT ?
+            ''', (game, limit))
+            return [{'id': user_id, 'username': username, 'seconds': seconds}
+                    for user_id, username, seconds in cursor.fetchall()]
+
+    def rank_of(self, game, seconds):
+        """:return: rank among everyone who played a game of a player with this playtime"""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM playtime_totals WHERE game = ? AND seconds > ?", (game, seconds))
+            return cursor.fetchone()[0] + 1
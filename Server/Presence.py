@@ -0,0 +1,228 @@
+import logging
+import os
+import signal
+import threading
+from collections import deque
+
+log = logging.getLogger('orderly.presence')
+
+
+class Outbox:
+    """
+    Bounded queue of push events for one connection
+
+    Publishers only append here and never touch the socket, the connection's own sender
+    (a thread in threaded mode, a task in asyncio mode) writes the events out. When a slow
+    client lets the queue fill up, further events are dropped and the client is sent a
+    single 'resync' event so it re-queries instead of working from a partial stream.
+    """
+
+    def __init__(self, limit=256, on_ready=None):
+        """
+        :param limit: events kept for a client that isn't reading
+        :param on_ready: optional callable run after each put, used to wake an asyncio sender
+        """
+        self.limit = limit
+        self.on_ready = on_ready
+        self.dropped = 0
+        self.closed = False
+        self._events = deque()
+        self._overflowed = False
+        self._condition = threading.Condition()
+
+    def put(self, event):
+        """Queue an event, False if it was dropped"""
+        with self._condition:
+            if self.closed:
+                return False
+            if len(self._events) >= self.limit:
+                self.dropped += 1
+                self._overflowed = True
+                return False
+            self._events.append(event)
+            self._condition.notify()
+        if self.on_ready:
+            self.on_ready()
+        return True
+
+    def take(self):
+        """Remove and return every queued event"""
+        with self._condition:
+            events = list(self._events)
+            self._events.clear()
+            if self._overflowed:
+                events.append({'type': 'event', 'event': 'resync'})
+                self._overflowed = False
+            return events
+
+    def wait(self, timeout=None):
+        """Block until there is something to send or the outbox is closed"""
+        with self._condition:
+            if not self._events and not self._overflowed and not self.closed:
+                self._condition.wait(timeout)
+
+    def depth(self):
+        return len(self._events)
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+        if self.on_ready:
+            self.on_ready()
+
+
+def presence_event(user_id, username, online):
+    return {
+        'type': 'event',
+        'event': 'online' if online else 'offline',
+        'user_id': user_id,
+        'username': username
+    }
+
+
+class PresenceService:
+    """
+    Registry of online users and their connections, and event fan-out to them
+
+    A user is online while at least one of their connections is signed in. publish()
+    only queues into each connection's Outbox, so fan-out never waits on a socket.
+    """
+
+    def __init__(self):
+        self._connections = {}  # {user_id: set of ClientContext}
+        self._lock = threading.Lock()
+        # {kind: callable(payload)} run for broadcast() messages from other worker processes
+        self.listeners = {}
+
+    def connect(self, client):
+        """Register a signed-in connection, True if this brought the user online"""
+        user_id = client.user['id']
+        with self._lock:
+            connections = self._connections.setdefault(user_id, set())
+            connections.add(client)
+            return len(connections) == 1
+
+    def disconnect(self, client, user_id):
+        """Unregister a connection of user_id, True if this took the user offline"""
+        with self._lock:
+            connections = self._connections.get(user_id)
+            if not connections or client not in connections:
+                return False
+            connections.discard(client)
+            if connections:
+                return False
+            del self._connections[user_id]
+            return True
+
+    def is_online(self, user_id):
+        return user_id in self._connections
+
+    def online_count(self):
+        return len(self._connections)
+
+    def connections(self, user_id):
+        with self._lock:
+            return list(self._connections.get(user_id, ()))
+
+    def publish(self, user_ids, event, exclude=None):
+        """
+        Queue an event for every connection of the given users
+
+        :param exclude: connection that caused the event, it already has the answer
+        :return: number of connections the event was queued for
+        """
+        delivered = 0
+        for user_id in set(user_ids):
+            for client in self.connections(user_id):
+                if client is exclude:
+                    continue
+                if client.outbox is not None and client.outbox.put(event):
+                    delivered += 1
+        return delivered
+
+    def announce(self, user, followers, online):
+        """Tell a user's followers they came online or went offline, after connect()/disconnect() said so"""
+        self.publish(followers, presence_event(user['id'], user['username'], online))
+
+    def broadcast(self, kind, payload):
+        """Notify the other worker processes of a local change, nothing to do with a single process"""
+
+
+class ClusterPresence(PresenceService):
+    """
+    PresenceService of one worker process under the Supervisor
+
+    Local connections are tracked as in a single process, and the supervisor is told when
+    a user's first or last connection on this worker comes or goes. It decides whether
+    that changes the user's online state across all workers and sends the verdict to every
+    worker, which keeps a replica of the online set and notifies its own connections.
+    Events published here are also forwarded to the workers hosting their recipients.
+    """
+
+    def __init__(self, connection, worker_id):
+        """
+        :param connection: this worker's end of its multiprocessing Pipe to the supervisor
+        :param worker_id: index of the worker, for logs and stats
+        """
+        super().__init__()
+        self.connection = connection
+        self.worker_id = worker_id
+        self._online = set()  # users online on any worker
+        self._send_lock = threading.Lock()
+        threading.Thread(target=self._receive, name='orderly-cluster', daemon=True).start()
+        self._send(('hello',))
+
+    def _send(self, message):
+        with self._send_lock:
+            self.connection.send(message)
+
+    def announce(self, user, followers, online):
+        self._send(('connect' if online else 'disconnect', user['id'], user['username'], followers))
+
+    def is_online(self, user_id):
+        return user_id in self._online
+
+    def online_count(self):
+        return len(self._online)
+
+    def publish(self, user_ids, event, exclude=None):
+        user_ids = list(set(user_ids))
+        delivered = super().publish(user_ids, event, exclude)
+        self._send(('publish', user_ids, event))
+        return delivered
+
+    def broadcast(self, kind, payload):
+        self._send(('broadcast', kind, payload))
+
+    def _receive(self):
+        """Apply messages from the supervisor, shut the worker down if the supervisor goes away"""
+        while True:
+            try:
+                message = self.connection.recv()
+            except (EOFError, OSError):
+                log.warning("Worker %s lost its supervisor, shutting down", self.worker_id)
+                os.kill(os.getpid(), signal.SIGTERM)
+                return
+
+            kind = message[0]
+            if kind in ('online', 'offline'):
+                _, user_id, username, followers = message
+                if kind == 'online':
+                    self._online.add(user_id)
+                else:
+                    self._online.discard(user_id)
+                PresenceService.publish(self, followers, presence_event(user_id, username, kind == 'online'))
+            elif kind == 'publish':
+                _, user_ids, event = message
+                PresenceService.publish(self, user_ids, event)
+            elif kind == 'snapshot':
+                self._online = set(message[1])
+            elif kind == 'broadcast':
+                _, broadcast_kind, payload = message
+                listener = self.listeners.get(broadcast_kind)
+                if listener:
+                    try:
+                        listener(payload)
+                    except Exception as e:
+                        log.error("Error applying '%s' from another worker: %s", broadcast_kind, e)
@@ -0,0 +1,105 @@
+import json
+import struct
+
+# Wire format: every message is a 4-byte big-endian body length followed by the UTF-8 JSON body.
+# The client (Protocol.py next to main.py) and the server (Server/Protocol.py) carry identical
+# copies of this module, keep the two in sync.
+HEADER = struct.Struct('!I')
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+# Bodies at least this large are streamed straight into a buffer sized from the header
+LARGE_MESSAGE_SIZE = 64 * 1024
+RECV_SIZE = 64 * 1024
+
+
+class ProtocolError(Exception):
+    """Raised when the peer sends a frame that can't be valid"""
+
+
+def encode_message(message):
+    """
+    Frame a message for the wire
+
+    :param message: JSON serializable object
+    :return: header + body bytes
+    """
+    body = json.dumps(message, separators=(',', ':')).encode('utf-8')
+    if len(body) > MAX_MESSAGE_SIZE:
+        raise ProtocolError(f"Message of {len(body)} bytes exceeds the {MAX_MESSAGE_SIZE} byte limit")
+    return HEADER.pack(len(body)) + body
+
+
+def decode_message(payload):
+    """Decode a single frame body, raises json.JSONDecodeError on a malformed body"""
+    return json.loads(payload.decode('utf-8'))
+
+
+class FrameDecoder:
+    """
+    Incremental frame decoder
+
+    feed() accepts whatever a single recv() returned and hands back every frame body
+    it completed, so one read can yield many messages and a message can span many reads.
+    """
+
+    def __init__(self, max_size=MAX_MESSAGE_SIZE):
+        self.max_size = max_size
+        self._buffer = bytearray()
+        # Large body in progress: preallocated to its final size and filled in place
+        self._large = None
+        self._large_filled = 0
+
+    def feed(self, data):
+        """
+        Consume received bytes
+
+        :param data: bytes from the socket
+        :return: list of complete frame bodies (bytearray)
+        """
+        payloads = []
+        view = memoryview(data)
+
+        if self._large is not None:
+            view = self._fill_large(view, payloads)
+
+        self._buffer += view
+        offset = 0
+        buffered = len(self._buffer)
+
+        while buffered - offset >= HEADER.size:
+            (length,) = HEADER.unpack_from(self._buffer, offset)
+            if length > self.max_size:
+                raise ProtocolError(f"Peer announced a {length} byte message, limit is {self.max_size}")
+
+            start = offset + HEADER.size
+            if buffered - start >= length:
+                payloads.append(self._buffer[start:start + length])
+                offset = start + length
+                continue
+
+            if length >= LARGE_MESSAGE_SIZE:
+                # Move what we have into a buffer of the final size, the rest streams in via _fill_large
+                self._large = bytearray(length)
+                self._large_filled = buffered - start
+                self._large[:self._large_filled] = self._buffer[start:buffered]
+                offset = buffered
+            break
+
+        del self._buffer[:offset]
+        return payloads
+
+    def _fill_large(self, view, payloads):
+        """Copy bytes into the preallocated body, returns the bytes left over after it completes"""
+        needed = len(self._large) - self._large_filled
+        chunk = view[:needed]
+        self._large[self._large_filled:self._large_filled + len(chunk)] = chunk
+        self._large_filled += len(chunk)
+
+        if self._large_filled == len(self._large):
+            payloads.append(self._large)
+            self._large = None
+            self._large_filled = 0
+        return view[len(chunk):]
+
+    def pending(self):
+        """Number of bytes received that don't form a complete message yet"""
+        return len(self._buffer) + self._large_filled
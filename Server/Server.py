@@ -1,91 +1,233 @@
 import socket
+import hmac
+import time
 import threading
 import sqlite3
-import hashlib
 import uuid
 import json
-from FriendManager import FriendManager
+import asyncio
+import argparse
+import signal
+import functools
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from FriendManager import FriendManager, SUGGESTIONS
+from MessageManager import MessageManager, MAX_MESSAGE_LENGTH
+from LibraryManager import LibraryManager, LibraryConflict
+from GameMetadata import (MetadataService, RawgUpstream, FileUpstream, RAWG_URL, DEFAULT_RAWG_KEY,
+                          MAX_TITLE_LENGTH)
+from Covers import CoverStore
+from PlaytimeManager import PlaytimeManager, TOP_GAMES, LEADERBOARD, ranked
+from Library import MAX_FIELD_LENGTH
+from Database import ConnectionPool
+from Migrations import migrate, check_query_plans
+from WriteQueue import GroupCommitWriter
+from Admission import AdmissionController, AsyncAdmissionController, busy_response
+from Auth import PasswordHasher, DEFAULT_ITERATIONS
+from Sessions import SessionStore, DEFAULT_TTL, load_secret
+from Presence import PresenceService, ClusterPresence, Outbox
+from Supervisor import Supervisor
+from Metrics import Metrics, StatsDumper, take_db_time
+from ServerLog import setup_logging, parse_sample_rates, log_stats, LOG_MAX_BYTES, LOG_BACKUPS
+from Protocol import FrameDecoder, ProtocolError, encode_message, decode_message, RECV_SIZE
 import ssl
+import base64
+
+log = logging.getLogger('orderly.server')
+# One DEBUG record per request, sampled per request type, see ServerLog
+request_log = logging.getLogger('orderly.requests')
+
+# A client has this long to finish the TLS handshake, so a silent connection can't hold a thread
+HANDSHAKE_TIMEOUT = 10.0
+# How often expired sessions are dropped
+HOUSEKEEPING_INTERVAL = 60.0
+# How often the friend index is compared with the friends table, a whole-table read
+INDEX_CHECK_INTERVAL = 3600.0
+# user_search page sizes
+SEARCH_PAGE = 20
+MAX_SEARCH_PAGE = 50
+MAX_SEARCH_LENGTH = 64
+# friendlist actions counted separately in the stats
+FRIENDLIST_ACTIONS = ('get', 'add', 'remove', 'count', 'suggestions')
+# Most requests one batch may carry, a batch holds a single admission slot
+MAX_BATCH = 16
+# Sent on a connection that has been quiet for heartbeat_interval, clients answer {'type': 'pong'}
+PING = encode_message({'type': 'ping'})
+
+
+class ClientContext:
+    """Per-connection state shared by the request handlers of both serving modes"""
+
+    def __init__(self, address, transport):
+        self.address = address
+        self.transport = transport  # ssl socket (threaded mode) or StreamWriter (asyncio mode)
+        self.user = None
+        self.outbox = None  # push events waiting to be written, see Presence.Outbox
+        self.send_lock = threading.Lock()
+
+    def send(self, data):
+        """Write framed bytes to a threaded-mode socket, pipelined responses may come from any worker"""
+        with self.send_lock:
+            try:
+                self.transport.sendall(data)
+            except OSError:
+                # Part of a frame may have gone out, nothing more can be sent on this stream. Shutting
+                # it down also wakes the connection's read loop, which then cleans up
+                try:
+                    self.transport.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                raise
 
 
 class OrderlyServer:
-    def __init__(self, host='localhost', port=5000):
+    def __init__(self, host='localhost', port=5000, mode='threaded', db_workers=8,
+                 commit_batch=64, commit_delay=0.0, friend_index=False, backlog=128,
+                 max_connections=1024, max_in_flight=64, max_queued=256, queue_deadline=0.5,
+                 kdf_iterations=DEFAULT_ITERATIONS, auth_workers=None, session_ttl=DEFAULT_TTL,
+                 stats_token=None, stats_file=None, stats_interval=60.0, heartbeat_interval=30.0,
+                 idle_timeout=90.0, metadata_upstream=None, covers_dir='covers', cluster=None, worker_id=None):
         # VARIABLES
         self.static = None  # variable to prevent "function may be static"
         self.e = None  # variable to prevent "too broad exception clause"
+        self.host = host
+        self.port = port
+        self.mode = mode
+        self.worker_id = worker_id
+        # A quiet connection is pinged every heartbeat_interval and closed after idle_timeout
+        # without receiving anything, 0 disables either
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
+        self.idle_closed = 0
 
+        # Long-lived per-worker SQLite connections shared with FriendManager
+        self.db = ConnectionPool('orderly_users.db')
         self.init_database()
+        # Password KDF runs on its own process pool, off the GIL
+        self.hasher = PasswordHasher(iterations=kdf_iterations, workers=auth_workers)
+        # Signups and friend changes are group-committed by a single writer thread
+        self.writer = GroupCommitWriter('orderly_users.db', max_batch=commit_batch, max_delay=commit_delay)
+        # Session tokens let reconnecting clients skip the password check
+        self.sessions = SessionStore(self.db, self.writer, secret_path='session.key', ttl=session_ttl)
 
         # Socket setup
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if cluster is not None:
+            # Every worker process binds the same port, the kernel balances connections between them
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server.bind((host, port))
-        self.server.listen(5)
+        self.server.listen(backlog)
 
         # create SSL context
-        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        context.load_cert_chain(certfile='cert.pem', keyfile='key.pem')
+        self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.ssl_context.load_cert_chain(certfile='cert.pem', keyfile='key.pem')
 
-        # wrap it
-        self.server = context.wrap_socket(self.server, server_side=True)
-        print(f"SSL server started on {host}:{port}")
+        # wrap it, asyncio mode hands the raw socket and the context to the event loop instead
+        # The handshake runs on the client's thread, with a timeout, instead of in accept()
+        if self.mode == 'threaded':
+            self.server = self.ssl_context.wrap_socket(self.server, server_side=True,
+                                                       do_handshake_on_connect=False)
+        worker = f", worker {worker_id}" if cluster is not None else ""
+        log.info("SSL server started on %s:%s (%s mode%s)", host, port, mode, worker)
 
-        # Connected clients
-        self.clients = {}  # {user_id: (socket, username)}
+        # Bounded pool for handler work: every request in asyncio mode, pipelined requests in threaded mode
+        self.db_executor = ThreadPoolExecutor(max_workers=db_workers, thread_name_prefix='orderly-db')
 
-    def init_database(self):
-        """Initialize SQLite database for user management"""
-        self.static = None
-        with sqlite3.connect('orderly_users.db') as conn:
-            cursor = conn.cursor()
+        self.friend_manager = FriendManager(pool=self.db, writer=self.writer, index=friend_index)
+        self.message_manager = MessageManager(pool=self.db, writer=self.writer)
+        self.library_manager = LibraryManager(pool=self.db, writer=self.writer)
+        # Game metadata fetched once for all clients, from RAWG unless another upstream is given
+        self.metadata = MetadataService(metadata_upstream or RawgUpstream(DEFAULT_RAWG_KEY),
+                                        pool=self.db, writer=self.writer)
+        self.playtime_manager = PlaytimeManager(pool=self.db, writer=self.writer)
+        # Cover thumbnails made from the metadata's cover URLs, shared by every client
+        self.covers = CoverStore(self.metadata, covers_dir, pool=self.db, writer=self.writer)
 
-            # Create the `users` table with the correct schema
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id TEXT PRIMARY KEY,
-                    username TEXT UNIQUE NOT NULL,
-                    email TEXT UNIQUE NOT NULL,
-                    password_hash TEXT NOT NULL,
-                    salt TEXT NOT NULL
-                )
-            ''')
+        # Limits on connections and concurrent requests, past them clients get a fast busy response
+        admission_type = AsyncAdmissionController if self.mode == 'asyncio' else AdmissionController
+        self.admission = admission_type(max_connections=max_connections, max_in_flight=max_in_flight,
+                                        max_queued=max_queued, queue_deadline=queue_deadline)
 
-            # Create the `friends` table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS friends (
-                    user_id TEXT,
-                    friend_id TEXT,
-                    PRIMARY KEY (user_id, friend_id),
-                    FOREIGN KEY (user_id) REFERENCES users (id),
-                    FOREIGN KEY (friend_id) REFERENCES users (id)
-                )
-            ''')
-            cursor.execute('''
-                            CREATE TABLE IF NOT EXISTS messages (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            sender_id TEXT,
-                            receiver_id TEXT,
-                            message TEXT,
-                            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-                        );
-                        ''')
-
-            conn.commit()
-
-    def hash_password(self, password, salt=None):
+        # Online users and their connections, push events fan out through it. Worker processes
+        # share it through the supervisor, which also relays changes other workers cache
+        if cluster is not None:
+            self.presence = ClusterPresence(cluster, worker_id)
+            self.presence.listeners['friend_change'] = lambda change: self.friend_manager.apply_change(*change)
+            self.presence.listeners['session_revoked'] = self.sessions.forget_local
+        else:
+            self.presence = PresenceService()
+
+        # Per request type counters and latency histograms, served to operators holding the stats token
+        self.metrics = Metrics()
+        self.stats_token = stats_token
+        self.stats_dumper = None
+        if stats_file:
+            if cluster is not None:
+                root, extension = os.path.splitext(stats_file)
+                stats_file = f"{root}.{worker_id}{extension}"
+            self.stats_dumper = StatsDumper(self.dump_stats, stats_file, stats_interval)
+
+        # Route request to appropriate handler
+        self.handlers = {
+            'login': self.handle_login,
+            'resume': self.handle_resume,
+            'logout': self.handle_logout,
+            'signup': self.handle_signup,
+            'friendlist': self.handle_friendlist,
+            'user_info': self.handle_profile,
+            'user_search': self.handle_user_search,
+            'send_message': self.handle_send_message,
+            'message_history': self.handle_message_history,
+            'unread_count': self.handle_unread_count,
+            'library_sync': self.handle_library_sync,
+            'library': self.handle_library,
+            'game_metadata': self.handle_game_metadata,
+            'cover': self.handle_cover,
+            'play_session': self.handle_play_session,
+            'playtime': self.handle_playtime,
+            'top_games': self.handle_top_games,
+            'leaderboard': self.handle_leaderboard,
+            'batch': self.handle_batch,
+            'server_load': self.handle_server_load,
+            'server_stats': self.handle_server_stats,
+            'ping': self.handle_ping
+        }
+
+        # Drops expired sessions while the server runs
+        threading.Thread(target=self.run_housekeeping, name='orderly-housekeeping', daemon=True).start()
+
+    def init_database(self):
+        """Bring the database up to the current schema, see Migrations.py"""
         self.static = None
+        with self.db.connection() as conn:
+            for version, description in migrate(conn):
+                log.info("Applied migration %s: %s", version, description)
+            for name, _, problems in check_query_plans(conn):
+                if problems:
+                    log.warning("Query '%s' isn't served by an index: %s", name, '; '.join(problems))
+
+    def hash_password(self, password):
         """
         Create a secure hash for the password
 
+        The KDF runs on the auth process pool, the calling thread just waits for it.
+
         :param password: Plain text password
-        :param salt: Optional salt (generated if not provided)
         :return: (salt, hashed_password)
         """
-        if salt is None:
-            salt = uuid.uuid4().hex
+        return self.hasher.hash(password)
+
+    def upgrade_password_hash(self, user_id, password):
+        """Re-hash a password at the configured cost after a successful login, without delaying the login"""
+        salt, password_hash = self.hash_password(password)
+
+        def update(cursor):
+            cursor.execute('''
+                UPDATE users SET password_hash = ?, salt = ? WHERE id = ?
+            ''', (password_hash, salt, user_id))
 
-        # Hash password with salt using SHA-256
-        password_hash = hashlib.sha256((password + salt).encode()).hexdigest()
-        return salt, password_hash
+        self.writer.submit(update)
 
     def register_user(self, username, email, password):
         """
@@ -100,18 +242,19 @@ class OrderlyServer:
             user_id = uuid.uuid4().hex
             salt, password_hash = self.hash_password(password)
 
-            with sqlite3.connect('orderly_users.db') as conn:
-                cursor = conn.cursor()
+            def insert(cursor):
                 cursor.execute('''
-                    INSERT INTO users 
-                    (id, username, email, password_hash, salt) 
+                    INSERT INTO users
+                    (id, username, email, password_hash, salt)
                     VALUES (?, ?, ?, ?, ?)
                 ''', (user_id, username, email, password_hash, salt))
-                conn.commit()
+
+            # Committed together with whatever other signups and friend changes are queued
+            self.writer.execute(insert)
 
             return user_id
         except sqlite3.IntegrityError:
-            print(f"[!] Username or email already exists")
+            log.warning("Username or email already exists")
             return None
 
     def authenticate_user(self, email, password):
@@ -123,261 +266,1498 @@ class OrderlyServer:
         :return: User info or None
         """
         try:
-            with sqlite3.connect('orderly_users.db') as conn:
+            with self.db.connection() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
-                    SELECT id, email, password_hash, salt 
-                    FROM users 
+                    SELECT id, username, password_hash, salt
+                    FROM users
                     WHERE username = ?
                 ''', (email,))
                 user = cursor.fetchone()
 
-                if user:
-                    # Verify password
-                    _, provided_hash = self.hash_password(password, user[3])
-                    if provided_hash == user[2]:
-                        return {
-                            'id': user[0],
-                            'username': user[1]
-                        }
+            if user:
+                # Verify password
+                matches, needs_rehash = self.hasher.verify(password, user[3], user[2])
+                if matches:
+                    if needs_rehash:
+                        self.db_executor.submit(self.upgrade_password_hash, user[0], password)
+                    return {
+                        'id': user[0],
+                        'username': user[1]
+                    }
             return None
         except Exception as e:
-            print(f"[!] Authentication error: {e}")
+            log.error("Authentication error: %s", e)
             return None
 
-    def handle_client(self, client_socket, address):
-        """Handle client connection and requests"""
-        print(f"[+] Client connected from IP: {address[0]}")
-
-        # Initialize FriendManager
-        friend_manager = FriendManager()
-
-        def send_response(response_data):
-            """Helper function to send JSON responses"""
-            client_socket.send(json.dumps(response_data).encode('utf-8'))
+    def handle_login(self, login_request, client):
+        """Handle login requests"""
+        user = self.authenticate_user(login_request['email'], login_request['password'])
+        if user:
+            self.sign_in(client, user)
+            log.info("User '%s' logged in from IP: %s", user['username'], client.address[0])
+            return {
+                'type': 'auth_response',
+                'status': 'success',
+                'user': user,
+                'token': self.sessions.issue(user)
+            }
+        return {
+            'type': 'auth_response',
+            'status': 'failed',
+            'message': 'Invalid email or password.'
+        }
 
-        def handle_login(login_request):
-            """Handle login requests"""
-            user = self.authenticate_user(login_request['email'], login_request['password'])
-            if user:
-                self.clients[user['id']] = (client_socket, user['username'])
-                print(f"[+] User '{user['username']}' logged in from IP: {address[0]}")
-                return {
-                    'type': 'auth_response',
-                    'status': 'success',
-                    'user': user
-                }
+    def handle_resume(self, resume_request, client):
+        """Handle reconnects carrying a session token, no password verification or DB lookup"""
+        user = self.sessions.resume(resume_request.get('token'))
+        if user:
+            self.sign_in(client, user)
+            log.info("User '%s' resumed a session from IP: %s", user['username'], client.address[0])
             return {
                 'type': 'auth_response',
-                'status': 'failed',
-                'message': 'Invalid email or password.'
+                'status': 'success',
+                'user': user,
+                'token': resume_request['token']
             }
+        return {
+            'type': 'auth_response',
+            'status': 'failed',
+            'message': 'Session expired, please log in again.'
+        }
 
-        def handle_signup(signup_request):
-            """Handle signup requests"""
-            success = self.register_user(
-                signup_request['username'],
-                signup_request['email'],
-                signup_request['password']
-            )
-            if success:
-                return {
-                    'type': 'signup_response',
-                    'status': 'success',
-                    'message': 'Signup successful!'
-                }
+    def handle_logout(self, logout_request, client):
+        """End the session behind a token"""
+        token = logout_request.get('token')
+        if token:
+            session_id = self.sessions.revoke(token)
+            if session_id:
+                self.presence.broadcast('session_revoked', session_id)
+        self.sign_out(client)
+        return {
+            'type': 'logout_response',
+            'status': 'success'
+        }
+
+    def sign_in(self, client, user):
+        """Attach an authenticated user to the connection and tell their friends they are online"""
+        if client.user is not None:
+            if client.user['id'] == user['id']:
+                return
+            self.sign_out(client)
+
+        client.user = user
+        if client.outbox is None:
+            # Threaded mode: push events get their own sender thread once the client signs in
+            client.outbox = Outbox()
+            threading.Thread(target=self.run_outbox_sender, args=(client,), daemon=True).start()
+
+        if self.presence.connect(client):
+            self.presence.announce(user, self.friend_manager.get_followers(user['id']), online=True)
+
+    def sign_out(self, client):
+        """Detach the user from the connection, announcing them offline if it was their last one"""
+        user = client.user
+        if user is None:
+            return
+        client.user = None
+
+        if self.presence.disconnect(client, user['id']):
+            self.presence.announce(user, self.friend_manager.get_followers(user['id']), online=False)
+
+    def publish_friend_change(self, event, user_id, friend_id, client):
+        """Push a friend list change to both users' other connections so nobody has to poll"""
+        self.presence.publish([user_id, friend_id], {
+            'type': 'event',
+            'event': event,
+            'user_id': user_id,
+            'friend_id': friend_id
+        }, exclude=client)
+        if self.friend_manager.graph is not None:
+            # Other worker processes keep their own index
+            self.presence.broadcast('friend_change', ('add' if event == 'friend_added' else 'remove',
+                                                      user_id, friend_id))
+
+    def handle_signup(self, signup_request, client):
+        """Handle signup requests"""
+        self.static = None
+        success = self.register_user(
+            signup_request['username'],
+            signup_request['email'],
+            signup_request['password']
+        )
+        if success:
             return {
                 'type': 'signup_response',
+                'status': 'success',
+                'message': 'Signup successful!'
+            }
+        return {
+            'type': 'signup_response',
+            'status': 'failed',
+            'message': 'Username or email already exists.'
+        }
+
+    def handle_friendlist(self, friendlist_request, client):
+        """Handle friendlist operations using FriendManager"""
+        self.static = None
+        friend_manager = self.friend_manager
+
+        if client.user is None:
+            return {
+                'type': 'friendlist_response',
                 'status': 'failed',
-                'message': 'Username or email already exists.'
+                'message': 'Not logged in.'
             }
 
-        def handle_friendlist(friendlist_request):
-            """Handle friendlist operations using FriendManager"""
-            user_id = friendlist_request.get('user_id')
-            action = friendlist_request.get('action')
-            friend_id = friendlist_request.get('friend_id')
+        action = friendlist_request.get('action')
+        friend_id = friendlist_request.get('friend_id')
+        # Friend counts are shown on any user's profile, everything else is the signed-in user's own list
+        user_id = client.user['id']
+        if action == 'count':
+            user_id = friendlist_request.get('user_id') or user_id
+
+        if not action:
+            return {
+                'type': 'friendlist_response',
+                'status': 'failed',
+                'message': 'Missing required parameters.'
+            }
 
-            if not user_id or not action:
+        try:
+            if action == 'get':
+                friends = friend_manager.get_friends(user_id)
+                for friend in friends:
+                    friend['online'] = self.presence.is_online(friend['id'])
                 return {
                     'type': 'friendlist_response',
-                    'status': 'failed',
-                    'message': 'Missing required parameters.'
+                    'status': 'success',
+                    'friends': friends
                 }
 
-            try:
-                if action == 'get':
-                    friends = friend_manager.get_friends(user_id)
+            elif action == 'add':
+                if not friend_id:
                     return {
                         'type': 'friendlist_response',
-                        'status': 'success',
-                        'friends': friends
+                        'status': 'failed',
+                        'message': 'Friend ID required for adding friend.'
                     }
-
-                elif action == 'add':
-                    if not friend_id:
-                        return {
-                            'type': 'friendlist_response',
-                            'status': 'failed',
-                            'message': 'Friend ID required for adding friend.'
-                        }
-
-                    success, message = friend_manager.add_friend(user_id, friend_id)
+                if friend_id == user_id:
                     return {
                         'type': 'friendlist_response',
-                        'status': 'success' if success else 'failed',
-                        'message': message
+                        'status': 'failed',
+                        'message': "You can't add yourself as a friend."
                     }
 
-                elif action == 'remove':
-                    if not friend_id:
-                        return {
-                            'type': 'friendlist_response',
-                            'status': 'failed',
-                            'message': 'Friend ID required for removing friend.'
-                        }
+                success, message = friend_manager.add_friend(user_id, friend_id)
+                if success:
+                    self.publish_friend_change('friend_added', user_id, friend_id, client)
+                return {
+                    'type': 'friendlist_response',
+                    'status': 'success' if success else 'failed',
+                    'message': message
+                }
 
-                    success, message = friend_manager.remove_friend(user_id, friend_id)
+            elif action == 'remove':
+                if not friend_id:
                     return {
                         'type': 'friendlist_response',
-                        'status': 'success' if success else 'failed',
-                        'message': message
+                        'status': 'failed',
+                        'message': 'Friend ID required for removing friend.'
                     }
-                elif action == 'count':
-                    count = friend_manager.get_friends_count(user_id)
+
+                success, message = friend_manager.remove_friend(user_id, friend_id)
+                if success:
+                    self.publish_friend_change('friend_removed', user_id, friend_id, client)
+                return {
+                    'type': 'friendlist_response',
+                    'status': 'success' if success else 'failed',
+                    'message': message
+                }
+            elif action == 'count':
+                count = friend_manager.get_friends_count(user_id)
+                return {
+                    'type': 'friendlist_response',
+                    'status': 'success',
+                    'message': str(count)
+                }
+            elif action == 'suggestions':
+                try:
+                    suggestions = friend_manager.get_suggestions(user_id,
+                                                                 friendlist_request.get('limit', SUGGESTIONS))
+                except (TypeError, ValueError):
                     return {
                         'type': 'friendlist_response',
-                        'status': 'success',
-                        'message': str(count)
+                        'status': 'failed',
+                        'message': 'Invalid suggestion limit.'
                     }
-
+                for suggestion in suggestions:
+                    suggestion['online'] = self.presence.is_online(suggestion['id'])
                 return {
                     'type': 'friendlist_response',
-                    'status': 'failed',
-                    'message': f"Invalid action '{action}'. Expected 'get', 'add', 'remove', or 'count'."
+                    'status': 'success',
+                    'suggestions': suggestions
                 }
 
-            except Exception as error:
-                print(f"[!] Error in friend operation: {error}")
+            return {
+                'type': 'friendlist_response',
+                'status': 'failed',
+                'message': f"Invalid action '{action}'. Expected 'get', 'add', 'remove', 'count' or 'suggestions'."
+            }
+
+        except Exception as error:
+            log.error("Error in friend operation: %s", error)
+            return {
+                'type': 'friendlist_response',
+                'status': 'failed',
+                'message': 'An error occurred while processing your request.'
+            }
+
+    def handle_profile(self, profile_request, client):
+        """Handle profile requests by fetching user details from the database."""
+        self.static = None
+        user_id = profile_request.get('user_id')
+        if not user_id:
+            return {
+                'type': 'user_info_response',
+                'status': 'failed',
+                'message': 'User ID is required.'
+            }
+
+        try:
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT id, username FROM users WHERE id = ?
+                ''', (user_id,))
+                user = cursor.fetchone()
+
+                if user:
+                    return {
+                        'type': 'user_info_response',
+                        'status': 'success',
+                        'user': {
+                            'id': user[0],
+                            'username': user[1]
+                        }
+                    }
+                else:
+                    return {
+                        'type': 'user_info_response',
+                        'status': 'failed',
+                        'message': 'User not found.'
+                    }
+        except Exception as error:
+            log.error("Error fetching user profile: %s", error)
+            return {
+                'type': 'user_info_response',
+                'status': 'failed',
+                'message': 'Internal server error.'
+            }
+
+    def search_users(self, prefix, after=None, limit=SEARCH_PAGE):
+        """
+        Users whose username starts with prefix, ignoring ASCII case, in username order
+
+        A seek into the case-insensitive username index (see Migrations.py), the page starts
+        right after the cursor instead of skipping the pages before it.
+
+        :param after: cursor from the previous page, None for the first one
+        :return: (users, cursor for the next page or None when there is none)
+        """
+        limit = max(1, min(int(limit), MAX_SEARCH_PAGE))
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+            # U+10FFFF sorts after every character, so it bounds the names starting with prefix
+            cursor.execute('''
+                SELECT id, username
+                FROM users
+                WHERE username >= ?1 COLLATE NOCASE AND username < ?2 COLLATE NOCASE
+                  AND (username COLLATE NOCASE > ?1 OR username > ?3)
+                ORDER BY username COLLATE NOCASE, username
+                LIMIT ?4
+            ''', (after or prefix, prefix + '\U0010ffff', after or '', limit + 1))
+            rows = cursor.fetchall()
+
+        # One row past the page tells whether there is another one
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = rows[-1][1]
+        return [{'id': row[0], 'username': row[1]} for row in rows], next_cursor
+
+    def handle_user_search(self, search_request, client):
+        """Find users by username prefix, a page at a time"""
+        query = search_request.get('query')
+        after = search_request.get('cursor')
+        if not isinstance(query, str) or not query.strip() or len(query) > MAX_SEARCH_LENGTH:
+            return {
+                'type': 'user_search_response',
+                'status': 'failed',
+                'message': f"A search query of 1 to {MAX_SEARCH_LENGTH} characters is required."
+            }
+        query = query.strip()
+        if after is not None and (not isinstance(after, str) or not after.lower().startswith(query.lower())):
+            return {
+                'type': 'user_search_response',
+                'status': 'failed',
+                'message': 'Invalid paging cursor.'
+            }
+
+        try:
+            users, next_cursor = self.search_users(query, after, search_request.get('limit', SEARCH_PAGE))
+        except (TypeError, ValueError):
+            return {
+                'type': 'user_search_response',
+                'status': 'failed',
+                'message': 'Invalid page size.'
+            }
+        except Exception as error:
+            log.error("Error searching users: %s", error)
+            return {
+                'type': 'user_search_response',
+                'status': 'failed',
+                'message': 'Internal server error.'
+            }
+
+        for user in users:
+            user['online'] = self.presence.is_online(user['id'])
+        return {
+            'type': 'user_search_response',
+            'status': 'success',
+            'users': users,
+            'next_cursor': next_cursor
+        }
+
+    def handle_send_message(self, message_request, client):
+        """Store a direct message from the signed-in user and push it to the receiver"""
+        if client.user is None:
+            return {
+                'type': 'send_message_response',
+                'status': 'failed',
+                'message': 'Not logged in.'
+            }
+
+        receiver_id = message_request.get('receiver_id')
+        text = message_request.get('message')
+        if not receiver_id or not isinstance(text, str) or not text.strip():
+            return {
+                'type': 'send_message_response',
+                'status': 'failed',
+                'message': 'Receiver ID and message text are required.'
+            }
+        if len(text) > MAX_MESSAGE_LENGTH:
+            return {
+                'type': 'send_message_response',
+                'status': 'failed',
+                'message': f"Messages are limited to {MAX_MESSAGE_LENGTH} characters."
+            }
+
+        try:
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT 1 FROM users WHERE id = ?", (receiver_id,))
+                if cursor.fetchone() is None:
+                    return {
+                        'type': 'send_message_response',
+                        'status': 'failed',
+                        'message': 'User not found.'
+                    }
+
+            stored = self.message_manager.send(client.user['id'], receiver_id, text)
+        except Exception as error:
+            log.error("Error sending message: %s", error)
+            return {
+                'type': 'send_message_response',
+                'status': 'failed',
+                'message': 'Internal server error.'
+            }
+
+        # The sender's other connections get it too, so every open window shows the conversation
+        self.presence.publish([receiver_id, client.user['id']], {
+            'type': 'event',
+            'event': 'message',
+            'data': stored
+        }, exclude=client)
+        return {
+            'type': 'send_message_response',
+            'status': 'success',
+            'data': stored
+        }
+
+    def handle_message_history(self, history_request, client):
+        """Return one page of the conversation with a peer, newest first"""
+        if client.user is None:
+            return {
+                'type': 'message_history_response',
+                'status': 'failed',
+                'message': 'Not logged in.'
+            }
+
+        peer_id = history_request.get('peer_id')
+        if not peer_id:
+            return {
+                'type': 'message_history_response',
+                'status': 'failed',
+                'message': 'Peer ID is required.'
+            }
+
+        user_id = client.user['id']
+        before = history_request.get('before')
+        try:
+            messages, next_cursor = self.message_manager.get_history(
+                user_id, peer_id, before=before, limit=history_request.get('limit', 50))
+        except (TypeError, ValueError):
+            return {
+                'type': 'message_history_response',
+                'status': 'failed',
+                'message': 'Invalid paging cursor.'
+            }
+        except Exception as error:
+            log.error("Error fetching message history: %s", error)
+            return {
+                'type': 'message_history_response',
+                'status': 'failed',
+                'message': 'Internal server error.'
+            }
+
+        if before is None:
+            # Opening a conversation reads it
+            self.message_manager.mark_read(user_id, peer_id)
+        return {
+            'type': 'message_history_response',
+            'status': 'success',
+            'messages': messages,
+            'next_cursor': next_cursor
+        }
+
+    def handle_unread_count(self, unread_request, client):
+        """Return the signed-in user's unread messages, per sender and in total"""
+        if client.user is None:
+            return {
+                'type': 'unread_count_response',
+                'status': 'failed',
+                'message': 'Not logged in.'
+            }
+
+        try:
+            counts = self.message_manager.get_unread_counts(client.user['id'])
+        except Exception as error:
+            log.error("Error counting unread messages: %s", error)
+            return {
+                'type': 'unread_count_response',
+                'status': 'failed',
+                'message': 'Internal server error.'
+            }
+        return {
+            'type': 'unread_count_response',
+            'status': 'success',
+            'total': sum(counts.values()),
+            'senders': counts
+        }
+
+    def handle_library_sync(self, sync_request, client):
+        """
+        Store the signed-in user's game library, see LibraryManager
+
+        The client sends the version it synced last as 'base' and only the games that changed
+        since, or 'base' None and the whole library. A 'resync' status means the stored library
+        isn't what the diff was made against and the whole library has to be sent.
+        """
+        if client.user is None:
+            return {
+                'type': 'library_sync_response',
+                'status': 'failed',
+                'message': 'Not logged in.'
+            }
+
+        base = sync_request.get('base')
+        version = sync_request.get('version')
+        added = sync_request.get('added', [])
+        changed = sync_request.get('changed', [])
+        removed = sync_request.get('removed', [])
+        if not isinstance(version, str) or not all(isinstance(part, list) for part in (added, changed, removed)):
+            return {
+                'type': 'library_sync_response',
+                'status': 'failed',
+                'message': 'Library version and game lists are required.'
+            }
+
+        try:
+            version = self.library_manager.sync(client.user['id'], base, version, added, changed, removed)
+        except LibraryConflict as conflict:
+            return {
+                'type': 'library_sync_response',
+                'status': 'resync',
+                'version': conflict.version
+            }
+        except ValueError as error:
+            return {
+                'type': 'library_sync_response',
+                'status': 'failed',
+                'message': f"Invalid library: {error}"
+            }
+        except Exception as error:
+            log.error("Error syncing library: %s", error)
+            return {
+                'type': 'library_sync_response',
+                'status': 'failed',
+                'message': 'Internal server error.'
+            }
+        return {
+            'type': 'library_sync_response',
+            'status': 'success',
+            'version': version
+        }
+
+    def handle_library(self, library_request, client):
+        """
+        A user's synced library, for themselves or a user who has them as a friend
+
+        A viewer that sends the version it already has gets 'unchanged' instead of the games.
+        """
+        if client.user is None:
+            return {
+                'type': 'library_response',
+                'status': 'failed',
+                'message': 'Not logged in.'
+            }
+
+        user_id = library_request.get('user_id') or client.user['id']
+        if user_id != client.user['id'] and not self.friend_manager.are_friends(client.user['id'], user_id):
+            return {
+                'type': 'library_response',
+                'status': 'failed',
+                'message': 'Only the libraries of your friends can be viewed.'
+            }
+
+        try:
+            known = library_request.get('version')
+            if known is not None and self.library_manager.get_version(user_id)[0] == known:
                 return {
-                    'type': 'friendlist_response',
-                    'status': 'failed',
-                    'message': 'An error occurred while processing your request.'
+                    'type': 'library_response',
+                    'status': 'success',
+                    'user_id': user_id,
+                    'version': known,
+                    'unchanged': True
                 }
+            version, games = self.library_manager.get_library(user_id)
+        except Exception as error:
+            log.error("Error fetching library: %s", error)
+            return {
+                'type': 'library_response',
+                'status': 'failed',
+                'message': 'Internal server error.'
+            }
+        return {
+            'type': 'library_response',
+            'status': 'success',
+            'user_id': user_id,
+            'version': version,
+            'games': games
+        }
+
+    def handle_game_metadata(self, metadata_request, client):
+        """Description, cover and other details of a game by title, see GameMetadata"""
+        if client.user is None:
+            return {
+                'type': 'game_metadata_response',
+                'status': 'failed',
+                'message': 'Not logged in.'
+            }
 
-        def handle_profile(profile_request):
-            """Handle profile requests by fetching user details from the database."""
-            user_id = profile_request.get('user_id')
-            if not user_id:
+        title = metadata_request.get('title')
+        if not isinstance(title, str) or not title.strip() or len(title) > MAX_TITLE_LENGTH:
+            return {
+                'type': 'game_metadata_response',
+                'status': 'failed',
+                'message': f"A game title of at most {MAX_TITLE_LENGTH} characters is required."
+            }
+
+        try:
+            metadata, cached = self.metadata.get(title)
+        except Exception as error:
+            log.error("Error fetching metadata for %r: %s", title, error)
+            return {
+                'type': 'game_metadata_response',
+                'status': 'failed',
+                'message': 'Game metadata is unavailable right now.'
+            }
+        return {
+            'type': 'game_metadata_response',
+            'status': 'success',
+            'title': title,
+            'metadata': metadata,
+            'cached': cached
+        }
+
+    def handle_cover(self, cover_request, client):
+        """
+        A game's cover as a small JPEG thumbnail, see Covers
+
+        A client that sends the 'etag' of the thumbnail it has gets 'not_modified' instead of the image.
+        """
+        if client.user is None:
+            return {
+                'type': 'cover_response',
+                'status': 'failed',
+                'message': 'Not logged in.'
+            }
+
+        title = cover_request.get('title')
+        if not isinstance(title, str) or not title.strip() or len(title) > MAX_TITLE_LENGTH:
+            return {
+                'type': 'cover_response',
+                'status': 'failed',
+                'message': f"A game title of at most {MAX_TITLE_LENGTH} characters is required."
+            }
+
+        try:
+            etag = self.covers.get(title)
+            if etag is None:
                 return {
-                    'type': 'user_info_response',
+                    'type': 'cover_response',
                     'status': 'failed',
-                    'message': 'User ID is required.'
+                    'message': 'No cover available.'
                 }
-
-            try:
-                with sqlite3.connect('orderly_users.db') as conn:
-                    cursor = conn.cursor()
-                    cursor.execute('''
-                        SELECT id, username FROM users WHERE id = ?
-                    ''', (user_id,))
-                    user = cursor.fetchone()
-
-                    if user:
-                        return {
-                            'type': 'user_info_response',
-                            'status': 'success',
-                            'user': {
-                                'id': user[0],
-                                'username': user[1]
-                            }
-                        }
-                    else:
-                        return {
-                            'type': 'user_info_response',
-                            'status': 'failed',
-                            'message': 'User not found.'
-                        }
-            except Exception as error:
-                print(f"[!] Error fetching user profile: {error}")
+            if cover_request.get('etag') == etag:
                 return {
-                    'type': 'user_info_response',
+                    'type': 'cover_response',
+                    'status': 'success',
+                    'etag': etag,
+                    'not_modified': True
+                }
+            image = self.covers.read(etag)
+        except Exception as error:
+            log.error("Error making cover for %r: %s", title, error)
+            return {
+                'type': 'cover_response',
+                'status': 'failed',
+                'message': 'Cover is unavailable right now.'
+            }
+        return {
+            'type': 'cover_response',
+            'status': 'success',
+            'etag': etag,
+            'image': base64.b64encode(image).decode('ascii')
+        }
+
+    def handle_play_session(self, session_request, client):
+        """
+        A game launched ('start') or closed ('stop') on the client, see PlaytimeManager
+
+        Reports are queued for the writer and answered right away, times are the server's.
+        """
+        if client.user is None:
+            return {
+                'type': 'play_session_response',
+                'status': 'failed',
+                'message': 'Not logged in.'
+            }
+
+        event = session_request.get('event')
+        session_id = session_request.get('session_id')
+        game = session_request.get('game')
+        if event not in ('start', 'stop') or not isinstance(session_id, str) or not 0 < len(session_id) <= 64:
+            return {
+                'type': 'play_session_response',
+                'status': 'failed',
+                'message': "A session ID and an event of 'start' or 'stop' are required."
+            }
+        if event == 'start' and (not isinstance(game, str) or not game or len(game) > MAX_FIELD_LENGTH):
+            return {
+                'type': 'play_session_response',
+                'status': 'failed',
+                'message': 'A game name is required to start a session.'
+            }
+
+        if event == 'start':
+            self.playtime_manager.start(client.user['id'], session_id, game)
+        else:
+            self.playtime_manager.stop(client.user['id'], session_id)
+        return {
+            'type': 'play_session_response',
+            'status': 'success'
+        }
+
+    def handle_playtime(self, playtime_request, client):
+        """
+        Time a user played each game in total and in the last week, for themselves or a user
+        who has them as a friend. With a 'game', also its hour by hour playtime of the last day.
+        """
+        if client.user is None:
+            return {
+                'type': 'playtime_response',
+                'status': 'failed',
+                'message': 'Not logged in.'
+            }
+
+        user_id = playtime_request.get('user_id') or client.user['id']
+        if user_id != client.user['id'] and not self.friend_manager.are_friends(client.user['id'], user_id):
+            return {
+                'type': 'playtime_response',
+                'status': 'failed',
+                'message': 'Only the playtime of your friends can be viewed.'
+            }
+
+        game = playtime_request.get('game')
+        try:
+            response = {
+                'type': 'playtime_response',
+                'status': 'success',
+                'user_id': user_id,
+                'games': self.playtime_manager.get_totals(user_id),
+                'week': self.playtime_manager.get_recent(user_id)
+            }
+            if isinstance(game, str):
+                response['game'] = game
+                response['hours'] = self.playtime_manager.get_hours(user_id, game)
+        except Exception as error:
+            log.error("Error fetching playtime: %s", error)
+            return {
+                'type': 'playtime_response',
+                'status': 'failed',
+                'message': 'Internal server error.'
+            }
+        return response
+
+    def handle_top_games(self, top_request, client):
+        """Games everyone played most this week"""
+        if client.user is None:
+            return {
+                'type': 'top_games_response',
+                'status': 'failed',
+                'message': 'Not logged in.'
+            }
+
+        try:
+            games = self.playtime_manager.top_games(top_request.get('limit', TOP_GAMES))
+        except (TypeError, ValueError):
+            return {
+                'type': 'top_games_response',
+                'status': 'failed',
+                'message': 'Invalid limit.'
+            }
+        except Exception as error:
+            log.error("Error fetching top games: %s", error)
+            return {
+                'type': 'top_games_response',
+                'status': 'failed',
+                'message': 'Internal server error.'
+            }
+        return {
+            'type': 'top_games_response',
+            'status': 'success',
+            'games': games
+        }
+
+    def handle_leaderboard(self, leaderboard_request, client):
+        """
+        Who played a game longest, among the user and their friends ('friends', the default)
+        or everyone ('global'), with the user's own rank
+        """
+        if client.user is None:
+            return {
+                'type': 'leaderboard_response',
+                'status': 'failed',
+                'message': 'Not logged in.'
+            }
+
+        game = leaderboard_request.get('game')
+        scope = leaderboard_request.get('scope', 'friends')
+        if not isinstance(game, str) or not game or scope not in ('friends', 'global'):
+            return {
+                'type': 'leaderboard_response',
+                'status': 'failed',
+                'message': "A game and a scope of 'friends' or 'global' are required."
+            }
+
+        user_id = client.user['id']
+        try:
+            if scope == 'friends':
+                # Friends from the friend index when it is loaded, their scores by primary key
+                players = {friend['id']: friend['username'] for friend in self.friend_manager.get_friends(user_id)}
+                players[user_id] = client.user['username']
+                scores = self.playtime_manager.get_scores(players, game)
+                entries = ranked({'id': player_id, 'username': players[player_id], 'seconds': seconds}
+                                 for player_id, seconds in scores.items())
+                rank = next((entry['rank'] for entry in entries if entry['id'] == user_id), None)
+            else:
+                limit = leaderboard_request.get('limit', LEADERBOARD)
+                entries = ranked(self.playtime_manager.top_players(game, limit))
+                mine = self.playtime_manager.get_scores([user_id], game).get(user_id)
+                rank = self.playtime_manager.rank_of(game, mine) if mine is not None else None
+        except (TypeError, ValueError):
+            return {
+                'type': 'leaderboard_response',
+                'status': 'failed',
+                'message': 'Invalid limit.'
+            }
+        except Exception as error:
+            log.error("Error building leaderboard: %s", error)
+            return {
+                'type': 'leaderboard_response',
+                'status': 'failed',
+                'message': 'Internal server error.'
+            }
+        return {
+            'type': 'leaderboard_response',
+            'status': 'success',
+            'game': game,
+            'scope': scope,
+            'entries': entries,
+            'rank': rank
+        }
+
+    def handle_batch(self, batch_request, client):
+        """
+        Several requests in one message, answered with one message
+
+        A page that needs several requests pays one round trip, one decode and one encode.
+        The requests run in order on this thread, sharing its pooled connection and prepared
+        statements, a login earlier in the batch counts for the requests after it. A failing
+        request doesn't stop the others. Each is recorded in the metrics under its own type,
+        so the batch's own entry counts its total time but not its DB time.
+        """
+        requests = batch_request.get('requests')
+        if not isinstance(requests, list) or not requests or len(requests) > MAX_BATCH:
+            return {
+                'type': 'batch_response',
+                'status': 'failed',
+                'message': f"A batch carries between 1 and {MAX_BATCH} requests."
+            }
+
+        responses = []
+        for request in requests:
+            if not isinstance(request, dict) or request.get('type') == 'batch':
+                response = {
+                    'type': 'error_response',
+                    'status': 'failed',
+                    'message': 'Batched requests must be request objects other than batch.'
+                }
+            elif request.get('type') not in self.handlers:
+                response = {
+                    'type': 'error_response',
                     'status': 'failed',
-                    'message': 'Internal server error.'
+                    'message': f"Unknown request type: {request.get('type')}"
                 }
+            else:
+                response = self.handle_request(request, client)
+            responses.append(response)
+        return {
+            'type': 'batch_response',
+            'status': 'success',
+            'responses': responses
+        }
+
+    def handle_ping(self, ping_request, client):
+        """Client-side heartbeat"""
+        self.static = None
+        return {
+            'type': 'pong',
+            'status': 'success'
+        }
+
+    def handle_server_load(self, load_request, client):
+        """Report connection and request queue depth against the admission limits"""
+        self.static = None
+        return {
+            'type': 'server_load_response',
+            'status': 'success',
+            'load': self.admission.snapshot()
+        }
+
+    def stats_snapshot(self):
+        """Request metrics together with the state of the server's queues and caches"""
+        snapshot = self.metrics.snapshot()
+        snapshot.update({
+            'load': self.admission.snapshot(),
+            'writer': self.writer.stats(),
+            'db_connections': self.db.size(),
+            'sessions': self.sessions.count(),
+            'metadata': self.metadata.stats(),
+            'covers': self.covers.stats(),
+            'online_users': self.presence.online_count(),
+            'idle_closed': self.idle_closed,
+            'log': log_stats(),
+            'worker': self.worker_id
+        })
+        return snapshot
+
+    def dump_stats(self, path):
+        """Write stats_snapshot() to a file, see --stats-file"""
+        self.metrics.dump(path, self.stats_snapshot())
+
+    def handle_server_stats(self, stats_request, client):
+        """Report per request type counts, errors and latency histograms to holders of the stats token"""
+        token = stats_request.get('stats_token')
+        if not self.stats_token or not isinstance(token, str) or \
+                not hmac.compare_digest(token.encode(), self.stats_token.encode()):
+            return {
+                'type': 'server_stats_response',
+                'status': 'failed',
+                'message': 'Not authorized.'
+            }
+        return {
+            'type': 'server_stats_response',
+            'status': 'success',
+            'stats': self.stats_snapshot()
+        }
+
+    def metric_key(self, request):
+        """Name requests are counted under: the request type, split by action for friend list requests"""
+        if not isinstance(request, dict) or request.get('type') not in self.handlers:
+            return 'pong' if self.is_pong(request) else 'unknown'
+        if request['type'] == 'friendlist' and request.get('action') in FRIENDLIST_ACTIONS:
+            return f"friendlist.{request['action']}"
+        return request['type']
+
+    def decode_request(self, payload):
+        """decode_message() timed into the request type's serialization stats"""
+        started = time.perf_counter()
+        request = decode_message(payload)
+        self.metrics.record_serialization(self.metric_key(request), 'decode', time.perf_counter() - started)
+        return request
+
+    def encode_response(self, request, response):
+        """encode_message() timed into the request type's serialization stats"""
+        started = time.perf_counter()
+        data = encode_message(response)
+        self.metrics.record_serialization(self.metric_key(request), 'encode', time.perf_counter() - started)
+        return data
+
+    def dispatch(self, request, client):
+        """Route a decoded request to its handler and return the response dict"""
+        if not isinstance(request, dict):
+            return {
+                'type': 'error_response',
+                'status': 'failed',
+                'message': 'A request must be a JSON object.'
+            }
+        handler = self.handlers.get(request.get('type'))
+
+        if handler:
+            return handler(request, client)
+        return {
+            'type': 'error_response',
+            'status': 'failed',
+            'message': f"Unknown request type: {request.get('type')}"
+        }
+
+    def handle_request(self, request, client):
+        """Run a decoded request and tag the response with the request's correlation id, if any"""
+        started = time.perf_counter()
+        take_db_time()
+        error = False
+        try:
+            response = self.dispatch(request, client)
+        except Exception:
+            log.exception("Error handling %s request", self.metric_key(request))
+            error = True
+            response = {
+                'type': 'error_response',
+                'status': 'failed',
+                'message': 'Internal server error'
+            }
+        key = self.metric_key(request)
+        elapsed = time.perf_counter() - started
+        self.metrics.record(key, elapsed, take_db_time(), failed=response.get('status') == 'failed', error=error)
+        if request_log.isEnabledFor(logging.DEBUG):
+            request_log.debug("request", extra={'fields': {
+                'request': key,
+                'status': response.get('status'),
+                'user': client.user['id'] if client.user else None,
+                'ms': round(elapsed * 1000, 3)
+            }})
+
+        if isinstance(request, dict) and 'id' in request:
+            response['id'] = request['id']
+        return response
+
+    def is_metered(self, request):
+        """Whether a request has to pass admission control, load and stats reports must get through a saturated server"""
+        self.static = None
+        return not (isinstance(request, dict) and request.get('type') in ('server_load', 'server_stats', 'ping'))
+
+    def busy_response(self, request):
+        response = busy_response(self.admission.queue_deadline)
+        if self.is_pipelined(request):
+            response['id'] = request['id']
+        return response
+
+    def handle_admitted(self, request, client):
+        """Run a request that already holds an admission slot, then free the slot"""
+        try:
+            return self.handle_request(request, client)
+        finally:
+            self.admission.release()
+
+    def invalid_json_response(self):
+        self.static = None
+        return {
+            'type': 'error_response',
+            'status': 'failed',
+            'message': 'Invalid JSON format'
+        }
+
+    @staticmethod
+    def is_pong(request):
+        """Heartbeat answers only show the connection is alive, they get no response"""
+        return isinstance(request, dict) and request.get('type') == 'pong'
+
+    def poll_interval(self):
+        """How long a read may block before the connection is checked for idleness, None to block forever"""
+        return self.heartbeat_interval or self.idle_timeout or None
+
+    def check_idle(self, client, idle):
+        """
+        Called when a read timed out
+
+        :return: True if the connection has been quiet too long and should be closed, otherwise
+                 it gets pinged if heartbeats are on
+        """
+        if self.idle_timeout and idle >= self.idle_timeout:
+            self.idle_closed += 1
+            log.warning("Closing connection from %s, idle for %.0fs", client.address[0], idle)
+            return True
+        return False
+
+    @staticmethod
+    def is_pipelined(request):
+        """Requests carrying an 'id' may be answered out of order, the rest keep strict request/response order"""
+        return isinstance(request, dict) and 'id' in request
+
+    def protocol_error_response(self, error):
+        """Response sent right before dropping a connection whose framing can't be recovered"""
+        self.static = None
+        log.warning("Protocol error: %s", error)
+        return {
+            'type': 'error_response',
+            'status': 'failed',
+            'message': 'Malformed message frame'
+        }
+
+    def handle_client(self, client_socket, address):
+        """Handle client connection and requests, whatever ends it the connection's state is released"""
+        client = ClientContext(address, client_socket)
+        try:
+            client_socket.settimeout(HANDSHAKE_TIMEOUT)
+            client_socket.do_handshake()
+            log.info("Client connected from IP: %s", address[0])
+            # Reads wake up periodically to ping or reap a quiet client, sends to a client that
+            # stopped reading fail instead of blocking forever
+            client_socket.settimeout(self.poll_interval())
+            self.serve_client(client)
+        except ProtocolError as e:
+            try:
+                client.send(encode_message(self.protocol_error_response(e)))
+            except (ConnectionError, ssl.SSLError, OSError):
+                pass
+        except (ConnectionError, ssl.SSLError, OSError) as e:
+            log.warning("Connection from %s lost: %s", address[0], e)
+        finally:
+            self.close_client(client)
+            client_socket.close()
+            self.db.release()
+            self.admission.close_connection()
+
+    def serve_client(self, client):
+        """Threaded mode request loop, returns when the client disconnects or idles out"""
+        client_socket = client.transport
+        decoder = FrameDecoder()
+        last_seen = time.monotonic()
 
-        # Main client handling loop
         while True:
             try:
-                data = client_socket.recv(1024).decode('utf-8')
+                data = client_socket.recv(RECV_SIZE)
+            except socket.timeout:
+                if self.check_idle(client, time.monotonic() - last_seen):
+                    return
+                if self.heartbeat_interval:
+                    client.send(PING)
+                continue
+            if not data:
+                return
+            last_seen = time.monotonic()
+            payloads = decoder.feed(data)
+
+            # Everything answered inline from this read goes out in a single send
+            responses = []
+            for payload in payloads:
+                try:
+                    request = self.decode_request(payload)
+                except json.JSONDecodeError:
+                    responses.append(encode_message(self.invalid_json_response()))
+                    continue
+
+                if self.is_pong(request):
+                    continue
+                if not self.is_metered(request):
+                    responses.append(self.encode_response(request, self.handle_request(request, client)))
+                elif not self.admission.acquire():
+                    responses.append(encode_message(self.busy_response(request)))
+                elif self.is_pipelined(request):
+                    future = self.db_executor.submit(self.handle_admitted, request, client)
+                    future.add_done_callback(functools.partial(self.send_pipelined, client, request))
+                else:
+                    responses.append(self.encode_response(request, self.handle_admitted(request, client)))
+
+            if responses:
+                client.send(b''.join(responses))
+
+    def close_client(self, client):
+        """Sign the connection out and stop its push sender"""
+        self.sign_out(client)
+        if client.outbox is not None:
+            client.outbox.close()
+
+    def run_outbox_sender(self, client):
+        """Threaded mode: write the client's queued push events until its outbox is closed"""
+        outbox = client.outbox
+        while not outbox.closed:
+            outbox.wait()
+            events = outbox.take()
+            if not events:
+                continue
+            try:
+                client.send(b''.join(encode_message(event) for event in events))
+            except (ConnectionError, ssl.SSLError, OSError):
+                break
+
+    def reject_connection(self, client_socket):
+        """Tell a client over the connection limit to come back later, without spawning a thread for it"""
+        # This runs on the accept loop, don't let a slow handshake hold it up
+        client_socket.settimeout(1.0)
+        try:
+            client_socket.sendall(encode_message(busy_response(self.admission.queue_deadline)))
+        except (ConnectionError, ssl.SSLError, OSError):
+            pass
+        client_socket.close()
+
+    def send_pipelined(self, client, request, future):
+        """Send a pipelined response as soon as its handler finishes"""
+        try:
+            client.send(self.encode_response(request, future.result()))
+        except (ConnectionError, ssl.SSLError, OSError) as e:
+            log.warning("Could not deliver response to %s: %s", client.address[0], e)
+
+    async def handle_client_async(self, reader, writer):
+        """Handle a client connection on the event loop, handlers run on the DB executor"""
+        address = writer.get_extra_info('peername')
+        if not self.admission.open_connection():
+            log.warning("Connection limit reached, turning away %s", address[0])
+            writer.write(encode_message(busy_response(self.admission.queue_deadline)))
+            writer.close()
+            return
+
+        log.info("Client connected from IP: %s", address[0])
+
+        client = ClientContext(address, writer)
+        decoder = FrameDecoder()
+        in_flight = set()  # pipelined request tasks, referenced until they finish
+
+        # Push events are queued from executor threads and written by this connection's own task
+        loop = asyncio.get_running_loop()
+        outbox_ready = asyncio.Event()
+        client.outbox = Outbox(on_ready=lambda: loop.call_soon_threadsafe(outbox_ready.set))
+        sender = asyncio.create_task(self.run_outbox_sender_async(client, outbox_ready))
+
+        last_seen = time.monotonic()
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(reader.read(RECV_SIZE), self.poll_interval())
+                except asyncio.TimeoutError:
+                    if self.check_idle(client, time.monotonic() - last_seen):
+                        break
+                    if self.heartbeat_interval:
+                        writer.write(PING)
+                        # A client that stopped reading can't hold the connection open either
+                        await asyncio.wait_for(writer.drain(), self.heartbeat_interval)
+                    continue
                 if not data:
                     break
+                last_seen = time.monotonic()
 
-                request = json.loads(data)
+                try:
+                    payloads = decoder.feed(data)
+                except ProtocolError as e:
+                    writer.write(encode_message(self.protocol_error_response(e)))
+                    await writer.drain()
+                    break
 
-                # Route request to appropriate handler
-                handlers = {
-                    'login': handle_login,
-                    'signup': handle_signup,
-                    'friendlist': handle_friendlist,
-                    'user_info': handle_profile
-                }
-                print(request)
-                handler = handlers.get(request['type'])
+                for payload in payloads:
+                    try:
+                        request = self.decode_request(payload)
+                    except json.JSONDecodeError:
+                        writer.write(encode_message(self.invalid_json_response()))
+                        continue
 
-                if handler:
-                    response = handler(request)
-                else:
-                    response = {
-                        'type': 'error_response',
-                        'status': 'failed',
-                        'message': f"Unknown request type: {request['type']}"
-                    }
+                    if self.is_pong(request):
+                        continue
+                    if self.is_pipelined(request):
+                        task = asyncio.create_task(self.handle_pipelined_async(request, client))
+                        in_flight.add(task)
+                        task.add_done_callback(in_flight.discard)
+                    else:
+                        writer.write(self.encode_response(request, await self.handle_request_async(request, client)))
+                await writer.drain()
+        except (ConnectionError, ssl.SSLError, asyncio.TimeoutError) as e:
+            log.warning("Connection from %s lost: %s", address[0], e or 'not reading')
+        finally:
+            for task in in_flight:
+                task.cancel()
+            await loop.run_in_executor(self.db_executor, self.close_client, client)
+            sender.cancel()
+            writer.close()
+            self.admission.close_connection()
 
-                client_socket.sendall(json.dumps(response).encode('utf-8'))
+    async def run_outbox_sender_async(self, client, ready):
+        """Asyncio mode: write the client's queued push events, a slow reader only stalls this task"""
+        outbox = client.outbox
+        try:
+            while not outbox.closed:
+                await ready.wait()
+                ready.clear()
+                events = outbox.take()
+                if events:
+                    client.transport.write(b''.join(encode_message(event) for event in events))
+                    await client.transport.drain()
+        except (ConnectionError, ssl.SSLError):
+            pass
 
-            except json.JSONDecodeError:
-                send_response({
-                    'type': 'error_response',
-                    'status': 'failed',
-                    'message': 'Invalid JSON format'
-                })
-            except Exception as e:
-                print(f"[!] Error handling client request: {e}")
-                send_response({
-                    'type': 'error_response',
-                    'status': 'failed',
-                    'message': 'Internal server error'
-                })
+    async def handle_request_async(self, request, client):
+        """Wait for an admission slot on the loop, then run the request on the executor"""
+        loop = asyncio.get_running_loop()
+        if not self.is_metered(request):
+            return self.handle_request(request, client)
+        if not await self.admission.acquire_async():
+            return self.busy_response(request)
+        work = loop.run_in_executor(self.db_executor, self.handle_request, request, client)
+        # The slot is freed when the work is done, a cancelled request doesn't free it while its
+        # query still runs on the executor
+        work.add_done_callback(lambda _: self.admission.release_async())
+        return await asyncio.shield(work)
+
+    async def handle_pipelined_async(self, request, client):
+        """Run a pipelined request and write its response whenever it completes"""
+        response = await self.handle_request_async(request, client)
+        client.transport.write(self.encode_response(request, response))
+        try:
+            await client.transport.drain()
+        except (ConnectionError, ssl.SSLError):
+            pass
+
+    async def serve_async(self):
+        """Serve every connection from a single asyncio event loop over TLS streams"""
+        server = await asyncio.start_server(self.handle_client_async, sock=self.server, ssl=self.ssl_context,
+                                            ssl_handshake_timeout=HANDSHAKE_TIMEOUT)
+        if self.worker_id is not None:
+            # The supervisor stops workers with SIGTERM, close the listener on the loop instead of
+            # letting the KeyboardInterrupt land in whichever task happens to be running
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, server.close)
+        async with server:
+            try:
+                await server.serve_forever()
+            except asyncio.CancelledError:
+                log.info("Server shutting down...")
+
+    def run_housekeeping(self):
+        """Periodically drop state that outlived its use, so a long-running server's memory stays flat"""
+        next_index_check = time.monotonic() + INDEX_CHECK_INTERVAL
+        while True:
+            time.sleep(HOUSEKEEPING_INTERVAL)
+            try:
+                self.sessions.purge_expired()
+                self.playtime_manager.close_abandoned()
+                if self.friend_manager.graph is not None and time.monotonic() >= next_index_check:
+                    next_index_check = time.monotonic() + INDEX_CHECK_INTERVAL
+                    self.check_friend_index()
+            except sqlite3.Error as e:
+                log.error("Housekeeping error: %s", e)
+
+    def check_friend_index(self):
+        """Repair the friend index where it differs from the friends table"""
+        problems = self.friend_manager.check_index(repair=True)
+        if problems['missing'] or problems['extra']:
+            log.warning("Repaired the friend index", extra={'fields': {
+                'missing': len(problems['missing']),
+                'extra': len(problems['extra'])
+            }})
+
+    def stop_stats(self):
+        """Write the final stats dump, before the writer and the pool are shut down"""
+        if self.stats_dumper is not None:
+            self.stats_dumper.stop()
 
     def start(self):
         """Accept and handle client connections"""
+        if self.mode == 'asyncio':
+            try:
+                asyncio.run(self.serve_async())
+            except KeyboardInterrupt:
+                log.info("Server shutting down...")
+            finally:
+                self.stop_stats()
+                self.db_executor.shutdown(wait=False)
+                self.hasher.shutdown()
+                self.writer.stop()
+                self.db.close_all()
+                self.server.close()
+            return
+
         try:
             while True:
                 # Wait for a client connection
                 client_socket, address = self.server.accept()
-                print(f"Connection from {address}")
+                log.debug("Connection from %s", address)
+
+                if not self.admission.open_connection():
+                    log.warning("Connection limit reached, turning away %s", address[0])
+                    self.reject_connection(client_socket)
+                    continue
 
-                # Start thread to handle this client
+                # Start thread to handle this client, a daemon so shutdown doesn't wait for idle clients
                 client_thread = threading.Thread(
                     target=self.handle_client,
-                    args=(client_socket, address)
+                    args=(client_socket, address),
+                    daemon=True
                 )
                 client_thread.start()
 
         except KeyboardInterrupt:
-            print("\nServer shutting down...")
+            log.info("Server shutting down...")
 
         finally:
+            self.stop_stats()
             self.server.close()
+            self.db_executor.shutdown(wait=False)
+            self.hasher.shutdown()
+            self.writer.stop()
+            self.db.close_all()
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Orderly server")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--mode', choices=['threaded', 'asyncio'], default='threaded',
+                        help="connection engine: one thread per client, or a single asyncio event loop")
+    parser.add_argument('--db-workers', type=int, default=8,
+                        help="size of the executor running request handlers off the connection loop")
+    parser.add_argument('--commit-batch', type=int, default=64,
+                        help="most writes group-committed in one transaction, 1 commits every write on its own")
+    parser.add_argument('--commit-delay-ms', type=float, default=0.0,
+                        help="how long the writer waits for more writes before committing a batch")
+    parser.add_argument('--friend-index', action='store_true',
+                        help="serve friend reads from an in-memory index loaded at startup")
+    parser.add_argument('--backlog', type=int, default=128,
+                        help="kernel accept queue length")
+    parser.add_argument('--max-connections', type=int, default=1024)
+    parser.add_argument('--max-in-flight', type=int, default=64,
+                        help="requests handled concurrently across all connections")
+    parser.add_argument('--max-queued', type=int, default=256,
+                        help="requests allowed to wait for a slot, more are answered 'busy' right away")
+    parser.add_argument('--queue-deadline-ms', type=float, default=500.0,
+                        help="how long a queued request may wait for a slot before it is answered 'busy'")
+    parser.add_argument('--kdf-iterations', type=int, default=DEFAULT_ITERATIONS,
+                        help="PBKDF2 cost for password hashes, existing hashes are upgraded on login")
+    parser.add_argument('--auth-workers', type=int, default=None,
+                        help="processes hashing and verifying passwords, defaults to the CPU count")
+    parser.add_argument('--session-ttl-hours', type=float, default=DEFAULT_TTL / 3600,
+                        help="how long a login's session token can be used to resume")
+    parser.add_argument('--stats-token', default=os.environ.get('ORDERLY_STATS_TOKEN'),
+                        help="secret a server_stats request must carry, defaults to $ORDERLY_STATS_TOKEN, "
+                             "server_stats is disabled without one")
+    parser.add_argument('--stats-file', default=None,
+                        help="file the server stats are dumped to as JSON every --stats-interval-s")
+    parser.add_argument('--stats-interval-s', type=float, default=60.0)
+    parser.add_argument('--heartbeat-interval-s', type=float, default=30.0,
+                        help="ping connections that have been quiet this long, 0 disables heartbeats")
+    parser.add_argument('--idle-timeout-s', type=float, default=90.0,
+                        help="close connections nothing was received on for this long, 0 keeps them open")
+    parser.add_argument('--rawg-key', default=os.environ.get('ORDERLY_RAWG_KEY', DEFAULT_RAWG_KEY),
+                        help="RAWG API key game metadata is fetched with, defaults to $ORDERLY_RAWG_KEY")
+    parser.add_argument('--rawg-url', default=RAWG_URL,
+                        help="RAWG API root, point it at a local stand-in for testing")
+    parser.add_argument('--metadata-file', default=None,
+                        help="serve game metadata from this JSON file of {title: metadata} instead of RAWG")
+    parser.add_argument('--covers-dir', default='covers',
+                        help="directory cover thumbnails are stored in")
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help="DEBUG adds a record for every request")
+    parser.add_argument('--log-file', default=None,
+                        help="also write JSON log lines to this file, rotated at --log-max-mb")
+    parser.add_argument('--log-max-mb', type=float, default=LOG_MAX_BYTES / (1024 * 1024))
+    parser.add_argument('--log-backups', type=int, default=LOG_BACKUPS,
+                        help="rotated log files kept")
+    parser.add_argument('--log-sample', action='append', default=[], metavar='TYPE=FRACTION',
+                        help="keep this fraction of the request records of a request type, e.g. ping=0.01, "
+                             "'*' for every type not given, can be repeated")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="server processes sharing the port through SO_REUSEPORT, connection and "
+                             "request limits apply per process")
+    args = parser.parse_args()
+    if args.heartbeat_interval_s and args.idle_timeout_s and args.idle_timeout_s <= args.heartbeat_interval_s:
+        parser.error("--idle-timeout-s must be longer than --heartbeat-interval-s, or clients are closed before being pinged")
+
+    options = dict(host=args.host, port=args.port, mode=args.mode, db_workers=args.db_workers,
+                   commit_batch=args.commit_batch, commit_delay=args.commit_delay_ms / 1000,
+                   friend_index=args.friend_index, backlog=args.backlog,
+                   max_connections=args.max_connections, max_in_flight=args.max_in_flight,
+                   max_queued=args.max_queued, queue_deadline=args.queue_deadline_ms / 1000,
+                   kdf_iterations=args.kdf_iterations, auth_workers=args.auth_workers,
+                   session_ttl=int(args.session_ttl_hours * 3600), stats_token=args.stats_token,
+                   stats_file=args.stats_file, stats_interval=args.stats_interval_s,
+                   heartbeat_interval=args.heartbeat_interval_s, idle_timeout=args.idle_timeout_s,
+                   covers_dir=args.covers_dir)
+    try:
+        log_options = dict(level=args.log_level, log_file=args.log_file, max_bytes=int(args.log_max_mb * 1024 * 1024),
+                           backups=args.log_backups, sample_rates=parse_sample_rates(args.log_sample))
+    except ValueError as e:
+        parser.error(f"--log-sample: {e}")
+    pipeline = setup_logging(**log_options)
+    if args.metadata_file:
+        options['metadata_upstream'] = FileUpstream(args.metadata_file)
+    else:
+        options['metadata_upstream'] = RawgUpstream(args.rawg_key, args.rawg_url)
+
+    if args.workers > 1:
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            parser.error("--workers needs SO_REUSEPORT, which this platform doesn't have")
+        # Split the password hashing processes between the workers instead of giving each a full set
+        if options['auth_workers'] is None:
+            options['auth_workers'] = max(1, (os.cpu_count() or 1) // args.workers)
+        # Create the signing key before forking, so every worker uses the same one
+        load_secret('session.key')
+        try:
+            Supervisor(args.workers, functools.partial(run_worker, options, log_options)).run()
+        finally:
+            pipeline.stop()
+        return
+
     # Create server instance
-    server = OrderlyServer()
+    server = OrderlyServer(**options)
 
     # Start the server
-    server.start()
+    try:
+        server.start()
+    finally:
+        pipeline.stop()
+
+
+def run_worker(options, log_options, worker_id, connection):
+    """Serve as one of the Supervisor's worker processes"""
+    if log_options['log_file']:
+        # One file per worker, processes can't share a rotating file
+        root, extension = os.path.splitext(log_options['log_file'])
+        log_options = dict(log_options, log_file=f"{root}.{worker_id}{extension}")
+    pipeline = setup_logging(**log_options)
+    server = OrderlyServer(**options, cluster=connection, worker_id=worker_id)
+    try:
+        server.start()
+    finally:
+        pipeline.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,217 @@
+"""
+Asynchronous, structured logging for the server
+
+Code logs through loggers under 'orderly' (logging.getLogger('orderly.server') and so on).
+Records are only put on a queue on the calling thread, a listener thread formats and writes
+them to the console and, with --log-file, to a rotating file of JSON lines. A request never
+waits for the disk: past MAX_QUEUED waiting records new ones are dropped and counted.
+
+The listener thread is stopped around every fork, after writing out what is queued, so a
+forked child doesn't inherit a queue nobody reads or a lock the listener held. Worker
+processes set up their own logging.
+
+Every request is logged at DEBUG to 'orderly.requests' with its type, status, user and
+latency. The records of busy request types can be sampled, e.g. --log-sample ping=0.01
+keeps one ping in a hundred.
+"""
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+
+ROOT = 'orderly'
+MAX_QUEUED = 10000
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 5
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and the record's `fields`"""
+
+    def format(self, record):
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class ConsoleFormatter(logging.Formatter):
+    """The server's console style, '[+]' for information and '[!]' for problems"""
+
+    def format(self, record):
+        prefix = '[+]' if record.levelno <= logging.INFO else '[!]'
+        fields = getattr(record, 'fields', None)
+        line = f"{prefix} {record.getMessage()}"
+        if fields:
+            line += ' ' + ' '.join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_text:
+            line += '\n' + record.exc_text
+        return line
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a fraction of the records of each request type, records of no request type all pass"""
+
+    def __init__(self, rates):
+        """
+        :param rates: {request type: fraction kept}, '*' for request types not listed
+        """
+        super().__init__()
+        self.rates = rates
+        self.default = rates.get('*', 1.0)
+
+    def filter(self, record):
+        fields = getattr(record, 'fields', None)
+        if not fields or 'request' not in fields:
+            return True
+        rate = self.rates.get(fields['request'], self.default)
+        return rate >= 1 or random.random() < rate
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of letting the queue grow past max_queued"""
+
+    def __init__(self, log_queue, max_queued=MAX_QUEUED):
+        super().__init__(log_queue)
+        self.max_queued = max_queued
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Only what can't be done later: the message and the traceback are resolved while
+        # their arguments are still current, the formatting is left to the listener
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        # qsize() of a SimpleQueue takes no lock, the bound is approximate under contention
+        if self.queue.qsize() >= self.max_queued:
+            self.dropped += 1
+            return
+        self.queue.put_nowait(record)
+
+
+class LogPipeline:
+    """The queue, its handler on the 'orderly' logger and the listener thread writing records out"""
+
+    def __init__(self, handler, listener):
+        self.handler = handler
+        self.listener = listener
+        self.pid = os.getpid()
+        self.paused = False
+
+    def stats(self):
+        return {
+            'queued': self.handler.queue.qsize(),
+            'dropped': self.handler.dropped
+        }
+
+    def stop(self):
+        """Write out what is queued and stop the listener thread"""
+        if self.listener._thread is not None:
+            self.listener.stop()
+
+    def pause(self):
+        """Stop the listener thread for a fork, records logged meanwhile wait in the queue"""
+        if self.pid == os.getpid() and self.listener._thread is not None:
+            self.listener.stop()
+            self.paused = True
+
+    def resume(self):
+        if self.paused:
+            self.paused = False
+            self.listener.start()
+
+
+_pipeline = None
+
+
+def setup_logging(level='INFO', log_file=None, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS, sample_rates=None,
+                  console=True, max_queued=MAX_QUEUED):
+    """
+    Route the 'orderly' loggers through a queue to the console and an optional rotating file
+
+    Replaces a previous setup, as a forked worker process has to: the parent's listener
+    thread doesn't exist in the child.
+
+    :param sample_rates: {request type: fraction of its request records kept}, see SamplingFilter
+    :return: LogPipeline
+    """
+    global _pipeline
+    logger = logging.getLogger(ROOT)
+    if _pipeline is not None:
+        logger.removeHandler(_pipeline.handler)
+        if _pipeline.pid == os.getpid():
+            _pipeline.stop()
+
+    outputs = []
+    if console:
+        stream = logging.StreamHandler(sys.stdout)
+        stream.setFormatter(ConsoleFormatter())
+        outputs.append(stream)
+    if log_file:
+        rotating = logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backups,
+                                                        encoding='utf-8')
+        rotating.setFormatter(JsonFormatter())
+        outputs.append(rotating)
+
+    log_queue = queue.SimpleQueue()
+    handler = NonBlockingQueueHandler(log_queue, max_queued)
+    if sample_rates:
+        handler.addFilter(SamplingFilter(sample_rates))
+    listener = logging.handlers.QueueListener(log_queue, *outputs, respect_handler_level=False)
+
+    logger.setLevel(level)
+    logger.addHandler(handler)
+    logger.propagate = False
+    listener.start()
+    _pipeline = LogPipeline(handler, listener)
+    return _pipeline
+
+
+def _before_fork():
+    if _pipeline is not None:
+        _pipeline.pause()
+
+
+def _after_fork_in_parent():
+    if _pipeline is not None:
+        _pipeline.resume()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=_before_fork, after_in_parent=_after_fork_in_parent)
+
+
+def log_stats():
+    """:return: LogPipeline.stats() of the current setup, None before setup_logging()"""
+    return _pipeline.stats() if _pipeline is not None else None
+
+
+def parse_sample_rates(specs):
+    """
+    :param specs: ['type=fraction', ...] as given to --log-sample
+    :return: {type: fraction}
+    :raise ValueError: a malformed spec
+    """
+    rates = {}
+    for spec in specs or ():
+        request_type, _, rate = spec.partition('=')
+        rate = float(rate)
+        if not request_type or not 0 <= rate <= 1:
+            raise ValueError(f"expected type=fraction between 0 and 1, got '{spec}'")
+        rates[request_type] = rate
+    return rates
@@ -0,0 +1,238 @@
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+
+DEFAULT_TTL = 7 * 24 * 3600
+# Logging in again past this evicts the user's oldest session, a client that never logs out can't grow the table
+MAX_SESSIONS_PER_USER = 10
+# How long a signed token whose session isn't in the table is answered from memory, short because
+# a session issued by another worker process may not have been committed yet
+MISS_TTL = 5
+
+
+def load_secret(path):
+    """Read the token signing key, creating it on first start so tokens survive restarts"""
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    secret = secrets.token_bytes(32)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(secret)
+    return secret
+
+
+class SessionStore:
+    """
+    Signed, expiring session tokens backed by a memory-resident session table
+
+    A token is '<session id>.<expiry>.<signature>', signed with HMAC-SHA256. Resuming
+    checks the signature and the expiry, then looks the session up in memory, so it costs
+    no password hash and no query. The table is written through to the `sessions` table
+    and loaded back at startup, so clients reconnecting after a restart resume the same way.
+
+    Revoked sessions are remembered until their tokens expire: the DELETE is only queued, and
+    a session looked up in the table before it commits must not come back.
+    """
+
+    def __init__(self, pool, writer, secret_path='session.key', ttl=DEFAULT_TTL):
+        """
+        :param pool: ConnectionPool used to load the sessions at startup
+        :param writer: GroupCommitWriter persisting new and revoked sessions
+        :param secret_path: file holding the signing key
+        :param ttl: seconds a token stays valid
+        """
+        self.pool = pool
+        self.writer = writer
+        self.ttl = ttl
+        self._secret = load_secret(secret_path)
+        self._sessions = {}  # {session_id: (user dict, expires)}
+        self._by_user = {}  # {user_id: [session_id, ...] oldest first}
+        self._revoked = {}  # {session_id: expires} of sessions ended before their tokens expired
+        self._missing = {}  # {session_id: time} until which a session not in the table isn't looked up again
+        self._lock = threading.Lock()
+        self._load(pool)
+
+    def _load(self, pool):
+        now = int(time.time())
+        with pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM sessions WHERE expires <= ?", (now,))
+            cursor.execute("SELECT id, user_id, username, expires FROM sessions ORDER BY expires")
+            evicted = []
+            for session_id, user_id, username, expires in cursor.fetchall():
+                evicted += self._add(session_id, {'id': user_id, 'username': username}, expires)
+            cursor.executemany("DELETE FROM sessions WHERE id = ?", [(session_id,) for session_id in evicted])
+
+    def _add(self, session_id, user, expires):
+        """
+        Register a session, called with self._lock held or before the store is shared
+
+        :return: ids of the user's sessions evicted to stay within MAX_SESSIONS_PER_USER
+        """
+        self._sessions[session_id] = (user, expires)
+        session_ids = self._by_user.setdefault(user['id'], [])
+        session_ids.append(session_id)
+        evicted = session_ids[:-MAX_SESSIONS_PER_USER]
+        if evicted:
+            del session_ids[:-MAX_SESSIONS_PER_USER]
+            for evicted_id in evicted:
+                self._sessions.pop(evicted_id, None)
+        return evicted
+
+    def _remove(self, session_id):
+        """Unregister a session, called with self._lock held, False if it wasn't known"""
+        session = self._sessions.pop(session_id, None)
+        if session is None:
+            return False
+        user_id = session[0]['id']
+        session_ids = self._by_user.get(user_id)
+        if session_ids is not None:
+            if session_id in session_ids:
+                session_ids.remove(session_id)
+            if not session_ids:
+                del self._by_user[user_id]
+        return True
+
+    def _sign(self, payload):
+        return hmac.new(self._secret, payload.encode(), hashlib.sha256).hexdigest()
+
+    def issue(self, user):
+        """
+        Start a session for an authenticated user
+
+        :param user: {'id', 'username'} as returned by authenticate_user
+        :return: token to hand to the client
+        """
+        session_id = secrets.token_hex(16)
+        expires = int(time.time()) + self.ttl
+        with self._lock:
+            evicted = self._add(session_id, user, expires)
+            # Their DELETE is only queued, a resume before it commits must not load them back
+            for evicted_id in evicted:
+                self._revoked[evicted_id] = expires
+
+        def insert(cursor):
+            cursor.execute("""
+                INSERT INTO sessions (id, user_id, username, expires)
+                VALUES (?, ?, ?, ?)
+            """, (session_id, user['id'], user['username'], expires))
+            cursor.executemany("DELETE FROM sessions WHERE id = ?", [(evicted_id,) for evicted_id in evicted])
+
+        self.writer.submit(insert)
+        payload = f"{session_id}.{expires}"
+        return f"{payload}.{self._sign(payload)}"
+
+    def _parse(self, token):
+        """Return (session id, expiry) of a well-formed, correctly signed, unexpired token, else None"""
+        try:
+            session_id, expires, signature = token.split('.')
+            expires = int(expires)
+        except (AttributeError, ValueError):
+            return None
+        if not hmac.compare_digest(self._sign(f"{session_id}.{expires}"), signature):
+            return None
+        if expires <= time.time():
+            with self._lock:
+                known = self._remove(session_id)
+            if known:
+                self._delete(session_id)
+            return None
+        return session_id, expires
+
+    def resume(self, token):
+        """
+        :return: the session's user dict, or None if the token is invalid, expired or revoked
+        """
+        parsed = self._parse(token)
+        if parsed is None:
+            return None
+        session_id = parsed[0]
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = self._fetch(session_id)
+        return session[0] if session else None
+
+    def _fetch(self, session_id):
+        """
+        Look up a session issued by another worker process after this one loaded the table
+
+        Only reached by correctly signed tokens, so this costs one primary key lookup per
+        worker and session at most. Revoked sessions aren't looked up, and a miss isn't looked
+        up again for MISS_TTL seconds.
+        """
+        with self._lock:
+            if session_id in self._revoked or self._missing.get(session_id, 0) > time.time():
+                return None
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT user_id, username, expires FROM sessions WHERE id = ?", (session_id,))
+            row = cursor.fetchone()
+        with self._lock:
+            # Checked again, the session may have been revoked while the row was read
+            if row is None or session_id in self._revoked:
+                self._missing[session_id] = time.time() + MISS_TTL
+                return None
+            session = ({'id': row[0], 'username': row[1]}, row[2])
+            if session_id not in self._sessions:
+                self._add(session_id, *session)
+        return session
+
+    def revoke(self, token):
+        """
+        End a session, e.g. on logout
+
+        :return: the revoked session's id, None if the token wasn't valid
+        """
+        parsed = self._parse(token)
+        if parsed is None:
+            return None
+        session_id, expires = parsed
+        with self._lock:
+            self._remove(session_id)
+            self._revoked[session_id] = expires
+        self._delete(session_id)
+        return session_id
+
+    def forget_local(self, session_id):
+        """
+        Drop a session revoked by another worker process, whose DELETE may not have committed yet
+
+        Remembered as revoked for the ttl, no token of the session outlives that.
+        """
+        with self._lock:
+            self._remove(session_id)
+            self._revoked[session_id] = int(time.time()) + self.ttl
+
+    def _delete(self, session_id):
+        def delete(cursor):
+            cursor.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+        self.writer.submit(delete)
+
+    def purge_expired(self):
+        """
+        Drop every expired session from memory and the table
+
+        :return: number of sessions dropped from memory
+        """
+        now = int(time.time())
+        with self._lock:
+            expired = [session_id for session_id, (_, expires) in self._sessions.items() if expires <= now]
+            for session_id in expired:
+                self._remove(session_id)
+            self._revoked = {session_id: expires for session_id, expires in self._revoked.items() if expires > now}
+            self._missing = {session_id: until for session_id, until in self._missing.items() if until > now}
+
+        def delete(cursor):
+            cursor.execute("DELETE FROM sessions WHERE expires <= ?", (now,))
+
+        self.writer.submit(delete)
+        return len(expired)
+
+    def count(self):
+        return len(self._sessions)
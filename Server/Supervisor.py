@@ -0,0 +1,206 @@
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from multiprocessing.connection import wait
+
+log = logging.getLogger('orderly.supervisor')
+
+RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 30.0
+STABLE_AFTER = 10.0  # a worker that lived this long resets the restart backoff
+
+
+def interrupt_once(signum, frame):
+    """
+    SIGTERM handler raising KeyboardInterrupt the first time only
+
+    A service manager may signal the whole process group and the supervisor then signals
+    its workers too, a second interrupt must not cut the first one's clean shutdown short.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    raise KeyboardInterrupt
+
+
+class Supervisor:
+    """
+    Runs the server as several worker processes sharing one port
+
+    Each worker binds the port with SO_REUSEPORT, so the kernel spreads new connections
+    over them and JSON, TLS and request handling use every core instead of one. The
+    supervisor doesn't serve anything itself: it restarts workers that die and brokers
+    the state they share over one Pipe per worker, which users are online on which
+    worker, events for users connected elsewhere and broadcast notifications.
+    """
+
+    def __init__(self, workers, start_worker):
+        """
+        :param workers: number of worker processes
+        :param start_worker: callable(worker_id, connection) serving in the worker until shutdown,
+            connection being the worker's end of its Pipe to the supervisor
+        """
+        self.workers = workers
+        self.start_worker = start_worker
+        # fork so workers start without re-importing, the supervisor's only thread besides this one,
+        # the log listener, is stopped around each fork (see ServerLog)
+        self._context = multiprocessing.get_context('fork')
+        self._stopping = False
+
+        self._processes = {}  # {worker_id: Process}
+        self._connections = {}  # {worker_id: supervisor end of the pipe}
+        self._started = {}  # {worker_id: start time}
+        self._delays = {}  # {worker_id: current restart delay}
+        self._restarts = {}  # {worker_id: time to restart at}
+
+        self._online = {}  # {user_id: set of worker_ids with a connection of the user}
+        self._announced = {}  # {user_id: (username, followers)} for announcing them offline if their worker dies
+
+    def _start(self, worker_id):
+        inherited = list(self._connections.values())
+        supervisor_end, worker_end = self._context.Pipe()
+        process = self._context.Process(target=self._worker_main, args=(worker_id, worker_end, inherited),
+                                         name=f"orderly-worker-{worker_id}")
+        process.start()
+        worker_end.close()
+
+        self._processes[worker_id] = process
+        self._connections[worker_id] = supervisor_end
+        self._started[worker_id] = time.monotonic()
+        log.info("Worker %s started (pid %s)", worker_id, process.pid)
+
+    def _worker_main(self, worker_id, connection, inherited):
+        # Drop the supervisor's ends of the other workers' pipes, so they see EOF when the supervisor exits
+        for other in inherited:
+            other.close()
+        # Ctrl-C reaches the whole process group, only the supervisor acts on it and
+        # shuts the workers down with SIGTERM, which they handle like Ctrl-C
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, interrupt_once)
+        self.start_worker(worker_id, connection)
+
+    def run(self):
+        """Start the workers and supervise them until interrupted"""
+        signal.signal(signal.SIGTERM, interrupt_once)
+        for worker_id in range(self.workers):
+            self._start(worker_id)
+
+        try:
+            while True:
+                self._restart_due()
+                by_sentinel = {process.sentinel: worker_id for worker_id, process in self._processes.items()}
+                by_connection = {connection: worker_id for worker_id, connection in self._connections.items()}
+                for ready in wait(list(by_sentinel) + list(by_connection), timeout=1.0):
+                    if ready in by_sentinel:
+                        self._worker_exited(by_sentinel[ready])
+                    elif by_connection[ready] in self._connections:
+                        self._receive(by_connection[ready], ready)
+        except KeyboardInterrupt:
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            log.info("Supervisor shutting down...")
+        finally:
+            self.stop()
+
+    def _receive(self, worker_id, connection):
+        try:
+            message = connection.recv()
+        except (EOFError, OSError):
+            return  # the worker is exiting, its sentinel reports it
+        self._handle(worker_id, message)
+
+    def _handle(self, worker_id, message):
+        kind = message[0]
+        if kind == 'hello':
+            # The worker is up and reading, bring its replica of the online set up to date
+            self._send(worker_id, ('snapshot', list(self._online)))
+        elif kind == 'connect':
+            _, user_id, username, followers = message
+            self._announced[user_id] = (username, followers)
+            workers = self._online.setdefault(user_id, set())
+            workers.add(worker_id)
+            if len(workers) == 1:
+                self._send_all(('online', user_id, username, followers))
+        elif kind == 'disconnect':
+            _, user_id, username, followers = message
+            self._disconnect(worker_id, user_id, username, followers)
+        elif kind == 'publish':
+            _, user_ids, event = message
+            # Only to the workers the recipients are connected to
+            targets = set()
+            for user_id in user_ids:
+                targets |= self._online.get(user_id, set())
+            targets.discard(worker_id)
+            for target in targets:
+                self._send(target, ('publish', user_ids, event))
+        elif kind == 'broadcast':
+            self._send_all(message, exclude=worker_id)
+
+    def _disconnect(self, worker_id, user_id, username, followers):
+        workers = self._online.get(user_id)
+        if not workers or worker_id not in workers:
+            return
+        workers.discard(worker_id)
+        if not workers:
+            del self._online[user_id]
+            self._announced.pop(user_id, None)
+            self._send_all(('offline', user_id, username, followers))
+
+    def _send(self, worker_id, message):
+        connection = self._connections.get(worker_id)
+        if connection is None:
+            return
+        try:
+            connection.send(message)
+        except (BrokenPipeError, OSError):
+            pass  # the worker is exiting, its sentinel reports it
+
+    def _send_all(self, message, exclude=None):
+        for worker_id in list(self._connections):
+            if worker_id != exclude:
+                self._send(worker_id, message)
+
+    def _worker_exited(self, worker_id):
+        """Forget a dead worker's users and schedule its restart, backing off if it keeps crashing"""
+        process = self._processes.pop(worker_id)
+        self._connections.pop(worker_id).close()
+        process.join()
+
+        # Its connections are gone with it
+        for user_id in [user_id for user_id, workers in self._online.items() if worker_id in workers]:
+            username, followers = self._announced.get(user_id, (None, []))
+            self._disconnect(worker_id, user_id, username, followers)
+
+        if self._stopping:
+            return
+        lived = time.monotonic() - self._started.pop(worker_id)
+        delay = RESTART_DELAY if lived >= STABLE_AFTER else min(self._delays.get(worker_id, RESTART_DELAY) * 2,
+                                                                 MAX_RESTART_DELAY)
+        self._delays[worker_id] = delay
+        self._restarts[worker_id] = time.monotonic() + delay
+        log.warning("Worker %s exited with code %s, restarting in %.0fs", worker_id, process.exitcode, delay)
+
+    def _restart_due(self):
+        now = time.monotonic()
+        for worker_id, restart_at in list(self._restarts.items()):
+            if restart_at <= now:
+                del self._restarts[worker_id]
+                self._start(worker_id)
+
+    def stop(self, timeout=10.0):
+        """Ask every worker to shut down cleanly, kill the ones that don't in time"""
+        self._stopping = True
+        for process in self._processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+        deadline = time.monotonic() + timeout
+        for process in self._processes.values():
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.kill()
+                process.join()
+        for connection in self._connections.values():
+            connection.close()
+        self._processes.clear()
+        self._connections.clear()
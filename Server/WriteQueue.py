@@ -0,0 +1,129 @@
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from Database import open_connection
+from Metrics import db_timer
+
+
+class GroupCommitWriter:
+    """
+    Single writer thread that group-commits mutations
+
+    Callers submit an operation, a callable taking a cursor, from any thread. The writer
+    drains whatever is queued (up to max_batch, waiting at most max_delay for more) and
+    runs the whole batch in one transaction, so the commit's fsync is shared by every
+    operation in it. Each operation runs inside its own savepoint: an operation that raises
+    (e.g. sqlite3.IntegrityError on a duplicate username) is rolled back alone and its
+    exception is handed to its own caller while the rest of the batch still commits.
+    """
+
+    def __init__(self, db_path='orderly_users.db', max_batch=64, max_delay=0.0):
+        """
+        :param db_path: SQLite database file
+        :param max_batch: most operations committed by one transaction, 1 disables batching
+        :param max_delay: seconds to wait for more operations after the first one of a batch, with 0
+            a batch is whatever queued up while the previous transaction was committing
+        """
+        self.db_path = db_path
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = queue.SimpleQueue()
+        self._stopping = False
+
+        # Counters for tuning, read them through stats()
+        self.batches = 0
+        self.operations = 0
+
+        self._thread = threading.Thread(target=self._run, name='orderly-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, operation):
+        """
+        Queue an operation for the next batch
+
+        :param operation: callable(cursor) -> result, runs on the writer thread
+        :return: Future resolved with the operation's result or exception after commit
+        """
+        future = Future()
+        self._queue.put((operation, future))
+        return future
+
+    def execute(self, operation):
+        """Queue an operation and block until its batch has committed"""
+        with db_timer():
+            return self.submit(operation).result()
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'operations': self.operations,
+            'queued': self._queue.qsize()
+        }
+
+    def stop(self):
+        """Commit whatever is queued and stop the writer thread"""
+        self._stopping = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self, first):
+        """Gather the batch that starts with `first`"""
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._stopping = True
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        # Autocommit mode, transactions and savepoints are issued explicitly
+        conn = open_connection(self.db_path, isolation_level=None)
+        cursor = conn.cursor()
+
+        while True:
+            item = self._queue.get()
+            if item is not None:
+                self._commit_batch(cursor, self._collect(item))
+            if self._stopping and self._queue.empty():
+                break
+
+        conn.close()
+
+    def _commit_batch(self, cursor, batch):
+        outcomes = []
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            for operation, _ in batch:
+                cursor.execute("SAVEPOINT operation")
+                try:
+                    outcomes.append((True, operation(cursor)))
+                    cursor.execute("RELEASE operation")
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO operation")
+                    cursor.execute("RELEASE operation")
+                    outcomes.append((False, e))
+            cursor.execute("COMMIT")
+        except sqlite3.Error as e:
+            # The transaction itself failed, nothing in the batch was committed
+            if cursor.connection.in_transaction:
+                cursor.execute("ROLLBACK")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.operations += len(batch)
+        for (_, future), (succeeded, outcome) in zip(batch, outcomes):
+            if succeeded:
+                future.set_result(outcome)
+            else:
+                future.set_exception(outcome)
@@ -0,0 +1,63 @@
+"""
+Login throughput at each KDF cost
+
+Verifies passwords through the server's PasswordHasher process pool from many
+threads, the way concurrent handle_login calls do, and reports logins per second
+for the original single SHA-256 format and for each PBKDF2 iteration count.
+
+    python benchmarks/auth_cost.py --costs 50000 100000 200000 600000 --logins 400
+"""
+import argparse
+import hashlib
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Server'))
+
+from Auth import PasswordHasher, make_hash  # noqa: E402
+
+
+def measure(hasher, salt, stored_hash, logins, threads):
+    """Logins per second and mean latency in ms for one stored hash"""
+    def login(_):
+        started = time.perf_counter()
+        matches, _ = hasher.verify('CorrectHorse1', salt, stored_hash)
+        assert matches
+        return time.perf_counter() - started
+
+    with ThreadPoolExecutor(max_workers=threads) as clients:
+        started = time.perf_counter()
+        latencies = list(clients.map(login, range(logins)))
+        elapsed = time.perf_counter() - started
+    return logins / elapsed, sum(latencies) / len(latencies) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--costs', type=int, nargs='+', default=[50000, 100000, 200000, 600000])
+    parser.add_argument('--logins', type=int, default=400)
+    parser.add_argument('--threads', type=int, default=64, help="concurrent logins")
+    parser.add_argument('--workers', type=int, default=None, help="auth processes, defaults to the CPU count")
+    args = parser.parse_args()
+
+    hasher = PasswordHasher(workers=args.workers)
+    print(f"{'cost':>14} {'logins/s':>10} {'mean ms':>9}")
+
+    salt = 'benchsalt'
+    legacy_hash = hashlib.sha256(('CorrectHorse1' + salt).encode()).hexdigest()
+    rate, latency = measure(hasher, salt, legacy_hash, args.logins, args.threads)
+    print(f"{'sha256 (old)':>14} {rate:10.0f} {latency:9.1f}")
+
+    for iterations in args.costs:
+        salt, stored_hash = make_hash('CorrectHorse1', iterations)
+        hasher.iterations = iterations
+        rate, latency = measure(hasher, salt, stored_hash, args.logins, args.threads)
+        print(f"{iterations:>14} {rate:10.0f} {latency:9.1f}")
+
+    hasher.shutdown()
+
+
+if __name__ == "__main__":
+    main()
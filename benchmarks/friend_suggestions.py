@@ -0,0 +1,115 @@
+"""
+Friend suggestion latency for users with thousands of friends
+
+Builds a random friend graph in a scratch database, then times FriendManager.get_suggestions
+for its best connected users: from the in-memory index uncached (right after a friend
+change), from its cache, and counted by SQLite without the index. Every ranking is checked
+against a plain count of friends of friends.
+
+    python benchmarks/friend_suggestions.py --users 20000 --friends 2000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Server'))
+
+from Database import ConnectionPool, open_connection  # noqa: E402
+from FriendManager import FriendManager  # noqa: E402
+from Migrations import migrate  # noqa: E402
+
+
+def build(conn, users, friends, seed):
+    """Users user0..userN, friend list sizes spread from a few up to `friends`"""
+    rng = random.Random(seed)
+    ids = [f"user{index}" for index in range(users)]
+    conn.executemany("INSERT INTO users (id, username, email, password_hash, salt) VALUES (?, ?, ?, '', '')",
+                     [(user_id, user_id, f"{user_id}@bench") for user_id in ids])
+    edges = []
+    for user_id in ids:
+        degree = min(users - 1, int(friends * rng.random() ** 3) + 1)
+        edges += [(user_id, friend_id) for friend_id in rng.sample(ids, degree) if friend_id != user_id]
+    conn.executemany("INSERT OR IGNORE INTO friends (user_id, friend_id) VALUES (?, ?)", edges)
+    conn.commit()
+
+
+def expected_counts(conn, user_id):
+    """{candidate: mutual friends} by brute force"""
+    adjacency = {}
+    for owner, friend_id in conn.execute("SELECT user_id, friend_id FROM friends"):
+        adjacency.setdefault(owner, set()).add(friend_id)
+    mine = adjacency.get(user_id, set())
+    counts = Counter(candidate for friend_id in mine for candidate in adjacency.get(friend_id, ()))
+    for excluded in mine | {user_id}:
+        counts.pop(excluded, None)
+    return counts
+
+
+def check(suggestions, counts, limit):
+    """The suggestions are a correct top `limit`, ties may come in any order"""
+    assert len(suggestions) == min(limit, len(counts)), (len(suggestions), len(counts))
+    for suggestion in suggestions:
+        assert counts[suggestion['id']] == suggestion['mutual_friends'], suggestion
+    if suggestions:
+        cutoff = suggestions[-1]['mutual_friends']
+        assert sum(count > cutoff for count in counts.values()) <= len(suggestions)
+
+
+def timed(function, repeat):
+    """Mean milliseconds of function()"""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - started) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--friends', type=int, default=2000, help="largest friend list")
+    parser.add_argument('--limit', type=int, default=10)
+    parser.add_argument('--sample', type=int, default=5, help="best connected users timed")
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        db_path = os.path.join(scratch, 'friends.db')
+        conn = open_connection(db_path)
+        migrate(conn)
+        build(conn, args.users, args.friends, args.seed)
+
+        pool = ConnectionPool(db_path)
+        started = time.perf_counter()
+        indexed = FriendManager(pool=pool, index=True)
+        print(f"index loaded in {time.perf_counter() - started:.2f}s")
+        plain = FriendManager(pool=pool)
+
+        busiest = conn.execute("""
+            SELECT user_id, COUNT(*) FROM friends GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT ?
+        """, (args.sample,)).fetchall()
+
+        print(f"{'user':>10} {'friends':>8} {'uncached ms':>12} {'cached ms':>10} {'sqlite ms':>10}")
+        for user_id, degree in busiest:
+            counts = expected_counts(conn, user_id)
+            check(indexed.get_suggestions(user_id, args.limit), counts, args.limit)
+            check(plain.get_suggestions(user_id, args.limit), counts, args.limit)
+
+            def uncached():
+                indexed.graph._suggestions.pop(user_id, None)
+                indexed.get_suggestions(user_id, args.limit)
+
+            cold = timed(uncached, args.repeat)
+            warm = timed(lambda: indexed.get_suggestions(user_id, args.limit), args.repeat)
+            sql = timed(lambda: plain.get_suggestions(user_id, args.limit), max(1, args.repeat // 10))
+            print(f"{user_id:>10} {degree:>8} {cold:12.3f} {warm:10.3f} {sql:10.3f}")
+
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
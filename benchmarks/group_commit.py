@@ -0,0 +1,90 @@
+"""
+Signups per second with and without group commit
+
+Runs the same users INSERT that OrderlyServer.register_user issues from many client
+threads against a scratch database, once with every signup committed on its own
+(--commit-batch 1) and once batched the way the server does by default.
+
+    python benchmarks/group_commit.py --signups 5000 --threads 32
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Server'))
+
+from Database import open_connection  # noqa: E402
+from WriteQueue import GroupCommitWriter  # noqa: E402
+
+
+def create_schema(db_path):
+    conn = open_connection(db_path)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY,
+            username TEXT UNIQUE NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            salt TEXT NOT NULL
+        )
+    ''')
+    conn.commit()
+    conn.close()
+
+
+def run(db_path, signups, threads, max_batch, max_delay):
+    """Return (signups per second, writer stats) for one configuration"""
+    writer = GroupCommitWriter(db_path, max_batch=max_batch, max_delay=max_delay)
+    per_thread = signups // threads
+
+    def client(index):
+        for n in range(per_thread):
+            user_id = uuid.uuid4().hex
+            name = f"bench_{max_batch}_{index}_{n}"
+
+            def insert(cursor):
+                cursor.execute('''
+                    INSERT INTO users
+                    (id, username, email, password_hash, salt)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (user_id, name, f"{name}@example.com", 'x' * 64, 'y' * 32))
+
+            writer.execute(insert)
+
+    workers = [threading.Thread(target=client, args=(i,)) for i in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+
+    stats = writer.stats()
+    writer.stop()
+    return per_thread * threads / elapsed, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--signups', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--commit-batch', type=int, default=64)
+    parser.add_argument('--commit-delay-ms', type=float, default=0.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        db_path = os.path.join(scratch, 'bench_users.db')
+        create_schema(db_path)
+
+        for label, max_batch in (('unbatched', 1), ('group commit', args.commit_batch)):
+            rate, stats = run(db_path, args.signups, args.threads, max_batch, args.commit_delay_ms / 1000)
+            print(f"{label:>13}: {rate:9.0f} signups/s  "
+                  f"({stats['operations']} signups in {stats['batches']} transactions)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+"""
+Load generator for a running Orderly server
+
+Opens --connections concurrent TLS connections to the server, pinned to the bundled
+Server/cert.pem, and has each one send a weighted mix of login, signup, friendlist and
+user_info requests back to back for --duration seconds. Prints throughput and
+p50/p99/p999 latency, overall and per request, and appends the run as one JSON line
+to --results so runs against different server modes and commits can be compared.
+
+    python Server/Server.py --mode asyncio &
+    python benchmarks/load_test.py --connections 200 --duration 30 --label asyncio
+    python benchmarks/load_test.py --compare
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import socket
+import ssl
+import sys
+import threading
+import time
+import uuid
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Server')
+sys.path.insert(0, SERVER_DIR)
+
+from Protocol import FrameDecoder, encode_message, decode_message, RECV_SIZE  # noqa: E402
+
+DEFAULT_MIX = 'login=5,signup=1,friendlist.get=50,friendlist.count=15,friendlist.add=4,user_info=25'
+PASSWORD = 'LoadTest1'
+
+
+def parse_mix(text):
+    """'login=5,user_info=20' -> {'login': 5.0, 'user_info': 20.0}"""
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in REQUESTS:
+            raise SystemExit(f"unknown request '{name}', expected one of {', '.join(REQUESTS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of a sorted list, in ms"""
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return round(ordered[index] * 1000, 3)
+
+
+def summarize(latencies):
+    ordered = sorted(latencies)
+    return {
+        'count': len(ordered),
+        'mean_ms': round(sum(ordered) / len(ordered) * 1000, 3) if ordered else 0.0,
+        'p50_ms': percentile(ordered, 0.50),
+        'p99_ms': percentile(ordered, 0.99),
+        'p999_ms': percentile(ordered, 0.999),
+        'max_ms': round(ordered[-1] * 1000, 3) if ordered else 0.0
+    }
+
+
+class Connection:
+    """One TLS connection sending a request at a time, push events from the server are skipped"""
+
+    def __init__(self, host, port, context):
+        raw_socket = socket.create_connection((host, port))
+        self.socket = context.wrap_socket(raw_socket, server_hostname=host)
+        if self.socket.getpeercert(binary_form=True) != context.pinned_certificate:
+            self.socket.close()
+            raise ssl.SSLError("server certificate does not match the bundled cert.pem")
+        self.decoder = FrameDecoder()
+        self.backlog = []
+        self.next_id = 0
+
+    def request(self, request):
+        self.next_id += 1
+        request['id'] = self.next_id
+        self.socket.sendall(encode_message(request))
+        while True:
+            while self.backlog:
+                message = decode_message(self.backlog.pop(0))
+                if message.get('id') == self.next_id:
+                    return message
+            data = self.socket.recv(RECV_SIZE)
+            if not data:
+                raise ConnectionError("server closed the connection")
+            self.backlog.extend(self.decoder.feed(data))
+
+    def close(self):
+        self.socket.close()
+
+
+# Request builders: (connection state, fixture users) -> request dict
+
+def login_request(state, users):
+    user = random.choice(users)
+    return {'type': 'login', 'email': user['username'], 'password': PASSWORD}
+
+
+def signup_request(state, users):
+    state['signups'] += 1
+    name = f"lt_{state['prefix']}_{state['signups']}"
+    return {'type': 'signup', 'username': name, 'email': f"{name}@load.test", 'password': PASSWORD}
+
+
+def friendlist_get_request(state, users):
+    return {'type': 'friendlist', 'action': 'get', 'user_id': state['user']['id']}
+
+
+def friendlist_count_request(state, users):
+    return {'type': 'friendlist', 'action': 'count', 'user_id': state['user']['id']}
+
+
+def friendlist_add_request(state, users):
+    """Alternates adding and removing the same friend so the graph doesn't only grow"""
+    friend = random.choice(users)
+    action = 'remove' if friend['id'] in state['friends'] else 'add'
+    state['friends'].symmetric_difference_update({friend['id']})
+    return {'type': 'friendlist', 'action': action, 'user_id': state['user']['id'], 'friend_id': friend['id']}
+
+
+def user_info_request(state, users):
+    return {'type': 'user_info', 'user_id': random.choice(users)['id']}
+
+
+REQUESTS = {
+    'login': login_request,
+    'signup': signup_request,
+    'friendlist.get': friendlist_get_request,
+    'friendlist.count': friendlist_count_request,
+    'friendlist.add': friendlist_add_request,
+    'user_info': user_info_request
+}
+
+
+def create_users(args, context, count):
+    """Sign up and log in the fixture users the requests act on"""
+    prefix = uuid.uuid4().hex[:8]
+    connection = Connection(args.host, args.port, context)
+    users = []
+    for index in range(count):
+        name = f"lt_{prefix}_user{index}"
+        connection.request({'type': 'signup', 'username': name, 'email': f"{name}@load.test", 'password': PASSWORD})
+        response = connection.request({'type': 'login', 'email': name, 'password': PASSWORD})
+        if response.get('status') != 'success':
+            raise SystemExit(f"could not create fixture user {name}: {response}")
+        users.append(response['user'])
+    connection.close()
+    return users
+
+
+def make_context(cert):
+    """
+    Client context pinned to the bundled certificate
+
+    The certificate is self-signed, issued to a person rather than a host name and past its
+    expiry date, so instead of chain validation each connection checks that the server
+    presented exactly this certificate.
+    """
+    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    with open(cert) as f:
+        context.pinned_certificate = ssl.PEM_cert_to_DER_cert(f.read())
+    return context
+
+
+def run_connection(args, context, users, mix, deadline, measure_from, results, lock):
+    """Closed loop on one connection until the deadline, samples before measure_from are warmup"""
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    state = {'prefix': uuid.uuid4().hex[:8], 'signups': 0, 'user': random.choice(users), 'friends': set()}
+    latencies = {name: [] for name in names}
+    outcomes = {'failed': 0, 'busy': 0, 'errors': 0}
+
+    try:
+        connection = Connection(args.host, args.port, context)
+    except (OSError, ssl.SSLError):
+        with lock:
+            results['connect_errors'] += 1
+        return
+
+    try:
+        while time.monotonic() < deadline:
+            name = random.choices(names, weights)[0]
+            request = REQUESTS[name](state, users)
+            started = time.monotonic()
+            response = connection.request(request)
+            finished = time.monotonic()
+            if started < measure_from:
+                continue
+            latencies[name].append(finished - started)
+            if response.get('status') == 'busy':
+                outcomes['busy'] += 1
+            elif response.get('status') == 'failed':
+                outcomes['failed'] += 1
+    except (OSError, ssl.SSLError, ValueError):
+        outcomes['errors'] += 1
+    finally:
+        connection.close()
+
+    with lock:
+        for name, samples in latencies.items():
+            results['latencies'].setdefault(name, []).extend(samples)
+        for key, value in outcomes.items():
+            results[key] += value
+
+
+def run_worker(args, users, mix, connections, start_at):
+    """Drive `connections` connections from threads, in its own process so the client isn't GIL bound"""
+    context = make_context(args.cert)
+    results = {'latencies': {}, 'failed': 0, 'busy': 0, 'errors': 0, 'connect_errors': 0}
+    lock = threading.Lock()
+    measure_from = start_at + args.warmup
+    deadline = measure_from + args.duration
+
+    threads = [threading.Thread(target=run_connection,
+                                args=(args, context, users, mix, deadline, measure_from, results, lock))
+               for _ in range(connections)]
+    while time.monotonic() < start_at:
+        time.sleep(0.01)
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def run(args):
+    mix = parse_mix(args.mix)
+    context = make_context(args.cert)
+    users = create_users(args, context, args.users)
+
+    processes = max(1, min(args.processes, args.connections))
+    shares = [args.connections // processes + (index < args.connections % processes) for index in range(processes)]
+    # CLOCK_MONOTONIC is shared by every process on the machine, so all workers start together
+    start_at = time.monotonic() + 1.0
+    with multiprocessing.Pool(processes) as pool:
+        parts = pool.starmap(run_worker, [(args, users, mix, share, start_at) for share in shares])
+
+    latencies = {}
+    totals = {'failed': 0, 'busy': 0, 'errors': 0, 'connect_errors': 0}
+    for part in parts:
+        for name, samples in part['latencies'].items():
+            latencies.setdefault(name, []).extend(samples)
+        for key in totals:
+            totals[key] += part[key]
+
+    everything = [sample for samples in latencies.values() for sample in samples]
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'label': args.label,
+        'connections': args.connections,
+        'processes': processes,
+        'duration': args.duration,
+        'mix': mix,
+        'requests': len(everything),
+        'throughput': round(len(everything) / args.duration, 1),
+        **totals,
+        'latency': summarize(everything),
+        'per_request': {name: summarize(samples) for name, samples in sorted(latencies.items())}
+    }
+
+
+def print_result(result):
+    latency = result['latency']
+    print(f"{result['requests']} requests in {result['duration']}s over {result['connections']} connections: "
+          f"{result['throughput']:.0f} req/s, p50 {latency['p50_ms']} ms, p99 {latency['p99_ms']} ms, "
+          f"p999 {latency['p999_ms']} ms")
+    print(f"failed {result['failed']}, busy {result['busy']}, errors {result['errors']}, "
+          f"connect errors {result['connect_errors']}")
+    print(f"{'request':>18} {'count':>8} {'p50 ms':>9} {'p99 ms':>9} {'p999 ms':>9}")
+    for name, stats in result['per_request'].items():
+        print(f"{name:>18} {stats['count']:>8} {stats['p50_ms']:>9} {stats['p99_ms']:>9} {stats['p999_ms']:>9}")
+
+
+def compare(path):
+    """Table of every saved run, one row each"""
+    with open(path) as f:
+        runs = [json.loads(line) for line in f if line.strip()]
+    print(f"{'time':>19} {'label':>12} {'conns':>6} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'p999 ms':>9} {'busy':>6}")
+    for result in runs:
+        latency = result['latency']
+        print(f"{result['time']:>19} {str(result['label'])[:12]:>12} {result['connections']:>6} "
+              f"{result['throughput']:>9.0f} {latency['p50_ms']:>9} {latency['p99_ms']:>9} "
+              f"{latency['p999_ms']:>9} {result['busy']:>6}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--cert', default=os.path.join(SERVER_DIR, 'cert.pem'),
+                        help="certificate the server is trusted by")
+    parser.add_argument('--connections', type=int, default=50)
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help="client processes the connections are spread over")
+    parser.add_argument('--duration', type=float, default=10.0, help="measured seconds")
+    parser.add_argument('--warmup', type=float, default=2.0, help="seconds of load before measuring")
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help=f"request weights, from {', '.join(REQUESTS)} (default {DEFAULT_MIX})")
+    parser.add_argument('--users', type=int, default=20, help="fixture users created before the run")
+    parser.add_argument('--label', default=None, help="name of the run in the results, e.g. the server mode")
+    parser.add_argument('--results', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                          'load_results.jsonl'),
+                        help="JSON lines file every run is appended to")
+    parser.add_argument('--compare', action='store_true', help="print the saved runs instead of running")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.results)
+        return
+
+    result = run(args)
+    with open(args.results, 'a') as f:
+        f.write(json.dumps(result) + '\n')
+    print_result(result)
+
+
+if __name__ == "__main__":
+    main()
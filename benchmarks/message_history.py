@@ -0,0 +1,99 @@
+"""
+Latest-page latency of a long conversation as the messages table grows
+
+Grows a scratch messages table in steps, a quarter of each step going to one long
+conversation and the rest spread over many others, and after each step times the
+newest 50 messages of the long conversation and a page deep in its history through
+MessageManager.get_history. Both should stay flat as the row count grows.
+
+    python benchmarks/message_history.py --sizes 100000 1000000 10000000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Server'))
+
+from Database import ConnectionPool, open_connection  # noqa: E402
+from MessageManager import MessageManager, conversation_key  # noqa: E402
+
+
+def create_schema(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender_id TEXT,
+            receiver_id TEXT,
+            message TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            conversation TEXT,
+            is_read INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages (conversation, timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_unread ON messages (receiver_id, sender_id) WHERE is_read = 0")
+    conn.commit()
+
+
+def grow(conn, rows, start):
+    """Append rows messages, a quarter of them between alice and bob"""
+    def generate():
+        for offset in range(rows):
+            second = start + offset
+            timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(1700000000 + second))
+            if offset % 4 == 0:
+                sender, receiver = ('alice', 'bob') if offset % 8 else ('bob', 'alice')
+            else:
+                sender, receiver = f"user{random.randrange(10000)}", f"user{random.randrange(10000)}"
+            yield conversation_key(sender, receiver), sender, receiver, 'hello', timestamp
+
+    conn.executemany("""
+        INSERT INTO messages (conversation, sender_id, receiver_id, message, timestamp)
+        VALUES (?, ?, ?, ?, ?)
+    """, generate())
+    conn.commit()
+
+
+def timed(function, repeat):
+    """Mean milliseconds of function()"""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - started) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        db_path = os.path.join(scratch, 'messages.db')
+        conn = open_connection(db_path)
+        create_schema(conn)
+        manager = MessageManager(pool=ConnectionPool(db_path))
+
+        print(f"{'rows':>12} {'latest ms':>10} {'deep page ms':>13}")
+        total = 0
+        for size in sorted(args.sizes):
+            grow(conn, size - total, total)
+            total = size
+
+            # Cursor of a page halfway back through the long conversation
+            cursor = list(conn.execute("""
+                SELECT timestamp, id FROM messages WHERE conversation = ?
+                ORDER BY timestamp DESC, id DESC LIMIT 1 OFFSET ?
+            """, (conversation_key('alice', 'bob'), size // 8)).fetchone())
+            latest = timed(lambda: manager.get_history('alice', 'bob'), args.repeat)
+            deep = timed(lambda: manager.get_history('alice', 'bob', before=cursor), args.repeat)
+            print(f"{size:>12} {latest:10.3f} {deep:13.3f}")
+
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,18 +2,33 @@ import threading
 import tkinter as tk
 from tkinter import ttk, messagebox
 from game_scanner import GameScanner
-from MetaDataRetrieval import GameMetadataRetriever
 import os
 from PIL import Image, ImageTk
 from io import BytesIO
-import requests
 import json
+import base64
 import socket
 import ssl
+import queue
+import subprocess
+import time
+import uuid
+from Protocol import FrameDecoder, encode_message, decode_message, RECV_SIZE
+from Library import library_from_games, library_version, diff_library
 
 # VARIABLES
 host = '127.0.0.1'
 port = 5000
+# Requests without side effects, sent again on a new connection when the old one dropped before their answers
+READ_ONLY_REQUESTS = ('user_info', 'user_search', 'library', 'game_metadata', 'cover', 'playtime', 'leaderboard')
+READ_ONLY_FRIENDLIST_ACTIONS = ('get', 'count', 'suggestions')
+# A game launched on Windows is timed by polling for its executable: how long it may take to appear, how often
+GAME_START_SECONDS = 30
+GAME_POLL_SECONDS = 15
+
+
+class RequestNotSent(ConnectionError):
+    """The connection was gone before the request could be written, it is safe to send again"""
 
 
 class OrderlyApp(tk.Tk):
@@ -33,15 +48,35 @@ class OrderlyApp(tk.Tk):
         self.static = None  # Variable for preventing "Function may be static" warning
         self.friend_window = None
         self.lock = threading.Lock()
+        # Held only while writing to the socket, the reader thread answers heartbeats with it
+        self.send_lock = threading.Lock()
         self.thread_flag = False
+        # Responses are read by a background thread, push events are handed to the Tk loop
+        self.reader_thread = None
+        self.responses_ready = threading.Condition()
+        self.connection_lost = False
+        self.events = queue.Queue()
+        self.friends_view_refresh = None  # set while the friends page is showing
+        self.next_request_id = 0
+        # Session token from the last login, lets reconnects and restarts skip the password
+        self.session_token = None
+        self.session_file = os.path.join(os.path.expanduser("~"), ".orderly", "session.json")
+        # Library as last synced to the server, later syncs only send what changed since
+        self.library_file = os.path.join(os.path.expanduser("~"), ".orderly", "library.json")
+        self.friend_libraries = {}  # {user_id: (version, games)} of libraries viewed this run
+        self.game_metadata_cache = {}  # {title: metadata} received from the server this run
+        # Cover thumbnails from the server, named by ETag and revalidated once per run
+        self.covers_dir = os.path.join(os.path.expanduser("~"), ".orderly", "covers")
+        self.cover_etags = self.load_cover_index()  # {title: ETag of the thumbnail on disk}
+        self.covers_checked = set()  # titles revalidated with the server this run
+        self.pending_responses = {}  # {request_id: response} received ahead of the caller waiting for them
+        self.abandoned_requests = set()  # request ids that timed out, their late responses are dropped
 
         # Connect to the server
         self.connect_to_server()
 
-        # self.notification_thread = threading.Thread(target=self.handle_server_responses, daemon=True)
-
-        # use RAWG.IO to receive game data
-        self.metadata_retriever = GameMetadataRetriever('74206afbba5d4287927acbdd696485f3')
+        # Apply push events (friend changes, friends coming online) as they arrive
+        self.after(200, self.process_server_events)
 
         # Configure the root window
         self.title("Orderly")
@@ -81,8 +116,9 @@ class OrderlyApp(tk.Tk):
         self.content_frame = ttk.Frame(self, style='Content.TFrame')
         self.nav_frame = None
 
-        # Create the first login form
-        self.create_login_form()
+        # Resume the previous session if the server still accepts it, otherwise show the login form
+        if not self.resume_session():
+            self.create_login_form()
 
     def create_login_form(self):
         """Create the login form"""
@@ -170,13 +206,7 @@ class OrderlyApp(tk.Tk):
                 'email': email,
                 'password': password
             }
-            self.socket.send(json.dumps(request).encode('utf-8'))
-            response_data = self.socket.recv(1024).decode('utf-8')
-
-            if not response_data:
-                raise ValueError("Empty response from server")
-
-            response = json.loads(response_data)
+            response = self.send_request(request)
 
             if response['status'] == 'success':
                 self.clear_content_frame()
@@ -212,17 +242,96 @@ class OrderlyApp(tk.Tk):
                              command=command)
             btn.pack(fill='x', padx=5, pady=5)
 
-    def launch_game(self, path):
-        """Launch game with error handling"""
-        self.static = None
+    def friends_leaderboard(self, title, shown=5):
+        """Text ranking the user among their friends by time played in a game"""
         try:
-            print(path)
-            os.startfile(path)
+            response = self.send_request({'type': 'leaderboard', 'game': title})
+        except Exception as e:
+            print(f"Error fetching leaderboard: {e}")
+            return ""
+        if response['status'] != 'success' or not response['entries']:
+            return ""
+        lines = ["Among Friends:"]
+        for entry in response['entries'][:shown]:
+            lines.append(f"{entry['rank']}. {entry['username']}  {entry['seconds'] / 3600:.1f} hours")
+        if response['rank'] and response['rank'] > shown:
+            lines.append(f"You are #{response['rank']} of {len(response['entries'])}")
+        return "\n".join(lines)
+
+    def launch_game(self, game):
+        """Launch game with error handling, the play session is reported to the server until it exits"""
+        try:
+            print(game['path'])
+            if os.name == 'nt':
+                # Shortcuts, URLs and games asking for elevation only launch the way Explorer launches them
+                os.startfile(game['path'])
+                process = None
+            else:
+                process = subprocess.Popen([game['path']], cwd=os.path.dirname(game['path']))
         except Exception as e:
             messagebox.showerror("Error",
                                  f"Failed to launch game: {str(e)}",
                                  icon='error')
-            pass
+            return
+
+        session_id = uuid.uuid4().hex
+        self.report_play_session('start', session_id, game['name'])
+        threading.Thread(target=self.watch_game, args=(process, game, session_id), daemon=True).start()
+
+    def watch_game(self, process, game, session_id):
+        """
+        Wait for a launched game to exit on a background thread and close its play session
+
+        os.startfile gives no process to wait for, the game's executable is looked for in the
+        running processes until it is gone.
+        """
+        if process is not None:
+            process.wait()
+        else:
+            image = game.get('exe_name') or os.path.basename(game['path'])
+            deadline = time.monotonic() + GAME_START_SECONDS
+            while self.is_running(image) or time.monotonic() < deadline:
+                time.sleep(GAME_POLL_SECONDS)
+        self.report_play_session('stop', session_id)
+
+    def is_running(self, image):
+        """Whether a process runs the executable named `image` (Windows)"""
+        self.static = None
+        try:
+            result = subprocess.run(['tasklist', '/FI', f"IMAGENAME eq {image}", '/NH'], capture_output=True,
+                                    text=True, creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0))
+        except OSError:
+            return False
+        return image.lower() in result.stdout.lower()
+
+    def report_play_session(self, event, session_id, game=None):
+        """Tell the server a game was started or stopped, the server times the session"""
+        if not self.user:
+            return
+        request = {'type': 'play_session', 'event': event, 'session_id': session_id}
+        if game:
+            request['game'] = game
+        try:
+            response = self.send_request(request)
+        except Exception as e:
+            print(f"Error reporting play session: {e}")
+            return
+        if response['status'] != 'success':
+            print(f"Play session not recorded: {response.get('message')}")
+
+    def hours_played(self, title):
+        """Text for how long the user played a game, from the server's playtime rollups"""
+        try:
+            response = self.send_request({'type': 'playtime'})
+        except Exception as e:
+            print(f"Error fetching playtime: {e}")
+            return "Unknown"
+        if response['status'] != 'success':
+            return "Unknown"
+        for entry in response['games']:
+            if entry['game'] == title:
+                return f"{entry['seconds'] / 3600:.1f} hours"
+        return "Not played yet"
 
     def fetch_covers(self):
         self.cover_fetch_index = 0
@@ -232,30 +341,7 @@ class OrderlyApp(tk.Tk):
         if self.cover_fetch_index < len(self.games_list):
             game = self.games_list[self.cover_fetch_index]
             try:
-                # Construct the local file path
-                local_path = os.path.join(r'C:\Users\User\PycharmProjects\Orderly\Icons',
-                                          f"{game['name']}.jpg")
-
-                image = None
-                # First try to load local file
-                if os.path.exists(local_path):
-                    try:
-                        image_data = open(local_path, 'rb')
-                        image = Image.open(image_data)
-                    except Exception as e:
-                        print(f"Error loading local cover for {game['name']}: {e}")
-
-                # If no local file, fetch from internet
-                if not image:
-                    cover_url = self.metadata_retriever.get_cover_url(game['name'])
-                    if cover_url:
-                        response = requests.get(cover_url)
-                        # Save the cover locally
-                        with open(local_path, 'wb') as f:
-                            f.write(response.content)
-                        image_data = BytesIO(response.content)
-                        image = Image.open(image_data)
-
+                image = self.cover_image(game['name'])
                 if image:
                     image = image.resize((200, 200))
                     photo = ImageTk.PhotoImage(image)
@@ -286,16 +372,11 @@ class OrderlyApp(tk.Tk):
                 'password': password
             }
             try:
-                self.socket.send(json.dumps(request).encode('utf-8'))
-                response_data = self.socket.recv(1024).decode('utf-8')
-
-                if not response_data:
-                    raise ValueError("Empty response from server")
-
-                response = json.loads(response_data)
+                response = self.send_request(request)
 
                 if response['status'] == 'success':
                     self.user = response['user']
+                    self.save_session(response.get('token'))
                     if self.login_frame:
                         self.login_frame.destroy()  # Destroy the login frame
                         self.login_frame = None
@@ -340,6 +421,9 @@ class OrderlyApp(tk.Tk):
         friend_id_entry = ttk.Entry(add_friend_frame, width=30)
         friend_id_entry.pack(side='left', padx=(0, 10))
 
+        # Usernames found by the search below, typed or picked names are added by their ID
+        search_matches = {}
+
         def add_friend():
             friend_username = friend_id_entry.get()
             if friend_username:
@@ -347,15 +431,16 @@ class OrderlyApp(tk.Tk):
                     'type': 'friendlist',
                     'action': 'add',
                     'user_id': self.user['id'],
-                    'friend_id': friend_username
+                    'friend_id': search_matches.get(friend_username, friend_username)
                 }
                 try:
-                    self.socket.send(json.dumps(request).encode('utf-8'))
-                    response = json.loads(self.socket.recv(1024).decode('utf-8'))
+                    # Added and the list reloaded in one batch
+                    response = refresh_friends_list(change=request)
 
+                    if response is None:
+                        return
                     if response['status'] == 'success':
                         messagebox.showinfo("Success", "Friend added successfully!")
-                        refresh_friends_list()  # Refresh the list after adding
                     else:
                         messagebox.showerror("Error", response.get('message', 'Failed to add friend'))
                 except Exception as e:
@@ -367,6 +452,93 @@ class OrderlyApp(tk.Tk):
                                 command=add_friend)
         add_button.pack(side='left')
 
+        # Search as you type, matching usernames are listed under the entry
+        search_results = tk.Listbox(friends_frame, height=5, font=('Helvetica', 11),
+                                    relief='flat', highlightthickness=1)
+
+        def search_users(event=None):
+            query = friend_id_entry.get().strip()
+            search_matches.clear()
+            search_results.delete(0, tk.END)
+            if not query:
+                search_results.pack_forget()
+                return
+            try:
+                response = self.send_request({'type': 'user_search', 'query': query, 'limit': 10})
+            except Exception as e:
+                print(f"Failed to search users: {e}")
+                return
+            for user in response.get('users', []):
+                if user['id'] != self.user['id']:
+                    search_matches[user['username']] = user['id']
+                    search_results.insert(tk.END, user['username'])
+            if search_matches:
+                search_results.pack(fill="x", padx=20, after=add_friend_frame)
+            else:
+                search_results.pack_forget()
+
+        def pick_result(event=None):
+            selection = search_results.curselection()
+            if selection:
+                friend_id_entry.delete(0, tk.END)
+                friend_id_entry.insert(0, search_results.get(selection[0]))
+                search_results.pack_forget()
+
+        friend_id_entry.bind('<KeyRelease>', search_users)
+        search_results.bind('<<ListboxSelect>>', pick_result)
+
+        # Suggestions section, friends of friends ranked by mutual friends
+        suggestions_frame = ttk.Frame(friends_frame, style='Content.TFrame')
+        suggestions_frame.pack(fill="x", padx=20, pady=10)
+
+        suggestions_label = ttk.Label(suggestions_frame,
+                                      text="People You May Know",
+                                      font=('Helvetica', 14, 'bold'),
+                                      background='white')
+        suggestions_label.pack(anchor='w')
+
+        suggestions_list = ttk.Frame(suggestions_frame, style='Content.TFrame')
+        suggestions_list.pack(fill="x")
+
+        suggestions_request = {
+            'type': 'friendlist',
+            'action': 'suggestions',
+            'user_id': self.user['id'],
+            'limit': 5
+        }
+
+        def refresh_suggestions(response):
+            for widget in suggestions_list.winfo_children():
+                widget.destroy()
+
+            suggestions = response.get('suggestions', []) if response['status'] == 'success' else []
+            if not suggestions:
+                ttk.Label(suggestions_list,
+                          text="No suggestions yet.",
+                          font=('Helvetica', 11),
+                          background='white').pack(anchor='w', pady=5)
+                return
+
+            for suggestion in suggestions:
+                suggestion_frame = ttk.Frame(suggestions_list, style='Content.TFrame')
+                suggestion_frame.pack(fill='x', pady=2)
+
+                mutual = suggestion['mutual_friends']
+                ttk.Label(suggestion_frame,
+                          text=f"{suggestion['username']}  ({mutual} mutual friend{'s' if mutual != 1 else ''})",
+                          font=('Helvetica', 12),
+                          background='white').pack(side='left', padx=5)
+
+                def add_suggestion(friend_id=suggestion['id']):
+                    friend_id_entry.delete(0, tk.END)
+                    friend_id_entry.insert(0, friend_id)
+                    add_friend()
+
+                ttk.Button(suggestion_frame,
+                           text="Add",
+                           style='ModernButton.TButton',
+                           command=add_suggestion).pack(side='right')
+
         # Friends list section
         friends_list_frame = ttk.Frame(friends_frame, style='Content.TFrame')
         friends_list_frame.pack(fill="both", expand=True, padx=20, pady=10)
@@ -390,24 +562,33 @@ class OrderlyApp(tk.Tk):
         canvas.create_window((0, 0), window=scrollable_frame, anchor="nw", width=canvas.winfo_reqwidth())
         canvas.configure(yscrollcommand=scrollbar.set)
 
-        def refresh_friends_list():
+        def refresh_friends_list(change=None):
+            """
+            Reload the friends list and suggestions in one batch
+
+            :param change: add or remove request to run first in the same batch
+            :return: the change's response, None if the server couldn't be reached
+            """
             # Clear existing friends
             for widget in scrollable_frame.winfo_children():
                 widget.destroy()
 
-            # Request friends list from server
+            # Request friends list and suggestions from server
             request = {
                 'type': 'friendlist',
                 'action': 'get',
                 'user_id': self.user['id']
             }
+            requests = ([change] if change else []) + [request, suggestions_request]
             try:
-                self.socket.send(json.dumps(request).encode('utf-8'))
-                self.lock.acquire()
-                response = self.socket.recv(1024).decode('utf-8')
-                self.lock.release()
-                response = json.loads(response)
+                responses = self.send_batch(requests)
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to fetch friends list: {e}")
+                return None
+            change_response = responses.pop(0) if change else None
+            response, suggestions_response = responses
 
+            try:
                 if response['status'] == 'success':
                     friends = response.get('friends', [])
 
@@ -422,8 +603,9 @@ class OrderlyApp(tk.Tk):
                             friend_frame = ttk.Frame(scrollable_frame, style='Content.TFrame')
                             friend_frame.pack(fill='x', pady=5)
 
+                            status = "  • online" if friend.get('online') else ""
                             friend_name = ttk.Label(friend_frame,
-                                                    text=friend['username'],
+                                                    text=friend['username'] + status,
                                                     font=('Helvetica', 12),
                                                     background='white')
                             friend_name.pack(side='left', padx=5)
@@ -436,12 +618,13 @@ class OrderlyApp(tk.Tk):
                                     'friend_id': friend_id
                                 }
                                 try:
-                                    self.socket.send(json.dumps(f_request).encode('utf-8'))
-                                    f_response = json.loads(self.socket.recv(1024).decode('utf-8'))
+                                    # Removed and the list reloaded in one batch
+                                    f_response = refresh_friends_list(change=f_request)
 
+                                    if f_response is None:
+                                        return
                                     if f_response['status'] == 'success':
                                         messagebox.showinfo("Success", "Friend removed successfully!")
-                                        refresh_friends_list()  # Refresh the list after removing
                                     else:
                                         messagebox.showerror("Error",
                                                              f_response.get('message', 'Failed to remove friend'))
@@ -460,11 +643,22 @@ class OrderlyApp(tk.Tk):
                                                          command=lambda f=friend['id']: self.show_profile(f))
                             friend_prof_btn.pack(side='right', padx=5)
 
+                            friend_library_btn = ttk.Button(friend_frame,
+                                                            text="Library",
+                                                            style='ModernButton.TButton',
+                                                            command=lambda f=friend: self.show_friend_library(
+                                                                f['id'], f['username']))
+                            friend_library_btn.pack(side='right', padx=5)
+
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to fetch friends list: {e}")
 
-        # Initial friends list load
+            refresh_suggestions(suggestions_response)
+            return change_response
+
+        # Initial friends list load, afterwards server push events trigger the refreshes
         refresh_friends_list()
+        self.friends_view_refresh = refresh_friends_list
 
         # Configure canvas resize behavior
         def configure_canvas(event):
@@ -486,6 +680,7 @@ class OrderlyApp(tk.Tk):
     def show_library(self):
         """Display the game library"""
         self.games_list = self.game_scanner.scan()
+        self.sync_library(self.games_list)
         self.clear_content_frame()  # Clear existing content
 
         # create the content frame for the library view
@@ -588,7 +783,7 @@ class OrderlyApp(tk.Tk):
                 # Create launch button
                 launch_button = tk.Button(button_frame,
                                           text="▶️ Launch",
-                                          command=lambda g=game: self.launch_game(g['path']),
+                                          command=lambda g=game: self.launch_game(g),
                                           bg='lightgray',
                                           fg='black',
                                           bd=0,
@@ -637,6 +832,54 @@ class OrderlyApp(tk.Tk):
         self.games_list = self.game_scanner.scan()
         self.show_library()
 
+    def show_friend_library(self, user_id, username):
+        """Display the games a friend's client last synced"""
+        request = {'type': 'library', 'user_id': user_id}
+        cached = self.friend_libraries.get(user_id)
+        if cached:
+            request['version'] = cached[0]
+        try:
+            response = self.send_request(request)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to fetch library: {e}")
+            return
+        if response['status'] != 'success':
+            messagebox.showerror("Error", response.get('message', 'Failed to fetch library'))
+            return
+        if not response.get('unchanged'):
+            cached = self.friend_libraries[user_id] = (response['version'], response['games'])
+        games = cached[1]
+
+        self.clear_content_frame()
+        library_frame = ttk.Frame(self, style='Content.TFrame')
+        library_frame.pack(fill="both", expand=True)
+
+        header_frame = ttk.Frame(library_frame, style='Content.TFrame')
+        header_frame.pack(fill="x", padx=20, pady=10)
+        ttk.Label(header_frame,
+                  text=f"{username}'s Library",
+                  font=('Helvetica', 20, 'bold'),
+                  background='white').pack(side='left')
+        ttk.Button(header_frame,
+                   text="Back",
+                   style='ModernButton.TButton',
+                   command=self.show_friends).pack(side='right')
+
+        if not games:
+            ttk.Label(library_frame,
+                      text="No games synced yet.",
+                      font=('Helvetica', 12),
+                      background='white').pack(pady=20)
+            return
+
+        games_list = tk.Listbox(library_frame, font=('Helvetica', 12), relief='flat', highlightthickness=0)
+        scrollbar = ttk.Scrollbar(library_frame, orient="vertical", command=games_list.yview)
+        games_list.configure(yscrollcommand=scrollbar.set)
+        for game in games:
+            games_list.insert(tk.END, game['name'])
+        games_list.pack(side="left", fill="both", expand=True, padx=(20, 0), pady=10)
+        scrollbar.pack(side="right", fill="y", pady=10)
+
     def show_profile(self, user_id=None):
         """Display user profile with detailed information"""
         self.clear_content_frame()
@@ -645,23 +888,28 @@ class OrderlyApp(tk.Tk):
         if user_id is None:
             user_id = self.user['id']
 
-        # Request user information from server
+        # Request user information and friend count from server in a single batch
         request = {
             'type': 'user_info',
             'user_id': user_id
         }
+        count_request = {
+            'type': 'friendlist',
+            'action': 'count',
+            'user_id': user_id
+        }
         try:
-            self.socket.send(json.dumps(request).encode('utf-8'))
-            response = json.loads(self.socket.recv(1024).decode('utf-8'))
+            response, count_response = self.send_batch([request, count_request])
 
             if response['status'] == 'success':
                 user_data = response['user']
+                friends_count = count_response.get('message', '0') if count_response['status'] == 'success' else '0'
                 # Store the current user temporarily
                 current_user = self.user
                 # Set the viewed user's data
                 self.user = user_data
                 # Show the profile
-                self._display_profile()
+                self._display_profile(friends_count)
                 # Restore the current user's data
                 self.user = current_user
             else:
@@ -672,7 +920,6 @@ class OrderlyApp(tk.Tk):
     def show_home(self):
         """Display the home page"""
         self.clear_content_frame()
-        # self.notification_thread.start()
         # Create and pack the home content frame
         home_frame = ttk.Frame(self, style='Content.TFrame')
         home_frame.pack(fill="both", expand=True)
@@ -705,8 +952,7 @@ class OrderlyApp(tk.Tk):
             'user_id': user_id
         }
         try:
-            self.socket.send(json.dumps(request).encode('utf-8'))
-            response = json.loads(self.socket.recv(1024).decode('utf-8'))
+            response = self.send_request(request)
 
             if response['status'] == 'success':
                 user_data = response['user']
@@ -723,7 +969,7 @@ class OrderlyApp(tk.Tk):
         except Exception as e:
             messagebox.showerror("Error", f"Failed to fetch user profile: {e}")
 
-    def _display_profile(self):
+    def _display_profile(self, friends_count=None):
         """Helper method to display the profile of the current user"""
         # Create main profile container
         profile_frame = ttk.Frame(self, style='Content.TFrame')
@@ -822,18 +1068,17 @@ class OrderlyApp(tk.Tk):
                 'user_id': self.user['id']
             }
             try:
-                self.socket.send(json.dumps(request).encode('utf-8'))
-                response = json.loads(self.socket.recv(1024).decode('utf-8'))
+                response = self.send_request(request)
                 return response.get('message', '0') if response['status'] == 'success' else '0'
             except (socket.error, json.JSONDecodeError, KeyError) as e:
                 print(f"Error: {e}")
                 return '0'
 
-        friends_count = ttk.Label(friends_frame,
-                                  text=get_friends_count(),
-                                  font=('Helvetica', 12),
-                                  background='white')
-        friends_count.pack(side='left', padx=5)
+        friends_count_label = ttk.Label(friends_frame,
+                                        text=friends_count if friends_count is not None else get_friends_count(),
+                                        font=('Helvetica', 12),
+                                        background='white')
+        friends_count_label.pack(side='left', padx=5)
 
         view_friends_button = ttk.Button(friends_frame,
                                          text="View Friends",
@@ -847,6 +1092,12 @@ class OrderlyApp(tk.Tk):
 
     def logout(self):
         """Handle logout"""
+        if self.session_token:
+            try:
+                self.send_request({'type': 'logout', 'token': self.session_token})
+            except (socket.error, json.JSONDecodeError, KeyError) as e:
+                print(f"Error: {e}")
+        self.forget_session()
         self.user = None
         self.nav_frame.pack_forget()
         self.content_frame.pack_forget()
@@ -855,10 +1106,303 @@ class OrderlyApp(tk.Tk):
 
     def clear_content_frame(self):
         """Clear all content widgets except the navigation frame"""
+        self.friends_view_refresh = None
         for widget in self.winfo_children():
             if widget != self.nav_frame:  # Keep the navigation frame to avoid too much processing
                 widget.destroy()
 
+    def save_session(self, token):
+        """Remember the session token in memory and on disk for the next start"""
+        self.session_token = token
+        if not token:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.session_file), exist_ok=True)
+            with open(self.session_file, 'w') as f:
+                json.dump({'token': token}, f)
+        except OSError as e:
+            print(f"Error saving session: {e}")
+
+    def load_synced_library(self):
+        """The library the server has for the current user as of the last sync, or None"""
+        try:
+            with open(self.library_file, 'r') as f:
+                synced = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        return synced if synced.get('user_id') == self.user['id'] else None
+
+    def sync_library(self, games):
+        """
+        Send the scanned library to the server, only the changes when it has an earlier version
+
+        :param games: GameScanner.scan() output
+        """
+        library = library_from_games(games)
+        version = library_version(library)
+        synced = self.load_synced_library()
+
+        request = {'type': 'library_sync', 'base': None, 'version': version, 'added': list(library.values())}
+        if synced:
+            added, changed, removed = diff_library(synced['games'], library)
+            request = {'type': 'library_sync', 'base': synced['version'], 'version': version}
+            for key, part in (('added', added), ('changed', changed), ('removed', removed)):
+                if part:
+                    request[key] = part
+        try:
+            response = self.send_request(request)
+            if response['status'] == 'resync' and synced:
+                # The server's copy isn't the one we diffed against, send everything
+                response = self.send_request({'type': 'library_sync', 'base': None, 'version': version,
+                                              'added': list(library.values())})
+        except Exception as e:
+            print(f"Error syncing library: {e}")
+            return
+
+        if response['status'] != 'success':
+            print(f"Library sync failed: {response.get('message', response['status'])}")
+            return
+        try:
+            os.makedirs(os.path.dirname(self.library_file), exist_ok=True)
+            with open(self.library_file, 'w') as f:
+                json.dump({'user_id': self.user['id'], 'version': version, 'games': library}, f)
+        except OSError as e:
+            print(f"Error saving synced library: {e}")
+
+    def game_metadata(self, title):
+        """
+        Description, cover URL and other details of a game from the server's shared cache,
+        the server fetches it from RAWG once for every client
+
+        :return: metadata dict, empty when the server couldn't provide it
+        """
+        metadata = self.game_metadata_cache.get(title)
+        if metadata is not None:
+            return metadata
+        try:
+            response = self.send_request({'type': 'game_metadata', 'title': title})
+        except Exception as e:
+            print(f"Error fetching metadata for {title}: {e}")
+            return {}
+        if response['status'] != 'success':
+            print(f"No metadata for {title}: {response.get('message')}")
+            return {}
+        metadata = self.game_metadata_cache[title] = response['metadata']
+        return metadata
+
+    def load_cover_index(self):
+        try:
+            with open(os.path.join(self.covers_dir, 'index.json'), 'r') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return {}
+
+    def cover_image(self, title):
+        """
+        Cover thumbnail of a game, from the local cache once the server confirmed it is current
+
+        :return: PIL image, None when there is no cover
+        """
+        etag = self.cover_etags.get(title)
+        if etag and not os.path.exists(os.path.join(self.covers_dir, f"{etag}.jpg")):
+            etag = None
+
+        if title not in self.covers_checked:
+            try:
+                response = self.send_request({'type': 'cover', 'title': title, 'etag': etag})
+            except Exception as e:
+                print(f"Error fetching cover for {title}: {e}")
+                response = {'status': 'failed'}
+            if response['status'] == 'success':
+                self.covers_checked.add(title)
+                if not response.get('not_modified'):
+                    etag = response['etag']
+                    try:
+                        os.makedirs(self.covers_dir, exist_ok=True)
+                        with open(os.path.join(self.covers_dir, f"{etag}.jpg"), 'wb') as f:
+                            f.write(base64.b64decode(response['image']))
+                        self.cover_etags[title] = etag
+                        with open(os.path.join(self.covers_dir, 'index.json'), 'w') as f:
+                            json.dump(self.cover_etags, f)
+                    except OSError as e:
+                        print(f"Error saving cover for {title}: {e}")
+                        return Image.open(BytesIO(base64.b64decode(response['image'])))
+
+        if not etag:
+            return None
+        with open(os.path.join(self.covers_dir, f"{etag}.jpg"), 'rb') as f:
+            return Image.open(BytesIO(f.read()))
+
+    def forget_session(self):
+        self.session_token = None
+        if os.path.exists(self.session_file):
+            os.remove(self.session_file)
+
+    def resume_session(self):
+        """Log back in with the saved session token, returns True if the home page is shown"""
+        if not self.socket or not os.path.exists(self.session_file):
+            return False
+        try:
+            with open(self.session_file, 'r') as f:
+                token = json.load(f).get('token')
+            response = self.send_request({'type': 'resume', 'token': token})
+        except (OSError, json.JSONDecodeError, KeyError) as e:
+            print(f"Error resuming session: {e}")
+            return False
+
+        if response['status'] != 'success':
+            self.forget_session()
+            return False
+
+        self.user = response['user']
+        self.session_token = token
+        self.create_nav_frame()
+        self.show_home()
+        return True
+
+    def send_requests(self, requests):
+        """
+        Pipeline several requests on the connection in one write
+
+        The server may answer them in any order, responses are matched back by request id.
+        If the connection dropped, it is re-established once and the session resumed with its
+        token. The requests are sent again if they never went out or have no side effects,
+        otherwise the error is raised: the server may have applied them. A timeout is raised
+        as it is, the server is slow rather than gone.
+
+        :param requests: list of request dicts, each is tagged with a fresh 'id'
+        :return: list of responses in the same order as the requests
+        """
+        with self.lock:
+            try:
+                return self._exchange(requests)
+            except TimeoutError:
+                raise
+            except (ConnectionError, ssl.SSLError, OSError) as error:
+                if not self._reconnect():
+                    raise
+                if not isinstance(error, RequestNotSent) and not all(map(self.is_read_only, requests)):
+                    raise
+                return self._exchange(requests)
+
+    def is_read_only(self, request):
+        """Whether a request can be sent twice without changing anything"""
+        self.static = None
+        if request.get('type') == 'friendlist':
+            return request.get('action') in READ_ONLY_FRIENDLIST_ACTIONS
+        if request.get('type') == 'batch':
+            return all(map(self.is_read_only, request.get('requests', [])))
+        return request.get('type') in READ_ONLY_REQUESTS
+
+    def _reconnect(self):
+        """Open a new connection and resume the session on it, called with self.lock held"""
+        if self.socket:
+            try:
+                self.socket.close()
+            except OSError:
+                pass
+        self.connect_to_server()
+        if not self.socket:
+            return False
+        if self.session_token:
+            response = self._exchange([{'type': 'resume', 'token': self.session_token}])[0]
+            if response['status'] != 'success':
+                self.forget_session()
+        return True
+
+    def _exchange(self, requests):
+        """Send requests and collect their responses, called with self.lock held"""
+        if self.socket is None:
+            raise RequestNotSent("Not connected to the server")
+
+        request_ids = []
+        for request in requests:
+            self.next_request_id += 1
+            request['id'] = self.next_request_id
+            request_ids.append(self.next_request_id)
+
+        with self.send_lock:
+            self.socket.sendall(b''.join(encode_message(request) for request in requests))
+
+        with self.responses_ready:
+            while not all(request_id in self.pending_responses for request_id in request_ids):
+                if self.connection_lost:
+                    raise ConnectionError("Server closed the connection")
+                if not self.responses_ready.wait(timeout=30):
+                    for request_id in request_ids:
+                        if self.pending_responses.pop(request_id, None) is None:
+                            self.abandoned_requests.add(request_id)
+                    raise TimeoutError("Server did not respond")
+            return [self.pending_responses.pop(request_id) for request_id in request_ids]
+
+    def read_server_messages(self, server_socket):
+        """Background reader: hands responses to the waiting request and queues push events for the UI"""
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = server_socket.recv(RECV_SIZE)
+                if not data:
+                    break
+                for payload in decoder.feed(data):
+                    message = decode_message(payload)
+                    if message.get('type') == 'ping':
+                        # Server heartbeat on an idle connection, answer so it isn't reaped
+                        with self.send_lock:
+                            server_socket.sendall(encode_message({'type': 'pong'}))
+                        continue
+                    if message.get('type') == 'event':
+                        self.events.put(message)
+                        continue
+                    with self.responses_ready:
+                        if message.get('id') in self.abandoned_requests:
+                            self.abandoned_requests.discard(message.get('id'))
+                            continue
+                        self.pending_responses[message.get('id')] = message
+                        self.responses_ready.notify_all()
+        except (OSError, ValueError) as e:
+            print(f"[!] Connection to server lost: {e}")
+
+        with self.responses_ready:
+            if self.socket is server_socket:
+                self.connection_lost = True
+            self.responses_ready.notify_all()
+
+    def process_server_events(self):
+        """Apply queued push events on the Tk thread, then check again shortly"""
+        refresh = False
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if event.get('event') in ('friend_added', 'friend_removed', 'online', 'offline', 'resync'):
+                refresh = True
+
+        if refresh and self.friends_view_refresh:
+            self.friends_view_refresh()
+        self.after(200, self.process_server_events)
+
+    def send_request(self, request):
+        """Send a single request and block until its response arrives"""
+        return self.send_requests([request])[0]
+
+    def send_batch(self, requests):
+        """
+        Send several requests as one 'batch' message, the server runs them together and
+        answers with one message
+
+        :return: list of responses in the same order as the requests, each the server's busy
+                 response if it turned the batch away
+        """
+        response = self.send_request({'type': 'batch', 'requests': requests})
+        if response['status'] == 'failed':
+            # A server without batches, or too many requests for one: pipeline them instead
+            return self.send_requests(requests)
+        if response['status'] != 'success':
+            # Busy, sending the requests one by one would only add to its load
+            return [response] * len(requests)
+        return response['responses']
+
     def connect_to_server(self):
         """Establish a connection to the server"""
         try:
@@ -873,6 +1417,14 @@ class OrderlyApp(tk.Tk):
                                               server_hostname=self.host)
 
             self.socket.connect((self.host, self.port))
+            with self.responses_ready:
+                self.pending_responses.clear()
+                self.abandoned_requests.clear()
+                self.connection_lost = False
+            self.reader_thread = threading.Thread(target=self.read_server_messages,
+                                                  args=(self.socket,),
+                                                  daemon=True)
+            self.reader_thread.start()
             print("[+] SSL connection established")
 
         except Exception as e:
@@ -934,6 +1486,8 @@ class OrderlyApp(tk.Tk):
     def show_game_info(self, game):
         """Displays the game info after button press"""
         self.clear_content_frame()
+        # One request for everything shown below
+        metadata = self.game_metadata(game['name'])
 
         # Create main container frame
         info_frame = ttk.Frame(self, style='Content.TFrame')
@@ -956,7 +1510,7 @@ class OrderlyApp(tk.Tk):
 
         # Description right below title in left container
         description_label = ttk.Label(left_content,
-                                      text=self.metadata_retriever.get_description(game['name']),
+                                      text=metadata.get('description', 'No description available'),
                                       font=("Helvetica", 10),
                                       background="white",
                                       wraplength=600,
@@ -964,25 +1518,35 @@ class OrderlyApp(tk.Tk):
         description_label.pack(anchor='w', pady=(10, 0))
 
         release_date_label = ttk.Label(right_content,
-                                       text=f"Released on: {self.metadata_retriever.get_release_date(game['name'])}",
+                                       text=f"Released on: {metadata.get('release_date', 'Unknown')}",
                                        font=("Helvetica", 10),
                                        background="white",
                                        justify="center")
         release_date_label.pack(anchor="e", pady=10)
 
         platforms_label = ttk.Label(left_content,
-                                    text=f"Available On: {self.metadata_retriever.get_platforms(game['name'])}",
+                                    text=f"Available On: {', '.join(metadata.get('platforms', []))}",
                                     font=("Helvetica", 10),
                                     background="white",
                                     justify="center")
         platforms_label.pack(anchor="e", pady=10)
 
+        playtime_label = ttk.Label(left_content,
+                                   text=f"Played: {self.hours_played(game['name'])}",
+                                   font=("Helvetica", 10),
+                                   background="white",
+                                   justify="center")
+        playtime_label.pack(anchor="e", pady=10)
+
+        leaderboard_label = ttk.Label(left_content,
+                                      text=self.friends_leaderboard(game['name']),
+                                      font=("Helvetica", 10),
+                                      background="white",
+                                      justify="left")
+        leaderboard_label.pack(anchor="w", pady=10)
+
         # Cover image in right container
         try:
-            # Construct the local file path
-            local_path = os.path.join(r'C:\Users\User\PycharmProjects\Orderly\Icons',
-                                      f"{game['name']}.jpg")
-
             # Create a placeholder image initially
             placeholder_image = Image.new('RGB', (200, 200), color='lightgray')
             placeholder_photo = ImageTk.PhotoImage(placeholder_image)
@@ -992,26 +1556,7 @@ class OrderlyApp(tk.Tk):
             cover_label.image = placeholder_photo
             cover_label.pack()
 
-            image = None
-            # First try to load local file
-            if os.path.exists(local_path):
-                try:
-                    image_data = open(local_path, 'rb')
-                    image = Image.open(image_data)
-                except Exception as e:
-                    print(f"Error loading local cover for {game['name']}: {e}")
-
-            # If no local file, fetch from internet
-            if not image:
-                cover_url = self.metadata_retriever.get_cover_url(game['name'])
-                if cover_url:
-                    response = requests.get(cover_url)
-                    # Save the cover locally
-                    with open(local_path, 'wb') as f:
-                        f.write(response.content)
-                    image_data = BytesIO(response.content)
-                    image = Image.open(image_data)
-
+            image = self.cover_image(game['name'])
             if image:
                 image = image.resize((200, 200))
                 photo = ImageTk.PhotoImage(image)
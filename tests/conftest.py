@@ -0,0 +1,8 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER = os.path.join(ROOT, 'Server')
+
+# The server's modules import each other by bare name, as when Server.py is run from Server/
+sys.path.insert(0, SERVER)
@@ -0,0 +1,74 @@
+import random
+import sqlite3
+
+import pytest
+
+from FriendManager import MAX_SUGGESTIONS, FriendGraph, rank_by_overlap
+
+
+def brute_counts(masks, exclude):
+    counts = {}
+    for mask in masks:
+        slot = 0
+        while mask >> slot:
+            if mask >> slot & 1 and not exclude >> slot & 1:
+                counts[slot] = counts.get(slot, 0) + 1
+            slot += 1
+    return counts
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_rank_by_overlap_matches_brute_force(seed):
+    rng = random.Random(seed)
+    slots = rng.randint(1, 300)
+    masks = [rng.getrandbits(slots) & rng.getrandbits(slots) for _ in range(rng.randint(0, 40))]
+    exclude = rng.getrandbits(slots) & rng.getrandbits(slots) & rng.getrandbits(slots)
+    limit = rng.randint(1, 30)
+
+    counts = brute_counts(masks, exclude)
+    ranked = rank_by_overlap(masks, exclude, limit)
+
+    assert len(ranked) == min(limit, len(counts))
+    assert all(counts[slot] == count for slot, count in ranked)
+    assert [count for _, count in ranked] == sorted(counts.values(), reverse=True)[:limit]
+
+
+def test_graph_suggestions_match_brute_force():
+    rng = random.Random(7)
+    users = [f"u{i}" for i in range(120)]
+    edges = {(user, friend) for user in users for friend in rng.sample(users, 12) if friend != user}
+
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE users (id TEXT PRIMARY KEY, username TEXT)")
+    conn.execute("CREATE TABLE friends (user_id TEXT, friend_id TEXT)")
+    conn.executemany("INSERT INTO users VALUES (?, ?)", [(user, user.upper()) for user in users])
+    conn.executemany("INSERT INTO friends VALUES (?, ?)", edges)
+    graph = FriendGraph()
+    graph.load(conn)
+
+    friends = {user: {friend for owner, friend in edges if owner == user} for user in users}
+    for user in users:
+        counts = {}
+        for friend in friends[user]:
+            for candidate in friends[friend] - friends[user] - {user}:
+                counts[candidate] = counts.get(candidate, 0) + 1
+        suggestions = graph.suggestions(user, MAX_SUGGESTIONS)
+        assert all(counts[s['id']] == s['mutual_friends'] and s['username'] == s['id'].upper() for s in suggestions)
+        assert ([s['mutual_friends'] for s in suggestions]
+                == sorted(counts.values(), reverse=True)[:MAX_SUGGESTIONS])
+
+
+def test_graph_suggestions_follow_changes():
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE users (id TEXT PRIMARY KEY, username TEXT)")
+    conn.execute("CREATE TABLE friends (user_id TEXT, friend_id TEXT)")
+    graph = FriendGraph()
+    graph.load(conn)
+
+    graph.add('a', 'b', 'B')
+    graph.add('b', 'c', 'C')
+    assert graph.suggestions('a') == [{'id': 'c', 'username': 'C', 'mutual_friends': 1}]
+    graph.add('a', 'c', 'C')
+    assert graph.suggestions('a') == []
+    graph.remove('a', 'c')
+    assert graph.suggestions('a') == [{'id': 'c', 'username': 'C', 'mutual_friends': 1}]
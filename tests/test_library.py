@@ -0,0 +1,80 @@
+import filecmp
+import os
+import random
+import sqlite3
+
+import pytest
+
+from conftest import ROOT, SERVER
+from Database import open_connection
+from Library import EMPTY_VERSION, diff_library, library_entry, library_version, update_version
+from LibraryManager import LibraryConflict, LibraryManager
+from Migrations import migrate
+
+
+def game(name, exe_name=None, kind='steam'):
+    return library_entry({'name': name, 'exe_name': exe_name or f"{name}.exe", 'type': kind})
+
+
+def test_client_and_server_copies_match():
+    assert filecmp.cmp(os.path.join(ROOT, 'Library.py'), os.path.join(SERVER, 'Library.py'), shallow=False)
+
+
+def test_version_independent_of_order():
+    games = [game(f"game {i}") for i in range(50)]
+    shuffled = games[:]
+    random.Random(1).shuffle(shuffled)
+    assert library_version({g['name']: g for g in games}) == library_version({g['name']: g for g in shuffled})
+    assert library_version({}) == EMPTY_VERSION
+
+
+def test_version_update_matches_recomputing():
+    old = {g['name']: g for g in (game('a'), game('b'), game('c'))}
+    new = {g['name']: g for g in (game('a'), game('b', 'other.exe'), game('d'))}
+    added, changed, removed = diff_library(old, new)
+    version = update_version(library_version(old), added=added + changed,
+                             removed=[old[entry['name']] for entry in changed] + [old[name] for name in removed])
+    assert version == library_version(new)
+
+
+@pytest.fixture
+def manager(tmp_path):
+    db_path = str(tmp_path / 'test.db')
+    conn = open_connection(db_path)
+    migrate(conn)
+    conn.close()
+    return LibraryManager(db_path)
+
+
+def test_delta_sync_equals_full_sync(manager):
+    old = {g['name']: g for g in (game('a'), game('b'), game('c'))}
+    new = {g['name']: g for g in (game('a'), game('b', 'other.exe'), game('d'), game('e'))}
+
+    base = manager.sync('delta', None, library_version(old), added=list(old.values()))
+    added, changed, removed = diff_library(old, new)
+    manager.sync('delta', base, library_version(new), added, changed, removed)
+    manager.sync('full', None, library_version(new), added=list(new.values()))
+
+    assert manager.get_version('delta') == manager.get_version('full') == (library_version(new), len(new))
+    assert manager.get_library('delta') == manager.get_library('full')
+    assert sorted(manager.get_library('delta')[1], key=lambda g: g['name']) == sorted(new.values(),
+                                                                                      key=lambda g: g['name'])
+
+
+def test_diff_against_another_version_is_refused(manager):
+    library = {g['name']: g for g in (game('a'),)}
+    manager.sync('user', None, library_version(library), added=list(library.values()))
+    with pytest.raises(LibraryConflict):
+        manager.sync('user', EMPTY_VERSION, library_version({}), removed=['a'])
+
+
+def test_duplicate_names_in_a_diff_are_refused(manager):
+    library = {g['name']: g for g in (game('a'), game('b'))}
+    base = manager.sync('user', None, library_version(library), added=list(library.values()))
+    for diff in ({'added': [game('c'), game('c')]}, {'removed': ['a', 'a']},
+                 {'changed': [game('a', 'x.exe')], 'removed': ['a']}):
+        with pytest.raises(ValueError):
+            manager.sync('user', base, base, **diff)
+    assert manager.get_version('user') == (base, 2)
+    with sqlite3.connect(manager.db_path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM library_games").fetchone()[0] == 2
@@ -0,0 +1,58 @@
+import filecmp
+import json
+import os
+
+import pytest
+
+from conftest import ROOT, SERVER
+from Protocol import HEADER, LARGE_MESSAGE_SIZE, FrameDecoder, ProtocolError, decode_message, encode_message
+
+
+def test_client_and_server_copies_match():
+    assert filecmp.cmp(os.path.join(ROOT, 'Protocol.py'), os.path.join(SERVER, 'Protocol.py'), shallow=False)
+
+
+def test_frames_split_across_reads():
+    messages = [{'type': 'ping'}, {'type': 'login', 'email': 'é' * 10}, []]
+    data = b''.join(encode_message(message) for message in messages)
+    decoder = FrameDecoder()
+    payloads = []
+    for i in range(len(data)):
+        payloads += decoder.feed(data[i:i + 1])
+    assert [decode_message(payload) for payload in payloads] == messages
+    assert decoder.pending() == 0
+
+
+def test_many_frames_in_one_read():
+    messages = [{'id': i} for i in range(100)]
+    payloads = FrameDecoder().feed(b''.join(encode_message(message) for message in messages))
+    assert [decode_message(payload) for payload in payloads] == messages
+
+
+def test_large_frame_streamed_in_chunks():
+    message = {'data': 'x' * (LARGE_MESSAGE_SIZE * 3)}
+    data = encode_message(message) + encode_message({'type': 'after'})
+    decoder = FrameDecoder()
+    payloads = []
+    for start in range(0, len(data), 1000):
+        payloads += decoder.feed(data[start:start + 1000])
+    assert [decode_message(payload) for payload in payloads] == [message, {'type': 'after'}]
+    assert decoder.pending() == 0
+
+
+def test_oversized_frame_rejected_from_its_header():
+    decoder = FrameDecoder(max_size=1024)
+    with pytest.raises(ProtocolError):
+        decoder.feed(HEADER.pack(1025))
+
+
+def test_oversized_message_not_encoded(monkeypatch):
+    import Protocol
+    monkeypatch.setattr(Protocol, 'MAX_MESSAGE_SIZE', 100)
+    with pytest.raises(ProtocolError):
+        encode_message({'data': 'x' * 100})
+
+
+def test_malformed_body():
+    with pytest.raises(json.JSONDecodeError):
+        decode_message(FrameDecoder().feed(HEADER.pack(3) + b'{x}')[0])
@@ -0,0 +1,46 @@
+import sqlite3
+
+import pytest
+
+from WriteQueue import GroupCommitWriter
+
+
+@pytest.fixture
+def writer(tmp_path):
+    db_path = str(tmp_path / 'test.db')
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("CREATE TABLE users (name TEXT PRIMARY KEY)")
+    # A long delay gathers everything submitted below into one batch
+    writer = GroupCommitWriter(db_path, max_delay=0.5)
+    yield writer
+    writer.stop()
+
+
+def insert(name):
+    def operation(cursor):
+        cursor.execute("INSERT INTO users (name) VALUES (?)", (name,))
+        return name
+    return operation
+
+
+def test_failing_operation_rolled_back_alone(writer):
+    def insert_twice(cursor):
+        cursor.execute("INSERT INTO users (name) VALUES ('c')")
+        cursor.execute("INSERT INTO users (name) VALUES ('a')")
+
+    futures = [writer.submit(insert('a')), writer.submit(insert_twice), writer.submit(insert('b'))]
+    assert futures[0].result() == 'a'
+    with pytest.raises(sqlite3.IntegrityError):
+        futures[1].result()
+    assert futures[2].result() == 'b'
+    assert writer.stats()['batches'] == 1
+
+    with sqlite3.connect(writer.db_path) as conn:
+        # 'c' went with the rest of the failed operation
+        assert [row[0] for row in conn.execute("SELECT name FROM users ORDER BY name")] == ['a', 'b']
+
+
+def test_execute_returns_after_commit(writer):
+    assert writer.execute(insert('a')) == 'a'
+    with sqlite3.connect(writer.db_path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 1